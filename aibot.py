@@ -1,33 +1,69 @@
+import time
+import asyncio
 import logging
 import os
-from fastapi import FastAPI, Request, BackgroundTasks
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 import uvicorn
-import requests
 
 from dotenv import load_dotenv
-from llm.models import interact_with_ai
+from llm.models import interact_with_ai, configure_tool_runner
+from llm.context import configure_store, delete_context, flush_context, release_contexts, release_context
+from llm.budget import configure_budget, budget
+from llm.summarizer import configure_summarizer, summarizer
+from llm.memory import configure_memory, memory
+from llm.toolcache import configure_tool_cache, tool_cache
+from llm.compact import configure_compactor, compactor
+from llm.registry import configure_tools, tool_registry
+from llm.db import configure_db, series_db
+from llm import web
+from llm.httpclient import configure_http, http_clients
+from llm.weather import configure_weather, weather
+from llm.files import configure_files, files
+from llm.backends import configure_ollama, ollama_clients, router
+from llm.telegram import configure_outbox, outbox, TelegramReplyStream
+from llm.scheduler import ChatScheduler
+from llm.ingest import configure_ingest, ingestor
+from llm.cluster import configure_cluster, cluster, run_workers
+from llm.metrics import metrics, new_trace
+from llm.logs import configure_logging, logs, truncated
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure basic logging
-logging.basicConfig(
-    format='%(levelname)s: %(name)s %(message)s',
-    level=logging.INFO
-)
+LOG_CONFIG = {
+  "level": os.getenv("LOG_LEVEL", "INFO"),
+  # LOG_LEVELS="llm.context=DEBUG,httpx=WARNING" overrides the level of single modules
+  "levels": dict(item.strip().split("=") for item in os.getenv("LOG_LEVELS", "").split(",") if item.strip()),
+  "payload_chars": int(os.getenv("LOG_PAYLOAD_CHARS", "500")),
+  "debug_sample": float(os.getenv("LOG_DEBUG_SAMPLE", "1")),
+  "queue_size": int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+}
+
+# Configure logging once, every module logs through a queue to a writer thread
+configure_logging(LOG_CONFIG)
 logger = logging.getLogger(__name__)
 
 def to_bool(env):
   return os.getenv(env, 'False').lower() in ('true', '1', 't')
 
-def escape_telegram_markdown(text):
-    return text.replace("_", "\\_").replace("*", "\\*").replace("[", "\\[").replace("`", "\\`");
-
-app = FastAPI()
 # Get bot token from environment variables
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 UVICORN_PORT = os.getenv("UVICORN_PORT")
 ALLOWED_CHAT_IDS = [int(id) for id in os.getenv("ALLOWED_CHAT_IDS").split(",")]
+TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.5"))
+
+TELEGRAM_CONFIG = {
+  "token": TELEGRAM_BOT_TOKEN,
+  "api_url": os.getenv("TELEGRAM_API_URL", "https://api.telegram.org"),
+  "rate": float(os.getenv("TELEGRAM_RATE", "30")),
+  "chat_rate": float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+  "chat_burst": int(os.getenv("TELEGRAM_CHAT_BURST", "3")),
+  "queue_max": int(os.getenv("TELEGRAM_QUEUE_MAX", "500")),
+  "senders": int(os.getenv("TELEGRAM_SENDERS", "4")),
+  "max_retries": int(os.getenv("TELEGRAM_RETRIES", "5"))
+}
 
 AI_CONFIG = {
   "system_prompt": os.getenv("AI_SYS_PROMPT"),
@@ -35,8 +71,8 @@ AI_CONFIG = {
   "model": os.getenv("AI_MODEL"),
   "temperature": float(os.getenv("AI_TEMP")),
   "num_ctx": int(os.getenv("AI_CTX")),
-  "stream": to_bool(os.getenv("AI_STREAM")),
-  "show_stats": to_bool(os.getenv("AI_STATS")),
+  "stream": to_bool("AI_STREAM"),
+  "show_stats": to_bool("AI_STATS"),
   "context_keep": int(os.getenv("AI_CONTEXT_KEEP")),
   "context_max": int(os.getenv("AI_CONTEXT_MAX")),
   "max_iter": int(os.getenv("AI_MAX_TOOL_ITER"))
@@ -48,73 +84,386 @@ CT_CONFIG = {
   "model": os.getenv("CT_MODEL"),
   "temperature": float(os.getenv("CT_TEMP")),
   "num_ctx": int(os.getenv("CT_CTX")),
-  "stream": to_bool(os.getenv("CT_STREAM"))
+  "stream": to_bool("CT_STREAM")
+}
+
+OLLAMA_CONFIG = {
+  "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+  "warm_interval": int(os.getenv("OLLAMA_WARM_INTERVAL", "300")),
+  "max_connections": int(os.getenv("OLLAMA_POOL_SIZE", "16")),
+  # AI_ENDPOINT/CT_ENDPOINT take a comma separated list of hosts, requests go to the least loaded one
+  "retries": int(os.getenv("OLLAMA_RETRIES", "2")),
+  "cooldown": float(os.getenv("OLLAMA_COOLDOWN", "15")),
+  "affinity": to_bool("OLLAMA_AFFINITY") if os.getenv("OLLAMA_AFFINITY") else True
+}
+
+TOOL_CONFIG = {
+  "timeout": float(os.getenv("TOOL_TIMEOUT", "60")),
+  "concurrency": int(os.getenv("TOOL_CONCURRENCY", "8"))
+}
+
+TOOLS_CONFIG = {
+  # comma separated tool names, an empty TOOLS_ENABLED means all of them
+  "enabled": [name.strip() for name in os.getenv("TOOLS_ENABLED", "").split(",") if name.strip()],
+  "disabled": [name.strip() for name in os.getenv("TOOLS_DISABLED", "").split(",") if name.strip()]
+}
+
+TOOL_CACHE_CONFIG = {
+  # TOOL_CACHE_TTLS="get_series_details=3600,browse_website=0" overrides the defaults, 0 disables caching
+  "policies": {name: {"ttl": int(ttl), "casefold": name != "browse_website"}
+               for name, ttl in (item.split("=") for item in os.getenv("TOOL_CACHE_TTLS", "").split(",") if item)},
+  "max_entries": int(os.getenv("TOOL_CACHE_ENTRIES", "1000")),
+  "max_bytes": int(os.getenv("TOOL_CACHE_MB", "16"))*1024*1024,
+  "path": os.getenv("TOOL_CACHE_FILE", "data/tool_cache.json")
+}
+
+FILES_CONFIG = {
+  # drafts, plots and data can be listed, read and searched, writes only go to drafts.
+  # The bot's own state kept in data (histories, memory, caches) is hidden, see state_files()
+  "read_bytes": int(os.getenv("FILES_READ_BYTES", "4000")),
+  "max_read_bytes": int(os.getenv("FILES_MAX_READ_BYTES", "16000")),
+  "max_matches": int(os.getenv("FILES_MAX_MATCHES", "50")),
+  "max_file_bytes": int(os.getenv("FILES_MAX_MB", "8"))*1024*1024
+}
+
+COMPACT_CONFIG = {
+  "max_chars": int(os.getenv("TOOL_OUTPUT_CHARS", "4000")),
+  "keep_turns": int(os.getenv("TOOL_KEEP_TURNS", "2")),
+  "tool_max_chars": {"browse_website": int(os.getenv("WEB_PAGE_TOKENS", "1500"))*4+500,
+                     "read_file": FILES_CONFIG["max_read_bytes"]+200}
+}
+
+DB_POOL_CONFIG = {
+  "minconn": int(os.getenv("DB_POOL_MIN", "1")),
+  "maxconn": int(os.getenv("DB_POOL_MAX", "5")),
+  "statement_timeout_ms": int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000")),
+  "pool_wait": float(os.getenv("DB_POOL_WAIT", "10")),
+  "create_indexes": to_bool("DB_CREATE_INDEXES"),
+  "top_n": int(os.getenv("SERIES_TOP_N", "3"))
+}
+
+HTTP_POOL_CONFIG = {
+  "max_connections": int(os.getenv("HTTP_POOL_SIZE", "20")),
+  "max_keepalive": int(os.getenv("HTTP_KEEPALIVE", "10")),
+  "keepalive_expiry": float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+  "retries": int(os.getenv("HTTP_RETRIES", "2")),
+  "backoff": float(os.getenv("HTTP_BACKOFF", "0.5"))
+}
+
+WEATHER_CONFIG = {
+  "api_key": os.getenv("WEATHER_API_KEY"),
+  "geocode_file": os.getenv("WEATHER_GEOCODE_FILE", "data/geocode.json")
+}
+
+WEB_FETCH_CONFIG = {
+  "connect_timeout": float(os.getenv("WEB_CONNECT_TIMEOUT", "5")),
+  "read_timeout": float(os.getenv("WEB_READ_TIMEOUT", "15")),
+  "max_bytes": int(os.getenv("WEB_MAX_KB", "2048"))*1024,
+  "page_chars": int(os.getenv("WEB_PAGE_TOKENS", "1500"))*4
+}
+
+BUDGET_CONFIG = {
+  "target": float(os.getenv("AI_CTX_TARGET", "0.75")),
+  "reply_reserve": int(os.getenv("AI_REPLY_RESERVE", "1024")),
+  "keep_recent": AI_CONFIG["context_keep"],
+  "tool_trim_chars": int(os.getenv("AI_TOOL_TRIM_CHARS", "1500")),
+  # num_ctx buckets below AI_CTX, by default a quarter and a half of it (min 2048)
+  "ctx_buckets": [int(size) for size in os.getenv("AI_CTX_BUCKETS", "").split(",") if size] or
+                 sorted({max(2048, AI_CONFIG["num_ctx"]//4), max(2048, AI_CONFIG["num_ctx"]//2)})
+}
+
+SUMMARY_CONFIG = {
+  "idle_after": int(os.getenv("SUMMARY_IDLE_SECS", "300")),
+  "threshold": int(os.getenv("SUMMARY_THRESHOLD", "60")),
+  "keep_recent": AI_CONFIG["context_keep"],
+  "min_messages": int(os.getenv("SUMMARY_MIN_MESSAGES", "8")),
+  "concurrency": int(os.getenv("SUMMARY_CONCURRENCY", "1"))
+}
+
+STORE_CONFIG = {
+  "engine": os.getenv("CONTEXT_STORE", "journal"),
+  "folder": os.getenv("CONTEXT_FOLDER", "data")
 }
 
+MEMORY_CONFIG = {
+  # MEMORY_MODEL is an Ollama embedding model (e.g. nomic-embed-text), unset sends the whole history every turn
+  "endpoint": os.getenv("MEMORY_ENDPOINT") or AI_CONFIG["endpoint"],
+  "model": os.getenv("MEMORY_MODEL"),
+  "folder": os.getenv("MEMORY_FOLDER", os.path.join(STORE_CONFIG["folder"], "memory")),
+  "top_k": int(os.getenv("MEMORY_TOP_K", "4")),
+  "min_score": float(os.getenv("MEMORY_MIN_SCORE", "0.3")),
+  "recent": int(os.getenv("MEMORY_RECENT", str(AI_CONFIG["context_keep"])))
+}
+
+CACHE_CONFIG = {
+  "enabled": to_bool("CONTEXT_CACHE") if os.getenv("CONTEXT_CACHE") else True,
+  "max_chats": int(os.getenv("CONTEXT_CACHE_CHATS", "256")),
+  "max_bytes": int(os.getenv("CONTEXT_CACHE_MB", "64"))*1024*1024,
+  "idle_ttl": int(os.getenv("CONTEXT_CACHE_TTL", "1800")),
+  "flush_interval": float(os.getenv("CONTEXT_FLUSH_INTERVAL", "5"))
+}
+
+INGEST_CONFIG = {
+  "path": os.getenv("UPDATES_DB", "data/updates.db"),
+  "window": int(os.getenv("UPDATES_WINDOW", "10000")),
+  "mode": os.getenv("TELEGRAM_MODE", "webhook"), # "polling" uses getUpdates, no public webhook needed
+  "poll_timeout": int(os.getenv("TELEGRAM_POLL_TIMEOUT", "30"))
+}
+
+def state_files():
+  """Globs of the files the bot keeps for itself, other chats' messages must not reach the file tools"""
+  folder = os.path.relpath(STORE_CONFIG["folder"])
+  patterns = [os.path.join(folder, f"{sign}[0-9]*{ext}") for sign in ("", "-") for ext in (".json", ".json.tmp", ".jsonl", ".jsonl.tmp")]
+  patterns += [os.path.join(folder, "context.db*"), os.path.join(os.path.relpath(MEMORY_CONFIG["folder"]), "*")]
+  for path in (TOOL_CACHE_CONFIG["path"], INGEST_CONFIG["path"], WEATHER_CONFIG["geocode_file"]):
+    if path: #worker_path() copies too: data/updates-2.db
+      root, ext = os.path.splitext(os.path.relpath(path))
+      patterns.append(f"{root}*{ext}*")
+  return patterns
+
+FILES_CONFIG["hidden"] = state_files()
+
+CLUSTER_CONFIG = {
+  # CLUSTER_SELF is the url the other nodes reach this one at, unset runs a single node.
+  # Chats are spread over CLUSTER_NODES, their histories need a shared CONTEXT_STORE
+  "self": os.getenv("CLUSTER_SELF"),
+  "nodes": [url.strip() for url in os.getenv("CLUSTER_NODES", "").split(",") if url.strip()],
+  "secret": os.getenv("CLUSTER_SECRET") or TELEGRAM_BOT_TOKEN,
+  "ping_interval": float(os.getenv("CLUSTER_PING_INTERVAL", "5"))
+}
+# CLUSTER_WORKERS > 1 runs that many nodes on this machine, on UVICORN_PORT and the next ports
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+
+SCHED_CONFIG = {
+  "workers": int(os.getenv("SCHED_WORKERS", "4")),
+  "chat_queue_max": int(os.getenv("SCHED_CHAT_QUEUE_MAX", "5")),
+  "total_queue_max": int(os.getenv("SCHED_TOTAL_QUEUE_MAX", "100"))
+}
 
-def process_message(message: dict):
-    """Message processing with logging"""
+async def process_message(chat_id: int, message: dict, on_done=None):
+    """Message processing with logging, runs on a scheduler worker. True when a reply took on_done"""
     logger.info("Starting message processing")
     try:
-        logger.debug(f"Raw message data: {message}")
+        logger.debug("Raw message data: %s", truncated(message))
 
         if "message" in message:
             user_request = message["message"].get("text")
-            chat_id = message["message"]["chat"].get("id")
 
             if user_request=="/start":
-                send_telegram_reply(chat_id, f"Welcome!")
+                send_telegram_reply(chat_id, f"Welcome!", on_done)
+                return True
             elif user_request=="/wipe":
-                os.remove(f"data/{chat_id}.json")
+                summarizer.forget(chat_id)
+                memory.forget(chat_id)
+                await asyncio.to_thread(delete_context, chat_id)
             else:
                 if user_request and chat_id and chat_id in ALLOWED_CHAT_IDS:
-                    logger.info(f"Message from {chat_id}: {user_request}")
-                    llm_response = interact_with_ai(user_request, chat_id, AI_CONFIG, CT_CONFIG)
-                    send_telegram_reply(chat_id, f"{llm_response}")
+                    logger.info("Message from %s: %s", chat_id, truncated(user_request))
+                    if AI_CONFIG["stream"]:
+                        reply_stream = TelegramReplyStream(outbox, chat_id, TELEGRAM_EDIT_INTERVAL)
+                        llm_response = await interact_with_ai(user_request, chat_id, AI_CONFIG, CT_CONFIG, reply_stream.update)
+                        await reply_stream.finish(f"{llm_response}", on_done)
+                    else:
+                        llm_response = await interact_with_ai(user_request, chat_id, AI_CONFIG, CT_CONFIG)
+                        send_telegram_reply(chat_id, f"{llm_response}", on_done)
+                    return True
                 else:
-                    logger.warning(f"Received message from {chat_id}: {message} [NOT ALLOWED USER]")
-                    send_telegram_reply(chat_id, f"You're NOT allowed to use this bot")
+                    logger.warning("Received message from %s: %s [NOT ALLOWED USER]", chat_id, truncated(message))
+                    send_telegram_reply(chat_id, f"You're NOT allowed to use this bot", on_done)
+                    return True
 
     except Exception as e:
+        metrics.inc("bot_errors_total", stage="turn")
         logger.error(f"Error processing message: {e}")
+    return False
 
-def send_telegram_reply(chat_id: int, text: str):
-    """Send message with error handling and logging"""
-    try:
-        escaped_text = escape_telegram_markdown(text)
+def send_telegram_reply(chat_id: int, text: str, on_done=None):
+    """Queues a reply for delivery, splitting and retries happen in the outbox"""
+    if outbox.send(chat_id, text, on_done):
+        logger.info(f"Message queued for {chat_id}")
 
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json={"chat_id": chat_id, "text": escaped_text, "parse_mode": "Markdown"},
-            timeout=5
-        )
-        #logger.info(response.__dict__)
-        response.raise_for_status()
-        logger.info(f"Message sent to {chat_id}")
+async def handle_update(chat_id: int, job: tuple):
+    """Scheduler handler: one traced turn per update, marked done once its reply went out"""
+    update, received = job
+    trace = new_trace()
+    metrics.observe("bot_stage_seconds", time.monotonic()-received, stage="queue")
+    logger.info(f"Trace {trace} for update {update.get('update_id')} of {chat_id}")
+    if not cluster.holds(chat_id): #waits until no other node still runs turns of this chat, without holding a worker
+        await scheduler.suspend(cluster.handoff(chat_id, update.get("update_id")))
 
-    except Exception as e:
-        logger.error(f"Failed to send message: {e}")
-        logger.error(f"Content: {text}")
+    async def done(delivered):
+        #the history is on disk before the update counts as handled, a restart doesn't lose the turn
+        await asyncio.to_thread(flush_context, chat_id)
+        await ingestor.finish(update)
+
+    with metrics.stage("turn"):
+        replied = await process_message(chat_id, update, done)
+    if not replied:
+        await done(False)
+
+def send_busy_reply(chat_id: int):
+    send_telegram_reply(chat_id, "I'm busy right now, please try again in a moment")
+
+async def rebalance(ring):
+    """Nodes joined or left: hand over the chats that moved, split the Telegram rate again"""
+    released = await asyncio.to_thread(release_contexts, cluster.owns)
+    for chat_id in summarizer.chats():
+        if not cluster.owns(chat_id):
+            summarizer.forget(chat_id)
+    memory.release(cluster.owns)
+    outbox.share(len(ring.nodes))
+    logger.info(f"🕸️ {len(released)} cached chats handed over, {len(ring.nodes)} nodes share the Telegram rate")
+
+async def drop_chat(chat_id: int):
+    """Writes out and forgets one chat, another node takes it or ran turns of it meanwhile"""
+    await asyncio.to_thread(release_context, chat_id)
+    summarizer.forget(chat_id)
+    memory.release(lambda key: key != chat_id)
+
+scheduler = ChatScheduler(handle_update, **SCHED_CONFIG)
+context_cache = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global context_cache
+    context_cache = configure_store(STORE_CONFIG, CACHE_CONFIG)
+    configure_budget(BUDGET_CONFIG)
+    configure_tool_runner(TOOL_CONFIG)
+    configure_tools(TOOLS_CONFIG)
+    configure_tool_cache(TOOL_CACHE_CONFIG)
+    configure_compactor(COMPACT_CONFIG)
+    configure_db(DB_POOL_CONFIG)
+    configure_http(HTTP_POOL_CONFIG)
+    configure_outbox(TELEGRAM_CONFIG)
+    web.configure_web(dict(WEB_FETCH_CONFIG))
+    configure_weather(WEATHER_CONFIG)
+    configure_files(FILES_CONFIG)
+    if TOOL_CACHE_CONFIG["path"]:
+        tool_cache.load(TOOL_CACHE_CONFIG["path"])
+    configure_summarizer(SUMMARY_CONFIG)
+    configure_memory(MEMORY_CONFIG)
+    if context_cache:
+        flusher = asyncio.create_task(context_cache.run_flusher(CACHE_CONFIG["flush_interval"]))
+    configure_ollama(OLLAMA_CONFIG)
+    warm_up = asyncio.create_task(ollama_clients.warm_up([{**AI_CONFIG, "num_ctx": min(BUDGET_CONFIG["ctx_buckets"]+[AI_CONFIG["num_ctx"]])}, CT_CONFIG])) #runs next to the first requests, doesn't delay startup
+    keep_warm = asyncio.create_task(ollama_clients.keep_warm())
+    configure_cluster(CLUSTER_CONFIG)
+    cluster.on_rebalance = rebalance
+    cluster.on_handoff = drop_chat
+    outbox.share(len(cluster.members) or 1)
+    await outbox.start()
+    await scheduler.start()
+    await cluster.start(scheduler.busy)
+    configure_ingest(INGEST_CONFIG)
+    await ingestor.start(scheduler, send_busy_reply, outbox.url, cluster.forward if cluster.enabled else None)
+    yield
+    await cluster.stop() #peers stop forwarding here before the queue is dropped
+    await scheduler.stop()
+    await outbox.stop() #replies that go out mark their updates done, so before the ledger closes
+    await ingestor.stop() #updates left in the queue stay pending, the next start resumes them
+    warm_up.cancel()
+    keep_warm.cancel()
+    await ollama_clients.close()
+    await summarizer.stop()
+    await memory.stop()
+    series_db.close()
+    await http_clients.close()
+    if TOOL_CACHE_CONFIG["path"]:
+        tool_cache.save(TOOL_CACHE_CONFIG["path"])
+    if context_cache:
+        flusher.cancel()
+        await asyncio.to_thread(context_cache.flush)
+        logger.info(f"Context cache flushed: {context_cache.stats()}")
+
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/aibot")
-async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
+async def telegram_webhook(request: Request):
     """Webhook endpoint with access logging"""
     client_ip = request.client.host
     logger.info(f"Incoming request from IP: {client_ip}")
 
     data = await request.json()
-    background_tasks.add_task(process_message, data)
+    return {"status": await ingestor.ingest(data)}
 
-    return {"status": "received"}
+def check_cluster_secret(request: Request):
+    if not cluster.allowed(request.headers.get("X-Cluster-Secret")):
+        raise HTTPException(status_code=403)
+
+@app.post("/cluster/update")
+async def cluster_update(request: Request):
+    """Update forwarded by the node that received it, the chat belongs to this node"""
+    check_cluster_secret(request)
+    return {"status": await ingestor.ingest(await request.json(), local=True)}
+
+@app.post("/cluster/join")
+async def cluster_join(request: Request):
+    check_cluster_secret(request)
+    await cluster.join((await request.json())["url"])
+    return {"status": "ok"}
+
+@app.post("/cluster/leave")
+async def cluster_leave(request: Request):
+    check_cluster_secret(request)
+    await cluster.leave((await request.json())["url"])
+    return {"status": "ok"}
+
+@app.post("/cluster/release")
+async def cluster_release(request: Request):
+    """Another node takes a chat over: busy while its turns still run here, otherwise written out and dropped"""
+    check_cluster_secret(request)
+    body = await request.json()
+    chat_id = body["chat_id"]
+    if cluster.release(chat_id, body.get("update_id")):
+        return {"busy": True}
+    await drop_chat(chat_id)
+    return {"busy": False}
+
+@app.get("/cluster/ping")
+async def cluster_ping(request: Request):
+    check_cluster_secret(request)
+    return {"status": "ok"}
 
 @app.get("/status")
-async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
+async def healthcheck(request: Request):
     """Webhook healthcheck with access logging"""
     client_ip = request.client.host
     logger.info(f"Incoming request from IP: {client_ip}")
 
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "scheduler": scheduler.stats(),
+        "context_cache": context_cache.stats() if context_cache else None,
+        "summarizer": summarizer.stats(),
+        "memory": memory.stats(),
+        "tool_cache": tool_cache.stats(),
+        "tool_output": compactor.stats(),
+        "tools": tool_registry.names(),
+        "http": http_clients.stats(),
+        "weather": weather.stats(),
+        "files": files.stats(),
+        "updates": ingestor.stats(),
+        "cluster": cluster.stats(),
+        "logs": logs.stats(),
+        "outbox": outbox.stats(),
+        "ollama": ollama_clients.stats(),
+        "router": router.stats(),
+        "num_ctx": budget.bucket_counts
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Prometheus text format, latency per stage, tokens, context usage and errors"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+metrics.gauge_callback("bot_queue_pending", "Jobs waiting in the chat scheduler", lambda: scheduler.stats()["pending"])
+metrics.gauge_callback("bot_outbox_pending", "Replies waiting to be sent", lambda: outbox.stats()["pending"])
+metrics.gauge_callback("bot_backend_inflight", "Model requests running per backend",
+                       lambda: [({"backend": endpoint}, state["inflight"]) for endpoint, state in router.stats().items()])
 
 if __name__ == "__main__":
     print(f"Allowed chat IDS: {ALLOWED_CHAT_IDS}")
-    uvicorn.run(app, host="0.0.0.0", port=int(UVICORN_PORT))
+    if CLUSTER_WORKERS > 1:
+        run_workers(os.path.abspath(__file__), CLUSTER_WORKERS, int(UVICORN_PORT), os.getenv("CLUSTER_HOST", "127.0.0.1"))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=int(UVICORN_PORT))
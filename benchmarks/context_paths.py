@@ -0,0 +1,56 @@
+"""
+Microbenchmark of compress_context on history slices of growing size against a fake
+Ollama that answers instantly, so what is left is rendering the transcript, building the
+request and the HTTP round trip. Loading and saving histories, with and without the
+context cache, is measured by benchmarks.context_store.
+
+    python -m benchmarks.context_paths --slices 20,200,1000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeOllama
+from benchmarks.context_store import fake_message
+from llm.context import render_transcript, compress_context
+
+async def bench_compress(slices, size, repeat):
+    ollama = FakeOllama(load=0, prompt_rate=1e9, gen_rate=1e9).start()
+    config = {"system_prompt": "Summarize", "endpoint": ollama.url, "model": "bench-summary",
+              "temperature": 0.2, "num_ctx": 8192, "stream": False}
+    results = []
+    try:
+        for count in slices:
+            messages = [fake_message(i, size) for i in range(count)]
+            render_times, compress_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                render_transcript(messages)
+                render_times.append(time.perf_counter()-start)
+                start = time.perf_counter()
+                await compress_context(messages, "earlier summary " * 50, config)
+                compress_times.append(time.perf_counter()-start)
+            results.append({"messages": count, "render_ms": statistics.median(render_times)*1000,
+                            "compress_ms": statistics.median(compress_times)*1000})
+    finally:
+        ollama.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=400, help="approximate characters per message")
+    parser.add_argument("--slices", default="20,100,400", help="history sizes handed to compress_context")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'messages':<16}{'render':>12}{'compress':>12}")
+    slices = [int(count) for count in args.slices.split(",")]
+    for r in asyncio.run(bench_compress(slices, args.size, args.repeat)):
+        print(f"{r['messages']:<16}{r['render_ms']:>10.3f}ms{r['compress_ms']:>10.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Context store microbenchmark: legacy JSON files vs append-only journal vs SQLite WAL.
+
+Replays a chat of --messages messages turn by turn (user, assistant, 2 messages per turn)
+and measures the cost of save_context at the end of each turn and of load_context on the
+resulting history.
+
+The same chat again through the ContextCache the bot puts in front of the store: every
+turn gets the history and puts it back, saves are write-behind and the flush column is
+the cost of writing them out at the end.
+
+--check runs no benchmark: it breaks and races the journal and sqlite stores on purpose
+(torn last line, rewritten history, a second writer, legacy JSON files) and asserts what
+a fresh store reads back.
+
+    python -m benchmarks.context_store --messages 5000
+    python -m benchmarks.context_store --check
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm.storage import make_store, JsonStore, JournalStore, SqliteStore, StaleHistoryError
+from llm.cache import ContextCache
+
+def fake_message(i, size):
+    role = "user" if i % 2 else "assistant"
+    return {"role": role, "content": f"message {i} " + "lorem ipsum dolor sit amet " * (size//27)}
+
+def bench_engine(engine, total, size, tail):
+    folder = tempfile.mkdtemp(prefix=f"bench_{engine}_")
+    try:
+        store = make_store(engine, folder)
+        key = "bench"
+        messages = [{"role": "system", "content": "you are a benchmark"}]
+        save_times = []
+
+        while len(messages) < total:
+            messages += [fake_message(len(messages), size), fake_message(len(messages)+1, size)]
+            start = time.perf_counter()
+            store.save(key, messages)
+            save_times.append(time.perf_counter()-start)
+
+        load_times = []
+        for _ in range(5):
+            fresh = make_store(engine, folder) #no in-process state, like a restart
+            start = time.perf_counter()
+            loaded = fresh.load(key)
+            load_times.append(time.perf_counter()-start)
+        assert loaded == messages, f"{engine} returned a different history"
+
+        return {
+            "engine": engine,
+            "save_mean_ms": statistics.mean(save_times)*1000,
+            "save_last_ms": statistics.mean(save_times[-tail:])*1000,
+            "load_ms": statistics.median(load_times)*1000,
+            "disk_kb": sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))/1024
+        }
+    finally:
+        shutil.rmtree(folder)
+
+def bench_cached(engine, total, size, tail):
+    folder = tempfile.mkdtemp(prefix=f"bench_{engine}_cache_")
+    try:
+        cache = ContextCache(make_store(engine, folder), max_chats=256, max_bytes=64*1024*1024, idle_ttl=1800)
+        key = "bench"
+        get_times, put_times = [], []
+        while True:
+            start = time.perf_counter()
+            messages = cache.get(key) or [{"role": "system", "content": "you are a benchmark"}]
+            get_times.append(time.perf_counter()-start)
+            if len(messages) >= total:
+                break
+            messages = messages + [fake_message(len(messages), size), fake_message(len(messages)+1, size)]
+            start = time.perf_counter()
+            cache.put(key, messages)
+            put_times.append(time.perf_counter()-start)
+
+        start = time.perf_counter()
+        cache.flush()
+        flush = time.perf_counter()-start
+        assert make_store(engine, folder).load(key) == messages, f"{engine}+cache flushed a different history"
+
+        return {
+            "engine": f"{engine}+cache",
+            "save_mean_ms": statistics.mean(put_times)*1000,
+            "save_last_ms": statistics.mean(put_times[-tail:])*1000,
+            "load_ms": statistics.mean(get_times)*1000,
+            "flush_ms": flush*1000
+        }
+    finally:
+        shutil.rmtree(folder)
+
+def history(count, size=100):
+    return [{"role": "system", "content": "you are a check"}] + [fake_message(i, size) for i in range(1, count)]
+
+def check_torn_tail(folder):
+    store, messages = JournalStore(folder), history(5)
+    store.save("torn", messages)
+    path = store.path("torn")
+    intact = os.path.getsize(path)
+    with open(path, "ab") as f: #crash in the middle of an append
+        f.write(b'{"role": "user", "content": "half wri')
+    assert JournalStore(folder).load("torn") == messages, "torn line not dropped"
+    assert os.path.getsize(path) == intact, "torn line not truncated"
+
+    with open(path, "ab") as f: #a complete but broken line, the ones after it go too
+        f.write(b"not json\n" + _line(fake_message(9, 100)))
+    assert JournalStore(folder).load("torn") == messages, "broken line not dropped"
+    assert os.path.getsize(path) == intact, "broken line not truncated"
+
+    store = JournalStore(folder)
+    store.load("torn")
+    store.save("torn", messages + history(3)[1:])
+    assert JournalStore(folder).load("torn") == messages + history(3)[1:], "append after truncation lost"
+
+def check_compaction(folder):
+    store, messages = JournalStore(folder), history(6)
+    store.save("compact", messages)
+    store.save("compact", messages + history(3)[1:])
+    assert _lines(store.path("compact")) == 8, "append rewrote the journal"
+
+    rewritten = [messages[0], {"role": "system", "content": "summary of the chat"}] + messages[4:]
+    store.save("compact", rewritten)
+    assert _lines(store.path("compact")) == len(rewritten), "rewrite not compacted"
+    assert not os.path.exists(f"{store.path('compact')}.tmp"), "compaction left its temp file"
+    assert JournalStore(folder).load("compact") == rewritten, "compacted history differs"
+
+    middle = [dict(msg) for msg in rewritten] #same length, a tool output collapsed in the middle
+    middle[2]["content"] = "[collapsed]"
+    store.save("compact", middle)
+    assert JournalStore(folder).load("compact") == middle, "rewrite in the middle not compacted"
+
+def check_stale_journal(folder):
+    mine, other, messages = JournalStore(folder), JournalStore(folder), history(4)
+    mine.save("stale", messages)
+    theirs = other.load("stale") + [fake_message(10, 100)]
+    other.save("stale", theirs) #appended, same inode but another size
+    _expect_stale(mine, "stale", messages + [fake_message(11, 100)])
+    assert JournalStore(folder).load("stale") == theirs, "stale append reached the journal"
+
+    mine.load("stale")
+    other.load("stale")
+    other.save("stale", theirs[:2] + [fake_message(12, 100)]) #compacted, new inode
+    _expect_stale(mine, "stale", theirs + [fake_message(13, 100)])
+    assert JournalStore(folder).load("stale") == theirs[:2] + [fake_message(12, 100)], "stale save reached the journal"
+
+    latest = mine.load("stale") + [fake_message(14, 100)] #reloaded, the next save goes through
+    mine.save("stale", latest)
+    assert JournalStore(folder).load("stale") == latest, "save after reload lost"
+
+def check_stale_sqlite(folder):
+    path = os.path.join(folder, "context.db")
+    mine, other, messages = SqliteStore(path), SqliteStore(path), history(4)
+    mine.save("stale", messages)
+    theirs = other.load("stale") + [fake_message(10, 100)]
+    other.save("stale", theirs)
+    _expect_stale(mine, "stale", messages + [fake_message(11, 100)])
+    assert SqliteStore(path).load("stale") == theirs, "stale save reached the database"
+
+    latest = mine.load("stale") + [fake_message(12, 100)]
+    mine.save("stale", latest)
+    assert SqliteStore(path).load("stale") == latest, "save after reload lost"
+
+def check_migration(folder):
+    messages = history(5)
+    JsonStore(folder).save("legacy", messages)
+    store = JournalStore(folder)
+    assert store.load("legacy") == messages, "legacy history not loaded"
+    assert not os.path.exists(os.path.join(folder, "legacy.json")), "legacy file left behind"
+    assert _lines(store.path("legacy")) == len(messages), "legacy history not written to the journal"
+    store.save("legacy", messages + history(3)[1:])
+    assert JournalStore(folder).load("legacy") == messages + history(3)[1:], "append after migration lost"
+
+def _line(msg):
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode()
+
+def _lines(path):
+    with open(path, "rb") as f:
+        return f.read().count(b"\n")
+
+def _expect_stale(store, key, messages):
+    try:
+        store.save(key, messages)
+    except StaleHistoryError:
+        return
+    raise AssertionError(f"{type(store).__name__} overwrote a history another writer changed")
+
+CHECKS = [check_torn_tail, check_compaction, check_stale_journal, check_stale_sqlite, check_migration]
+
+def run_checks():
+    for check in CHECKS:
+        folder = tempfile.mkdtemp(prefix="check_store_")
+        try:
+            check(folder)
+        finally:
+            shutil.rmtree(folder)
+        print(f"{check.__name__[6:]:<16}ok")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000, help="history length at the end of the run")
+    parser.add_argument("--size", type=int, default=400, help="approximate characters per message")
+    parser.add_argument("--tail", type=int, default=50, help="turns averaged for the save_last column")
+    parser.add_argument("--engines", default="json,journal,sqlite")
+    parser.add_argument("--check", action="store_true", help="only check what the stores reload after crashes and races")
+    args = parser.parse_args()
+
+    if args.check:
+        return run_checks()
+
+    print(f"{'engine':<10}{'save mean':>12}{'save last':>12}{'load':>12}{'disk':>12}")
+    for engine in args.engines.split(","):
+        r = bench_engine(engine, args.messages, args.size, args.tail)
+        print(f"{r['engine']:<10}{r['save_mean_ms']:>10.2f}ms{r['save_last_ms']:>10.2f}ms{r['load_ms']:>10.2f}ms{r['disk_kb']:>10.0f}KB")
+
+    print(f"\n{'engine':<16}{'save mean':>12}{'save last':>12}{'load':>12}{'flush':>12}")
+    for engine in args.engines.split(","):
+        r = bench_cached(engine, args.messages, args.size, args.tail)
+        print(f"{r['engine']:<16}{r['save_mean_ms']:>10.3f}ms{r['save_last_ms']:>10.3f}ms{r['load_ms']:>10.3f}ms{r['flush_ms']:>10.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Local stand-ins for Ollama and the Telegram Bot API, for load tests without a GPU or a bot.
+
+FakeOllama answers /api/chat (streamed or not), /api/generate and /api/embed like a real
+server would: a one-time model load, prompt evaluation and generation times derived from token
+counts and rates, a fixed number of parallel slots, and optional scripted tool calls.
+The reply repeats the "#<n>" marker of the last user message, so a reply can be matched
+to the update that asked for it. Embeddings are hashed bags of words, texts sharing words
+come out similar. FakeTelegram records every Bot API call with its
+arrival time and can answer some of them with 429 flood errors.
+
+Both run on a background thread. They can also be started on their own to point a
+manually run bot at them:
+
+    python -m benchmarks.fakes --ollama-port 11434 --telegram-port 8081
+"""
+import re
+import json
+import math
+import time
+import zlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MARKER = re.compile(r"#(\d+)")
+
+def find_marker(text):
+    found = MARKER.search(text or "")
+    return int(found.group(1)) if found else None
+
+def embed_text(text, dims=64):
+    vector = [0.0]*dims
+    for word in re.findall(r"\w+", (text or "").lower()):
+        vector[zlib.crc32(word.encode()) % dims] += 1
+    norm = math.sqrt(sum(value*value for value in vector)) or 1
+    return [value/norm for value in vector]
+
+def estimate_tokens(messages):
+    return max(1, sum(len(json.dumps(msg, ensure_ascii=False)) for msg in messages)//4)
+
+class FakeServer:
+    """Threaded HTTP server running handle(handler, path, body) of the subclass"""
+
+    def __init__(self, port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                fake.handle(self, self.path, body)
+
+            def do_GET(self):
+                fake.handle(self, self.path, {})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def reply(handler, status, payload):
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+class FakeOllama(FakeServer):
+    """
+    load: seconds to load a model the first time it is asked for
+    prompt_rate, gen_rate: tokens per second of prompt evaluation and generation
+    reply_tokens: length of every answer
+    parallel: requests served at once, like OLLAMA_NUM_PARALLEL, the rest wait
+    tool_every: every n-th user message is first answered with a call to tool(**tool_args)
+    """
+
+    def __init__(self, port=0, load=2.0, prompt_rate=2000, gen_rate=200, reply_tokens=40, parallel=4,
+                 tool_every=0, tool="get_current_time", tool_args=None, chunk_tokens=8):
+        super().__init__(port)
+        self.load = load
+        self.prompt_rate = prompt_rate
+        self.gen_rate = gen_rate
+        self.reply_tokens = reply_tokens
+        self.tool_every = tool_every
+        self.tool = tool
+        self.tool_args = tool_args or {}
+        self.chunk_tokens = chunk_tokens
+        self.slots = threading.BoundedSemaphore(parallel)
+        self.lock = threading.Lock()
+        self.loaded = set()
+        self.counters = {"chat": 0, "generate": 0, "embed": 0, "tool_calls": 0, "prompt_tokens": 0, "gen_tokens": 0, "waited": 0.0}
+
+    def _load_time(self, model):
+        with self.lock:
+            if model in self.loaded:
+                return 0
+            self.loaded.add(model)
+        return self.load
+
+    def _stats(self, model, load, prompt_tokens, gen_tokens):
+        ns = 1000000000
+        prompt_secs = prompt_tokens/self.prompt_rate
+        gen_secs = gen_tokens/self.gen_rate
+        return {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": True, "done_reason": "stop",
+                "load_duration": int(load*ns), "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prompt_secs*ns),
+                "eval_count": gen_tokens, "eval_duration": int(gen_secs*ns), "total_duration": int((load+prompt_secs+gen_secs)*ns)}
+
+    def _answer(self, messages):
+        """(content, tool_calls) for the next assistant message"""
+        users = [msg for msg in messages if msg.get("role") == "user"]
+        marker = find_marker(users[-1].get("content")) if users else None
+        tag = f"#{marker} " if marker is not None else ""
+        if messages and messages[-1].get("role") == "user" and self.tool_every and len(users) % self.tool_every == 0:
+            with self.lock:
+                self.counters["tool_calls"] += 1
+            return "", [{"function": {"name": self.tool, "arguments": self.tool_args}}]
+        words = [f"word{i}" for i in range(self.reply_tokens-1)]
+        return tag + " ".join(words), None
+
+    def handle(self, handler, path, body):
+        model = body.get("model", "")
+        if path == "/api/generate": #warm-up and keep-alive loads
+            load = self._load_time(model)
+            time.sleep(load)
+            with self.lock:
+                self.counters["generate"] += 1
+            return self.reply(handler, 200, {**self._stats(model, load, 0, 0), "response": ""})
+        if path == "/api/embed":
+            inputs = body.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            with self.lock:
+                self.counters["embed"] += 1
+            return self.reply(handler, 200, {"model": model, "embeddings": [embed_text(text) for text in inputs]})
+        if path != "/api/chat":
+            return self.reply(handler, 404, {"error": f"{path} not found"})
+
+        messages = body.get("messages") or []
+        waiting = time.perf_counter()
+        with self.slots:
+            with self.lock:
+                self.counters["waited"] += time.perf_counter()-waiting
+                self.counters["chat"] += 1
+            load = self._load_time(model)
+            prompt_tokens = estimate_tokens(messages)
+            content, tool_calls = self._answer(messages)
+            gen_tokens = len(content.split()) if content else 10
+            with self.lock:
+                self.counters["prompt_tokens"] += prompt_tokens
+                self.counters["gen_tokens"] += gen_tokens
+            time.sleep(load + prompt_tokens/self.prompt_rate)
+
+            message = {"role": "assistant", "content": content}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            if not body.get("stream", True):
+                time.sleep(gen_tokens/self.gen_rate)
+                return self.reply(handler, 200, {**self._stats(model, load, prompt_tokens, gen_tokens), "message": message})
+            self._stream(handler, model, message, load, prompt_tokens, gen_tokens)
+
+    def _stream(self, handler, model, message, load, prompt_tokens, gen_tokens):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(payload):
+            data = (json.dumps(payload)+"\n").encode()
+            handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            handler.wfile.flush()
+
+        created = datetime.now(timezone.utc).isoformat()
+        if message.get("tool_calls"):
+            time.sleep(gen_tokens/self.gen_rate)
+            send({"model": model, "created_at": created, "message": message, "done": False})
+        else:
+            words = message["content"].split(" ")
+            for i in range(0, len(words), self.chunk_tokens):
+                time.sleep(min(self.chunk_tokens, len(words)-i)/self.gen_rate)
+                text = " ".join(words[i:i+self.chunk_tokens]) + ("" if i+self.chunk_tokens >= len(words) else " ")
+                send({"model": model, "created_at": created, "message": {"role": "assistant", "content": text}, "done": False})
+        send({**self._stats(model, load, prompt_tokens, gen_tokens), "message": {"role": "assistant", "content": ""}})
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+class FakeTelegram(FakeServer):
+    """
+    Records Bot API calls as (arrival time, method, chat_id, text).
+    latency: seconds added to every call
+    flood_every: every n-th call is refused with a 429 and retry_after seconds, 0 never
+    """
+
+    def __init__(self, port=0, latency=0.0, flood_every=0, retry_after=1):
+        super().__init__(port)
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = []
+        self.count = 0
+        self.floods = 0
+        self.message_id = 0
+
+    def handle(self, handler, path, body):
+        arrived = time.monotonic()
+        method = path.rsplit("/", 1)[-1]
+        time.sleep(self.latency)
+        with self.lock:
+            self.count += 1
+            if self.flood_every and self.count % self.flood_every == 0:
+                self.floods += 1
+                return self.reply(handler, 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                                 "parameters": {"retry_after": self.retry_after}})
+            self.calls.append((arrived, method, body.get("chat_id"), body.get("text", "")))
+            if method == "sendMessage":
+                self.message_id += 1
+                result = {"message_id": self.message_id, "chat": {"id": body.get("chat_id")}, "text": body.get("text")}
+            elif method == "getUpdates":
+                result = []
+            else:
+                result = True
+
+        if method == "getUpdates": #long poll with nothing to return
+            time.sleep(min(1, body.get("timeout", 0)))
+        self.reply(handler, 200, {"ok": True, "result": result})
+
+    def sent(self, *methods):
+        with self.lock:
+            return [call for call in self.calls if call[1] in methods]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ollama-port", type=int, default=11434)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--load", type=float, default=2.0, help="model load seconds")
+    parser.add_argument("--prompt-rate", type=float, default=2000, help="prompt tokens per second")
+    parser.add_argument("--gen-rate", type=float, default=200, help="generated tokens per second")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--parallel", type=int, default=4, help="requests served at once")
+    parser.add_argument("--tool-every", type=int, default=0, help="every n-th user message triggers a tool call")
+    parser.add_argument("--tool", default="get_current_time")
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--flood-every", type=int, default=0, help="every n-th Telegram call gets a 429")
+    args = parser.parse_args()
+
+    ollama = FakeOllama(args.ollama_port, args.load, args.prompt_rate, args.gen_rate, args.reply_tokens,
+                        args.parallel, args.tool_every, args.tool).start()
+    telegram = FakeTelegram(args.telegram_port, args.telegram_latency, args.flood_every).start()
+    print(f"Ollama on {ollama.url}, Telegram on {telegram.url} (TELEGRAM_API_URL), Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"ollama {ollama.counters}, telegram {len(telegram.calls)} calls, {telegram.floods} floods")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
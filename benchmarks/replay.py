@@ -0,0 +1,323 @@
+"""
+End-to-end load test: runs aibot.py against a fake Ollama and a fake Telegram and replays
+synthetic webhook updates at it.
+
+Every update carries a "#<update_id>" marker that the fake model repeats in its answer,
+so each reply seen by the fake Telegram is matched to the update it answers. The report
+gives throughput, p50/p95/p99 latency to the first reply message and to the finished
+reply (the last edit when streaming), the bot's peak memory, lost replies (accepted
+updates never answered), duplicated replies, and the mean time per stage from /metrics.
+
+    python -m benchmarks.replay --chats 50 --messages 4 --rate 20
+    python -m benchmarks.replay --chats 10 --messages 10 --rate 0 --stream --tool-every 3
+    python -m benchmarks.replay --chats 5 --history 400 --duplicates 0.2 --env CONTEXT_STORE=sqlite
+    python -m benchmarks.replay --chats 40 --rate 0 --parallel 16 --env CLUSTER_WORKERS=4
+
+--rate 0 fires everything at once. The bot runs in a temporary folder with its own data/,
+its log is kept there (--keep to leave the folder behind). With CLUSTER_WORKERS the updates
+go to the first worker, which forwards them to the owner of the chat, and memory is the
+sum of all the workers.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeOllama, FakeTelegram, find_marker
+from llm.storage import make_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "bench"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, max(0, round(p/100*len(values))-1))]
+
+def rss_mb(pid):
+    """Resident memory of a process and its children, Linux only"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))/1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(rss_mb(child) or 0 for child in children)
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.start_mb = rss_mb(pid)
+        self.peak_mb = self.start_mb
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            current = rss_mb(self.pid)
+            if current is not None:
+                self.peak_mb = max(self.peak_mb or 0, current)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def make_updates(args):
+    """(update, is a retry) in sending order, messages of a chat stay in order"""
+    rnd = random.Random(args.seed)
+    chats = [1000+i for i in range(args.chats)]
+    updates = []
+    update_id = 1
+    for turn in range(args.messages):
+        for chat_id in chats:
+            text = f"#{update_id} question {turn} from {chat_id} " + "lorem ipsum " * rnd.randint(1, args.words)
+            update = {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "from": {"id": chat_id, "is_bot": False}, "text": text}}
+            updates.append((update, False))
+            if rnd.random() < args.duplicates: #Telegram retrying a webhook it thinks failed
+                updates.append((update, True))
+            update_id += 1
+    return chats, updates
+
+def prefill_histories(folder, chats, length, engine):
+    store = make_store(engine, folder)
+    for chat_id in chats:
+        messages = [{"role": "system", "content": "you are a benchmark"}]
+        for i in range(length//2):
+            messages.append({"role": "user", "content": f"old question {i} " + "lorem ipsum " * 20})
+            messages.append({"role": "assistant", "content": f"old answer {i} " + "dolor sit amet " * 30})
+        store.save(chat_id, messages)
+
+def bot_env(args, ollama, telegram, chats, port):
+    env = {**os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN, "TELEGRAM_API_URL": telegram.url, "UVICORN_PORT": str(port),
+        "ALLOWED_CHAT_IDS": ",".join(str(chat_id) for chat_id in chats),
+        "AI_SYS_PROMPT": "You are a benchmark", "AI_ENDPOINT": ollama.url, "AI_MODEL": "bench-chat", "AI_TEMP": "0.2",
+        "AI_CTX": "8192", "AI_STREAM": str(args.stream), "AI_STATS": "False", "AI_CONTEXT_KEEP": "10",
+        "AI_CONTEXT_MAX": str(max(60, args.history+2*args.messages+10)), "AI_MAX_TOOL_ITER": "3",
+        "CT_SYS_PROMPT": "Summarize", "CT_ENDPOINT": ollama.url, "CT_MODEL": "bench-summary", "CT_TEMP": "0.2",
+        "CT_CTX": "8192", "CT_STREAM": "False", "TELEGRAM_EDIT_INTERVAL": str(args.edit_interval)}
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+async def wait_ready(url, process, timeout=60):
+    deadline = time.monotonic()+timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"bot exited with code {process.returncode}")
+            try:
+                response = await client.get(f"{url}/status")
+                cluster = response.json().get("cluster") if response.status_code == 200 else {"nodes": {"": False}}
+                if not cluster or all(cluster["nodes"].values()):
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"bot not ready after {timeout}s")
+
+async def replay(url, updates, rate, burst):
+    """Posts the updates, returns (send time and webhook answer of each update_id, answers count)"""
+    sent_at = {}
+    answers = {}
+    statuses = {}
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=100)) as client:
+        async def post(update, retry):
+            if not retry:
+                sent_at[update["update_id"]] = time.monotonic()
+            try:
+                response = await client.post(f"{url}/aibot", json=update)
+                status = response.json().get("status", f"http {response.status_code}")
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            statuses[status] = statuses.get(status, 0)+1
+            if not retry:
+                answers[update["update_id"]] = status
+
+        pending = []
+        for i in range(0, len(updates), burst):
+            pending += [asyncio.create_task(post(update, retry)) for update, retry in updates[i:i+burst]]
+            if rate:
+                await asyncio.sleep(burst/rate)
+        await asyncio.gather(*pending)
+    return sent_at, answers, statuses
+
+def stage_means(text):
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        found = re.match(r'bot_stage_seconds_(sum|count)\{(.*)\} ([0-9.e+-]+)$', line)
+        if not found:
+            continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', found.group(2)))
+        stage = labels["stage"] + (f":{labels['name']}" if "name" in labels else "")
+        (sums if found.group(1) == "sum" else counts)[stage] = float(found.group(3))
+    return {stage: round(sums[stage]/counts[stage]*1000, 1) for stage in sums if counts.get(stage)}
+
+def collect(telegram, sent_at, accepted):
+    first, done, sends = {}, {}, {}
+    for arrived, method, chat_id, text in telegram.sent("sendMessage", "editMessageText"):
+        update_id = find_marker(text)
+        if update_id not in sent_at:
+            continue
+        first.setdefault(update_id, arrived)
+        done[update_id] = max(done.get(update_id, arrived), arrived)
+        if method == "sendMessage":
+            sends[update_id] = sends.get(update_id, 0)+1
+    return {
+        "first": [first[u]-sent_at[u] for u in first],
+        "done": [done[u]-sent_at[u] for u in done],
+        "lost": sorted(u for u in accepted if u not in first),
+        "duplicated": sorted(u for u, count in sends.items() if count > 1),
+        "end": max(done.values()) if done else None
+    }
+
+async def run(args):
+    folder = tempfile.mkdtemp(prefix="aibot_bench_")
+    os.makedirs(os.path.join(folder, "data"))
+    ollama = FakeOllama(load=args.load, prompt_rate=args.prompt_rate, gen_rate=args.gen_rate, reply_tokens=args.reply_tokens,
+                        parallel=args.parallel, tool_every=args.tool_every, tool=args.tool).start()
+    telegram = FakeTelegram(latency=args.telegram_latency, flood_every=args.flood_every).start()
+    chats, updates = make_updates(args)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = bot_env(args, ollama, telegram, chats, port)
+    if args.history:
+        prefill_histories(os.path.join(folder, "data"), chats, args.history, env.get("CONTEXT_STORE", "journal"))
+
+    log_path = os.path.join(folder, "aibot.log")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, "aibot.py")], cwd=folder,
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        try:
+            await wait_ready(url, process)
+        except RuntimeError:
+            with open(log_path) as log:
+                print("".join(log.readlines()[-30:]), file=sys.stderr)
+            raise
+        memory = MemorySampler(process.pid).start()
+        started = time.monotonic()
+        sent_at, answers, statuses = await replay(url, updates, args.rate, args.burst)
+        accepted = {u for u, status in answers.items() if status in ("received", "forwarded")}
+
+        deadline = time.monotonic()+args.timeout
+        while time.monotonic() < deadline and collect(telegram, sent_at, accepted)["lost"]:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.edit_interval+1) #late edits and duplicates
+        async with httpx.AsyncClient() as client:
+            stages = stage_means((await client.get(f"{url}/metrics")).text)
+        memory.stop()
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        ollama.stop()
+        telegram.stop()
+
+    result = collect(telegram, sent_at, accepted)
+    elapsed = (result["end"] or time.monotonic())-started
+    report = {
+        "updates": len(sent_at),
+        "retries": len(updates)-len(sent_at),
+        "webhook": statuses,
+        "replies": len(result["done"]),
+        "throughput": round(len(result["done"])/elapsed, 2) if elapsed > 0 else None,
+        "elapsed": round(elapsed, 2),
+        "latency_first": {f"p{p}": round(percentile(result["first"], p), 3) for p in (50, 95, 99)} if result["first"] else None,
+        "latency_done": {f"p{p}": round(percentile(result["done"], p), 3) for p in (50, 95, 99)} if result["done"] else None,
+        "rss_start_mb": round(memory.start_mb, 1) if memory.start_mb else None,
+        "rss_peak_mb": round(memory.peak_mb, 1) if memory.peak_mb else None,
+        "lost": result["lost"],
+        "duplicated": result["duplicated"],
+        "telegram_calls": len(telegram.calls),
+        "telegram_floods": telegram.floods,
+        "ollama": {k: round(v, 2) for k, v in ollama.counters.items()},
+        "stage_ms": stages
+    }
+    if args.keep:
+        report["folder"] = folder
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+    return report, log_path
+
+def print_report(report):
+    print(f"updates        {report['updates']} (+{report['retries']} retries), webhook {report['webhook']}")
+    print(f"replies        {report['replies']} in {report['elapsed']}s, {report['throughput']} replies/s")
+    for name in ("latency_first", "latency_done"):
+        values = report[name] or {}
+        print(f"{name:<15}" + "  ".join(f"{p} {v:.3f}s" for p, v in values.items()))
+    print(f"memory         {report['rss_start_mb']} MB at start, {report['rss_peak_mb']} MB peak")
+    print(f"lost           {len(report['lost'])} {report['lost'][:10]}")
+    print(f"duplicated     {len(report['duplicated'])} {report['duplicated'][:10]}")
+    print(f"telegram       {report['telegram_calls']} calls, {report['telegram_floods']} floods")
+    print(f"ollama         {report['ollama']}")
+    print("stages (mean ms)")
+    for stage, ms in sorted(report["stage_ms"].items(), key=lambda item: -item[1]):
+        print(f"  {stage:<28}{ms:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=3, help="messages per chat")
+    parser.add_argument("--words", type=int, default=20, help="max filler words per message")
+    parser.add_argument("--rate", type=float, default=10, help="updates per second, 0 sends everything at once")
+    parser.add_argument("--burst", type=int, default=1, help="updates sent together at every tick")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="share of updates delivered twice")
+    parser.add_argument("--history", type=int, default=0, help="messages already in every chat history")
+    parser.add_argument("--stream", action="store_true", help="AI_STREAM, replies are edited while generated")
+    parser.add_argument("--edit-interval", type=float, default=0.5, help="TELEGRAM_EDIT_INTERVAL")
+    parser.add_argument("--load", type=float, default=1.0, help="fake model load seconds")
+    parser.add_argument("--prompt-rate", type=float, default=2000)
+    parser.add_argument("--gen-rate", type=float, default=200)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--parallel", type=int, default=4, help="requests the fake model serves at once")
+    parser.add_argument("--tool-every", type=int, default=0, help="every n-th user message triggers a tool call")
+    parser.add_argument("--tool", default="get_current_time")
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--flood-every", type=int, default=0, help="every n-th Telegram call gets a 429")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the bot, repeatable")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the last reply")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the bot folder and log")
+    args = parser.parse_args()
+
+    report, log_path = asyncio.run(run(args))
+    print_report(report)
+    if args.keep:
+        print(f"bot log        {log_path}")
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
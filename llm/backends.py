@@ -0,0 +1,260 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+from . import streaming
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_CONFIG = {
+    "keep_alive": "30m",   # how long Ollama keeps a model loaded after a request
+    "warm_interval": 300,  # ping models idle for this long, 0 disables the keep-warm task
+    "max_connections": 16,
+    "retries": 2,          # other backends tried when a request fails
+    "cooldown": 15,        # seconds a failing backend gets no traffic, doubles on every new failure
+    "affinity": True,      # keep a chat on the backend that has its prompt cached
+    "affinity_slack": 1    # ...unless it has this many more requests running than the best one
+}
+
+def endpoints(config):
+    """AI_ENDPOINT and CT_ENDPOINT can list several hosts serving the same model"""
+    return [endpoint.strip() for endpoint in config["endpoint"].split(",") if endpoint.strip()]
+
+def backend_fault(error):
+    """True when a failed request says the backend is in trouble, not that the request itself is wrong"""
+    if isinstance(error, ResponseError): #-1 is an error in the middle of a stream, 429 a full queue
+        return error.status_code >= 500 or error.status_code in (-1, 429)
+    return isinstance(error, (httpx.TransportError, ConnectionError, asyncio.TimeoutError))
+
+class WarmModel:
+    def __init__(self, endpoint, model, num_ctx):
+        self.endpoint = endpoint
+        self.model = model
+        self.num_ctx = num_ctx # the one Ollama has loaded, as far as this process knows
+        self.last_used = 0
+        self.load_secs = None
+
+class OllamaClients:
+    """
+    One long-lived AsyncClient (and its connection pool) per Ollama endpoint, shared by
+    the chat and compression models instead of a new client per turn.
+
+    Models registered with warm_up() are loaded at startup with the same num_ctx the
+    chats use, so the first user doesn't pay the load time (a different num_ctx would
+    make Ollama reload the runner). Every request asks Ollama to keep the model resident
+    for keep_alive, and keep_warm() pings models that had no traffic for warm_interval
+    so a quiet spell doesn't unload them, with the num_ctx the last request used there.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._models = {} # (endpoint, model) -> WarmModel
+        self.pings = 0
+
+    def client(self, endpoint):
+        if endpoint not in self._clients:
+            self._clients[endpoint] = AsyncClient(
+                host=endpoint,
+                limits=httpx.Limits(max_connections=OLLAMA_CONFIG["max_connections"], max_keepalive_connections=OLLAMA_CONFIG["max_connections"])
+            )
+        return self._clients[endpoint]
+
+    def used(self, endpoint, model, num_ctx=None):
+        """A request went to model on endpoint, num_ctx is what it loaded there"""
+        warm = self._models.get((endpoint, model))
+        if warm is None and num_ctx:
+            warm = self._models[(endpoint, model)] = WarmModel(endpoint, model, num_ctx)
+        if warm:
+            warm.last_used = time.monotonic()
+            warm.num_ctx = num_ctx or warm.num_ctx
+
+    def resident(self, endpoint, model):
+        """num_ctx of model as last loaded on endpoint, None when unknown"""
+        warm = self._models.get((endpoint, model))
+        return warm.num_ctx if warm else None
+
+    async def load(self, warm):
+        """An empty generate request loads the model without evaluating anything"""
+        start = time.perf_counter()
+        response = await self.client(warm.endpoint).generate(model=warm.model, options={'num_ctx': warm.num_ctx}, keep_alive=OLLAMA_CONFIG["keep_alive"])
+        warm.last_used = time.monotonic()
+        warm.load_secs = round(response.load_duration/1e9, 2) if response.load_duration else 0
+        return time.perf_counter()-start
+
+    async def warm_up(self, configs):
+        for config in configs:
+            for endpoint in endpoints(config):
+                warm = self._models.setdefault((endpoint, config["model"]), WarmModel(endpoint, config["model"], config["num_ctx"]))
+                warm.num_ctx = max(warm.num_ctx, config["num_ctx"])
+        for warm in list(self._models.values()):
+            try:
+                secs = await self.load(warm)
+                logger.info(f"🔥 {warm.model} ready on {warm.endpoint} in {secs:.1f}s (load {warm.load_secs}s)")
+            except Exception as e:
+                logger.warning(f"🔥 Cannot warm up {warm.model} on {warm.endpoint}: {e}")
+
+    async def keep_warm(self):
+        interval = OLLAMA_CONFIG["warm_interval"]
+        if not interval:
+            return
+        while True:
+            await asyncio.sleep(interval/2)
+            for warm in list(self._models.values()):
+                if time.monotonic()-warm.last_used < interval:
+                    continue
+                try:
+                    await self.load(warm)
+                    self.pings += 1
+                    logger.debug("🔥 Keep-warm ping for %s on %s", warm.model, warm.endpoint)
+                except Exception as e:
+                    logger.warning(f"🔥 Keep-warm ping failed for {warm.model} on {warm.endpoint}: {e}")
+
+    def stats(self):
+        return {
+            "endpoints": list(self._clients),
+            "keep_warm_pings": self.pings,
+            "models": {f"{warm.model}@{warm.endpoint}": {"last_load_secs": warm.load_secs,
+                                                         "idle_secs": int(time.monotonic()-warm.last_used) if warm.last_used else None}
+                       for warm in self._models.values()}
+        }
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients = {}
+
+class Backend:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.inflight = 0
+        self.latency = None # EWMA of request seconds
+        self.failures = 0
+        self.down_until = 0
+        self.requests = 0
+        self.errors = 0
+
+    def up(self):
+        return time.monotonic() >= self.down_until
+
+    def load(self, default_latency):
+        return (self.inflight+1) * (self.latency or default_latency)
+
+    def succeeded(self, secs):
+        self.failures = 0
+        self.latency = secs if self.latency is None else 0.8*self.latency + 0.2*secs
+
+    def failed(self):
+        self.errors += 1
+        self.failures += 1
+        self.down_until = time.monotonic() + OLLAMA_CONFIG["cooldown"] * 2**min(self.failures-1, 5)
+
+class ModelRouter:
+    """
+    Spreads model requests over every endpoint configured for a model.
+
+    Each request goes to the healthy backend with the lowest expected wait, (running
+    requests + 1) x recent latency. A failing backend (connection errors, timeouts,
+    5xx) is taken out for a cooldown that grows while it keeps failing, and the request
+    is retried on another one; a request the backend rejects (4xx) fails at once. With
+    affinity on, a chat sticks to the backend that served its last turn, where Ollama
+    still has the prompt prefix cached, as long as that backend isn't clearly busier.
+    chat(num_ctx=...) picks the context size once the backend is known, from the one
+    already loaded there, so a request doesn't make Ollama reload the model.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.backends = {}
+        self._affinity = OrderedDict() # chat_id -> endpoint, most recent last
+
+    def backend(self, endpoint):
+        if endpoint not in self.backends:
+            self.backends[endpoint] = Backend(endpoint)
+        return self.backends[endpoint]
+
+    def pick(self, config, chat_id=None, exclude=()):
+        candidates = [self.backend(endpoint) for endpoint in endpoints(config) if endpoint not in exclude]
+        if not candidates:
+            return None
+        healthy = [backend for backend in candidates if backend.up()]
+        if not healthy: #everything is cooling down, try the one that comes back first
+            return min(candidates, key=lambda backend: backend.down_until)
+
+        known = [backend.latency for backend in healthy if backend.latency]
+        default_latency = sum(known)/len(known) if known else 1
+        best = min(healthy, key=lambda backend: backend.load(default_latency))
+        pinned = self.backends.get(self._affinity.get(chat_id)) if OLLAMA_CONFIG["affinity"] else None
+        if pinned in healthy and pinned.inflight <= best.inflight + OLLAMA_CONFIG["affinity_slack"]:
+            return pinned
+        return best
+
+    def _pin(self, chat_id, endpoint):
+        if chat_id is None:
+            return
+        self._affinity[chat_id] = endpoint
+        self._affinity.move_to_end(chat_id)
+        while len(self._affinity) > 4096:
+            self._affinity.popitem(last=False)
+
+    async def chat(self, config, chat_id=None, on_partial=None, num_ctx=None, **kwargs):
+        """
+        streaming.chat on the best backend for config, retried elsewhere on failure.
+        num_ctx(resident) returns the num_ctx of the request, given the one loaded on the backend
+        """
+        def call(client, endpoint):
+            options = dict(kwargs.get("options") or {})
+            if num_ctx:
+                options["num_ctx"] = num_ctx(self.clients.resident(endpoint, config["model"]))
+            self.clients.used(endpoint, config["model"], options.get("num_ctx"))
+            return streaming.chat(client, on_partial, keep_alive=OLLAMA_CONFIG["keep_alive"], **{**kwargs, "options": options})
+        return await self._request(config, chat_id, call)
+
+    async def embed(self, config, inputs):
+        """Embedding vectors of a list of texts, same backend choice and retries as chat"""
+        response = await self._request(config, None, lambda client, endpoint: client.embed(model=config["model"], input=inputs, keep_alive=OLLAMA_CONFIG["keep_alive"]))
+        return response.embeddings
+
+    async def _request(self, config, chat_id, call):
+        tried = []
+        error = None
+        for attempt in range(1+OLLAMA_CONFIG["retries"]):
+            backend = self.pick(config, chat_id, tried)
+            if backend is None:
+                break
+            tried.append(backend.endpoint)
+            backend.inflight += 1
+            backend.requests += 1
+            self.clients.used(backend.endpoint, config["model"])
+            start = time.perf_counter()
+            try:
+                reply = await call(self.clients.client(backend.endpoint), backend.endpoint)
+            except Exception as e:
+                if not backend_fault(e): #bad model name, options or tools: the same on every backend
+                    raise
+                backend.failed()
+                error = e
+                logger.warning(f"🔀 {config['model']} failed on {backend.endpoint} ({type(e).__name__}: {e}), {backend.failures} in a row")
+                continue
+            finally:
+                backend.inflight -= 1
+            backend.succeeded(time.perf_counter()-start)
+            self._pin(chat_id, backend.endpoint)
+            return reply
+        raise error or RuntimeError(f"no endpoint configured for {config['model']}")
+
+    def stats(self):
+        return {backend.endpoint: {"up": backend.up(), "inflight": backend.inflight, "requests": backend.requests, "errors": backend.errors,
+                                   "latency_ms": int(backend.latency*1000) if backend.latency else None}
+                for backend in self.backends.values()}
+
+ollama_clients = OllamaClients()
+router = ModelRouter(ollama_clients)
+
+def configure_ollama(config):
+  """Updates the shared client settings, must run before the first request"""
+  OLLAMA_CONFIG.update(config)
+  return ollama_clients
@@ -0,0 +1,183 @@
+import json
+import inspect
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MSG_OVERHEAD = 4 # role and template tokens around every message
+TRIM_TAG = " chars trimmed]"
+
+class ContextBudget:
+    """
+    Estimates the prompt size of a chat before it is sent and trims the request to fit.
+
+    Token estimates are cached per message and per chat, so only the messages appended
+    since the last call are measured. The chars-per-token ratio is learnt from the
+    prompt_eval_count Ollama reports back. fit() returns the messages to send:
+    old tool outputs are trimmed first, then the oldest turns are dropped, the system
+    prompt and the current turn always stay. The stored history is never modified.
+
+    num_ctx() sizes the KV cache of each request: the smallest of a few context buckets
+    that holds the prompt and the reply, so short chats don't allocate the full AI_CTX.
+    Few buckets means few model reloads in Ollama; a chat only moves down a bucket once
+    it fits well inside the smaller one, and the per chat estimate error is learnt from
+    prompt_eval_count. The num_ctx already loaded on the backend wins whenever the
+    request fits in it, a change of num_ctx reloads the model for every chat on it.
+    """
+
+    def __init__(self, target=0.75, reply_reserve=1024, keep_recent=6, tool_trim_chars=1500, max_chats=512, ctx_buckets=(), ctx_fill=0.85, ctx_shrink=0.5):
+        self.target = target
+        self.reply_reserve = reply_reserve
+        self.keep_recent = keep_recent
+        self.tool_trim_chars = tool_trim_chars
+        self.max_chats = max_chats
+        self.ctx_buckets = list(ctx_buckets)
+        self.ctx_fill = ctx_fill      # prompt+reply may use this much of a bucket
+        self.ctx_shrink = ctx_shrink  # ...and must use less than this to move a chat down to it
+        self.chars_per_token = 4.0
+        self._ledgers = OrderedDict() # chat_id -> [(message, chars)]
+        self._sizes = OrderedDict()   # chat_id -> [last num_ctx, real/estimated tokens]
+        self.bucket_counts = {}
+
+    def message_chars(self, msg):
+        chars = len(msg.get('content') or "")
+        if msg.get('tool_calls'):
+            chars += len(json.dumps(msg['tool_calls'], default=str))
+        return chars
+
+    def message_tokens(self, msg):
+        return int(self.message_chars(msg)/self.chars_per_token)+MSG_OVERHEAD
+
+    def tools_tokens(self, tools):
+        """Size of the tools block sent with every request"""
+        chars = 0
+        for tool in tools or []:
+            if callable(tool):
+                chars += len(tool.__name__) + len(str(inspect.signature(tool))) + len(inspect.getdoc(tool) or "")
+            else:
+                chars += len(json.dumps(tool, default=str))
+        return int(chars/self.chars_per_token)
+
+    def estimate(self, chat_id, messages):
+        """Prompt tokens of the whole history, only new or changed messages are measured"""
+        ledger = self._ledgers.pop(chat_id, [])
+        same = 0
+        while same < min(len(ledger), len(messages)) and ledger[same][0] is messages[same]:
+            same += 1
+        ledger = ledger[:same] + [(msg, self.message_chars(msg)) for msg in messages[same:]]
+
+        self._ledgers[chat_id] = ledger
+        if len(self._ledgers) > self.max_chats:
+            self._ledgers.popitem(last=False)
+        return int(sum(chars for _, chars in ledger)/self.chars_per_token) + MSG_OVERHEAD*len(ledger)
+
+    def usage(self, chat_id, messages, num_ctx, tools_tokens=0):
+        """Expected context usage in % of num_ctx"""
+        return int((self.estimate(chat_id, messages)+tools_tokens)/num_ctx*100)
+
+    def calibrate(self, estimated, prompt_tokens):
+        """Learns the chars-per-token ratio from the real prompt_eval_count"""
+        if not estimated or not prompt_tokens:
+            return
+        ratio = self.chars_per_token * estimated/prompt_tokens
+        self.chars_per_token = min(8.0, max(1.5, 0.8*self.chars_per_token + 0.2*ratio))
+        if abs(ratio-self.chars_per_token) > 0.5:
+            logger.debug("🎫 Estimated %s vs real %s tokens, chars/token now %.2f", estimated, prompt_tokens, self.chars_per_token)
+
+    def num_ctx(self, chat_id, estimated, max_ctx, resident=None):
+        """Context size for a request of about estimated prompt tokens, resident is the one loaded on the backend"""
+        buckets = sorted(bucket for bucket in self.ctx_buckets if bucket < max_ctx) + [max_ctx]
+        previous, ratio = self._sizes.get(chat_id, (None, 1.0))
+        need = int((estimated or 0)*ratio) + self.reply_reserve
+        chosen = next((bucket for bucket in buckets if need <= bucket*self.ctx_fill), max_ctx)
+        if previous and chosen < previous <= max_ctx and need > chosen*self.ctx_shrink:
+            chosen = previous #not small enough yet, stay in the current bucket
+        if resident and resident <= max_ctx and need <= resident*self.ctx_fill:
+            chosen = resident #fits in what is loaded, no reload
+
+        self._sizes[chat_id] = [chosen, ratio]
+        self._sizes.move_to_end(chat_id)
+        if len(self._sizes) > self.max_chats:
+            self._sizes.popitem(last=False)
+        self.bucket_counts[chosen] = self.bucket_counts.get(chosen, 0)+1
+        return chosen
+
+    def learn_num_ctx(self, chat_id, estimated, prompt_tokens, num_ctx, max_ctx):
+        """Corrects the chat estimate with the real prompt size, bumps the bucket if the prompt got cut"""
+        size = self._sizes.get(chat_id)
+        if size is None or not estimated or not prompt_tokens:
+            return
+        size[1] = min(2.0, max(0.5, 0.7*size[1] + 0.3*prompt_tokens/estimated))
+        if prompt_tokens + self.reply_reserve//4 >= num_ctx and num_ctx < max_ctx:
+            bigger = [bucket for bucket in self.ctx_buckets if num_ctx < bucket < max_ctx]
+            size[0] = min(bigger) if bigger else max_ctx
+            logger.warning(f"🎫 Prompt of {chat_id} filled num_ctx {num_ctx}, next request uses {size[0]}")
+
+    def fit(self, chat_id, messages, num_ctx, tools_tokens=0):
+        """Returns (messages to send, estimated prompt tokens)"""
+        limit = int(num_ctx*self.target) - self.reply_reserve - tools_tokens
+        total = self.estimate(chat_id, messages)
+        if total <= limit:
+            return messages, total+tools_tokens
+
+        fitted = list(messages)
+        recent_start = max(1, len(fitted)-self.keep_recent)
+
+        # 1. trim the tool outputs before the recent window
+        total = self._trim_tools(fitted, 1, recent_start, total, limit)
+
+        # 2. drop the oldest turns, a turn being a user message and all the replies and tools after it
+        dropped = 0
+        head = 2 if len(fitted) > 1 and fitted[1].get('role') == 'system' else 1 #keep a summary too
+        while total > limit:
+            turn_end = self._next_user(fitted, head+1)
+            if turn_end is None: #only the current turn is left
+                break
+            for msg in fitted[head:turn_end]:
+                total -= self.message_tokens(msg)
+                dropped += 1
+            del fitted[head:turn_end]
+
+        # 3. last resort, trim what is left, the current turn included
+        total = self._trim_tools(fitted, head, len(fitted), total, limit)
+
+        logger.warning(f"🎫 Context over budget ({limit} tokens): sending {len(fitted)}/{len(messages)} messages, {dropped} dropped, ~{total} tokens")
+        return fitted, total+tools_tokens
+
+    def _trim_tools(self, fitted, start, end, total, limit):
+        for i in range(start, end):
+            if total <= limit:
+                break
+            if fitted[i].get('role') == 'tool':
+                trimmed = self._trim(fitted[i])
+                total += self.message_tokens(trimmed) - self.message_tokens(fitted[i])
+                fitted[i] = trimmed
+        return total
+
+    def _trim(self, msg):
+        """Head of a long tool output, plus its last line when short (paging hints like "call again with page=2")"""
+        content = msg.get('content') or ""
+        if len(content) <= self.tool_trim_chars or TRIM_TAG in content: #trimmed already
+            return msg
+        tail = content.rstrip().rsplit("\n", 1)[-1]
+        tail = f"\n{tail}" if len(tail) <= 200 and len(tail) < len(content) else ""
+        cut = len(content)-self.tool_trim_chars-len(tail)
+        return {**msg, 'content': content[:self.tool_trim_chars]+f"\n…[{cut}{TRIM_TAG}"+tail}
+
+    def _next_user(self, messages, start):
+        for i in range(start, len(messages)):
+            if messages[i].get('role') == 'user':
+                return i
+        return None
+
+budget = ContextBudget()
+
+def configure_budget(config):
+  """Updates the shared budget in place, modules keep their reference to it"""
+  budget.target = config["target"]
+  budget.reply_reserve = config["reply_reserve"]
+  budget.keep_recent = config["keep_recent"]
+  budget.tool_trim_chars = config["tool_trim_chars"]
+  budget.ctx_buckets = config["ctx_buckets"]
+  return budget
@@ -0,0 +1,173 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from .storage import StaleHistoryError
+
+logger = logging.getLogger(__name__)
+
+def message_size(msg):
+    """Rough in-memory footprint of a message, good enough for cache accounting"""
+    size = 64 + len(msg.get('content') or "")
+    if msg.get('tool_calls'):
+        size += len(str(msg['tool_calls']))
+    return size
+
+class CacheEntry:
+    def __init__(self, messages, dirty):
+        self.messages = messages
+        self.size = sum(message_size(msg) for msg in messages)
+        self.dirty = dirty
+        self.last_access = time.monotonic()
+
+class ContextCache:
+    """
+    In-process LRU cache of active chat histories in front of a context store.
+
+    Reads of a cached chat don't touch the disk. Writes only update memory and mark
+    the chat dirty; dirty chats are written to the store by flush(), which runs on a
+    timer, before a chat is evicted and at shutdown (write-behind). Chats are evicted
+    least recently used first once there are too many or they use too much memory,
+    and dropped after idle_ttl seconds without activity.
+    """
+
+    def __init__(self, store, max_chats=256, max_bytes=64*1024*1024, idle_ttl=1800):
+        self.store = store
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()     # guards _entries, never held during I/O
+        self._io_lock = threading.Lock()  # orders store I/O so a flush can't resurrect a wiped chat
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "flushes": 0, "stale": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self.counters["hits"] += 1
+                entry.last_access = time.monotonic()
+                self._entries.move_to_end(key)
+                return list(entry.messages)
+            self.counters["misses"] += 1
+
+        with self._io_lock:
+            messages = self.store.load(key)
+        if messages is not None:
+            self._insert(key, CacheEntry(list(messages), dirty=False))
+        return messages
+
+    def put(self, key, messages):
+        self._insert(key, CacheEntry(list(messages), dirty=True))
+
+    def delete(self, key):
+        with self._io_lock:
+            with self._lock:
+                entry = self._entries.pop(key, None)
+                if entry:
+                    self._bytes -= entry.size
+            self.store.delete(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def release(self, key):
+        """Writes a chat out and drops it from memory, another process owns it now"""
+        self._flush_key(key)
+        with self._lock:
+            if key in self._entries and not self._entries[key].dirty:
+                self._drop(key)
+
+    def flush_key(self, key):
+        """Writes one chat to the store now if it is dirty"""
+        self._flush_key(key)
+
+    def flush(self):
+        """Writes every dirty chat to the store and drops idle ones"""
+        now = time.monotonic()
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            self._flush_key(key)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and not entry.dirty and now-entry.last_access > self.idle_ttl:
+                    self._drop(key)
+                    self.counters["expirations"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"]+self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": round(self.counters["hits"]/lookups, 3) if lookups else None,
+                "chats": len(self._entries),
+                "dirty": sum(1 for entry in self._entries.values() if entry.dirty),
+                "bytes": self._bytes
+            }
+
+    async def run_flusher(self, interval):
+        """Background write-behind loop, cancel it and call flush() on shutdown"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"Context cache flush failed: {e}")
+
+    def _insert(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            victims = self._over_budget()
+        for victim in victims:
+            self._flush_key(victim)
+            with self._lock:
+                if victim in self._entries and not self._entries[victim].dirty:
+                    self._drop(victim)
+                    self.counters["evictions"] += 1
+
+    def _over_budget(self):
+        """Least recently used keys that have to go, the newest entry always stays"""
+        victims = []
+        count, size = len(self._entries), self._bytes
+        if count <= self.max_chats and size <= self.max_bytes:
+            return victims
+        for key, entry in list(self._entries.items())[:-1]:
+            if count <= self.max_chats and size <= self.max_bytes:
+                break
+            victims.append(key)
+            count -= 1
+            size -= entry.size
+        return victims
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _flush_key(self, key):
+        with self._io_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if not entry or not entry.dirty:
+                    return
+            # a put() meanwhile replaces the entry with a new dirty one, so this one can be marked clean
+            try:
+                self.store.save(key, entry.messages)
+            except StaleHistoryError as e:
+                # another node owned the chat meanwhile, its turns win over the ones cached here
+                logger.error(f"Dropping cached history of {key}: {e}")
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._drop(key)
+                    self.counters["stale"] += 1
+                return
+            with self._lock:
+                entry.dirty = False
+                self.counters["flushes"] += 1
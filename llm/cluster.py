@@ -0,0 +1,314 @@
+import os
+import sys
+import hmac
+import time
+import bisect
+import signal
+import asyncio
+import hashlib
+import logging
+import subprocess
+
+import httpx
+
+from .httpclient import http_clients
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_CONFIG = {
+    "self": None,          # url the other nodes reach this one at, None runs a single node
+    "nodes": [],           # urls of every node, this one included
+    "secret": None,        # shared by the nodes, sent with every internal call
+    "vnodes": 256,         # points per node on the hash ring
+    "ping_interval": 5,
+    "ping_failures": 2,    # missed pings before a node leaves the ring
+    "forward_timeout": 10,
+    "handoff_timeout": 120  # longest wait for the other nodes to finish the turns of a chat taken over
+}
+
+def ring_hash(key):
+    """Same value in every process, unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Consistent hashing of chat ids over the nodes, a node joining or leaving moves ~1/n of the chats"""
+
+    def __init__(self, nodes, vnodes=256):
+        self.nodes = sorted(nodes)
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        return self._owners[bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)]
+
+class Member:
+    def __init__(self, url):
+        self.url = url
+        self.up = True
+        self.failures = 0
+
+class Cluster:
+    """
+    Chat affinity across several bot processes, on one machine or many.
+
+    Every chat has a single owner picked by consistent hashing of its chat_id over the
+    live nodes, and only the owner runs its turns, so messages of a chat keep their
+    order and a history never has two writers. Any node can receive an update, it is
+    forwarded to the owner (POST /cluster/update) or handled locally when the owner is
+    this node or can't be reached. A chat that still has work queued here stays here
+    until it is drained.
+
+    Before its first turn on a node, and again after every rebalance, a chat is taken
+    over by handoff(): every live peer is asked to release it (POST /cluster/release),
+    a peer answers busy while the chat still has turns queued or running there, and
+    once idle writes it out to the shared store and drops it. Then on_handoff(chat_id)
+    drops what this node had cached, so the turn reads the history the others left.
+    A node that was frozen longer than the ping timeout forgets the chats it held,
+    the others may have taken them meanwhile. The stores also reject a write over a
+    history changed since it was read, the last line against two writers.
+
+    Nodes ping each other, and announce themselves when they start and stop. When the
+    set of live nodes changes the ring is rebuilt and on_rebalance(ring) runs: chats
+    that moved are written out and dropped from memory, and the Telegram rate is split
+    again between the nodes. Histories live in a store shared by the nodes (sqlite or
+    journal in a shared folder, or any engine added with register_store).
+    """
+
+    def __init__(self):
+        self.url = None
+        self.members = {}
+        self.ring = None
+        self.on_rebalance = None
+        self.busy = None
+        self.on_handoff = None
+        self._held = set()        # chats taken over since the last rebalance
+        self._waiting = {}        # chats waiting for the other nodes to release them -> [update_id, gave way to another node]
+        self._pinger = None
+        self.counters = {"forwarded": 0, "forward_failures": 0, "kept_busy": 0, "rebalances": 0, "handoffs": 0, "handoff_waits": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.url)
+
+    def configure(self, config):
+        CLUSTER_CONFIG.update(config)
+        self.url = CLUSTER_CONFIG["self"]
+        nodes = set(CLUSTER_CONFIG["nodes"]) | ({self.url} if self.url else set())
+        self.members = {url: Member(url) for url in nodes}
+        self.ring = HashRing(nodes, CLUSTER_CONFIG["vnodes"]) if self.url else None
+
+    def owner(self, chat_id):
+        return self.ring.owner(chat_id) if self.ring else self.url
+
+    def owns(self, chat_id):
+        return not self.enabled or self.owner(chat_id) == self.url
+
+    def headers(self):
+        return {"X-Cluster-Secret": CLUSTER_CONFIG["secret"] or ""}
+
+    def allowed(self, secret):
+        return bool(CLUSTER_CONFIG["secret"]) and hmac.compare_digest(secret or "", CLUSTER_CONFIG["secret"])
+
+    async def forward(self, chat_id, update):
+        """True when the owner took the update, False when this node has to handle it"""
+        owner = self.owner(chat_id)
+        if owner is None or owner == self.url:
+            return False
+        if self.busy and self.busy(chat_id): #the previous owner drains what it has before handing over
+            self.counters["kept_busy"] += 1
+            return False
+        try:
+            response = await http_clients.post("cluster", f"{owner}/cluster/update", json=update, headers=self.headers(),
+                                               timeout=CLUSTER_CONFIG["forward_timeout"])
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.counters["forward_failures"] += 1
+            logger.warning(f"🕸️ Forward of {chat_id} to {owner} failed ({type(e).__name__}), handled here")
+            await self.mark(owner, up=False)
+            return False
+        self.counters["forwarded"] += 1
+        logger.debug("🕸️ Update of %s forwarded to %s", chat_id, owner)
+        return True
+
+    def holds(self, chat_id):
+        """True when turns of the chat can run here without asking the other nodes"""
+        return not self.enabled or chat_id in self._held
+
+    async def handoff(self, chat_id, update_id=None):
+        """Waits until no other node has turns of a chat left, before its first turn here"""
+        if self.holds(chat_id):
+            return
+        waiting = self._waiting[chat_id] = [update_id, False]
+        deadline = time.monotonic()+CLUSTER_CONFIG["handoff_timeout"]
+        try:
+            while True:
+                peers = [url for url, member in self.members.items() if member.up and url != self.url]
+                results = await asyncio.gather(*[http_clients.post("cluster", f"{url}/cluster/release", json={"chat_id": chat_id, "update_id": update_id},
+                                                                   headers=self.headers(), timeout=2) for url in peers],
+                                               return_exceptions=True)
+                #a peer that can't answer has nothing running that could be waited for
+                busy = [url for url, result in zip(peers, results)
+                        if not isinstance(result, Exception) and result.status_code == 200 and result.json().get("busy")]
+                if not busy and not waiting[1]:
+                    break
+                if time.monotonic() > deadline:
+                    logger.warning(f"🕸️ {', '.join(busy)} still busy with {chat_id} after {CLUSTER_CONFIG['handoff_timeout']}s, taking it over")
+                    break
+                self.counters["handoff_waits"] += 1
+                waiting[1] = False
+                await asyncio.sleep(0.5)
+        finally:
+            self._waiting.pop(chat_id, None)
+        if self.on_handoff:
+            await self.on_handoff(chat_id)
+        self._held.add(chat_id)
+        self.counters["handoffs"] += 1
+        logger.debug("🕸️ Chat %s handed over to this node", chat_id)
+
+    def release(self, chat_id, update_id=None):
+        """A peer takes a chat over for update_id, False once this node has no earlier turn of it to run"""
+        if self.busy and self.busy(chat_id):
+            waiting = self._waiting.get(chat_id)
+            if not waiting:
+                return True
+            #both wait for each other: the older update goes first, the owner when that is unknown
+            mine = waiting[0]
+            if (mine < update_id) if None not in (mine, update_id) else self.owns(chat_id):
+                return True
+            waiting[1] = True #asks again once the peer is running
+        self._held.discard(chat_id)
+        return False
+
+    async def start(self, busy=None):
+        """busy(chat_id) tells whether this node still has work for a chat"""
+        if not self.enabled:
+            return
+        self.busy = busy
+        await self._announce("join")
+        self._pinger = asyncio.create_task(self._ping_loop())
+        logger.info(f"🕸️ Node {self.url} in a cluster of {len(self.members)}: {sorted(self.members)}")
+
+    async def stop(self):
+        if not self.enabled:
+            return
+        if self._pinger:
+            self._pinger.cancel()
+            await asyncio.gather(self._pinger, return_exceptions=True)
+        await self._announce("leave")
+
+    async def join(self, url):
+        member = self.members.setdefault(url, Member(url))
+        member.failures = 0
+        await self.mark(url, up=True)
+
+    async def leave(self, url):
+        await self.mark(url, up=False)
+
+    async def mark(self, url, up):
+        member = self.members.get(url)
+        if not member or member.up == up or url == self.url:
+            return
+        member.up = up
+        logger.info(f"🕸️ Node {url} is {'up' if up else 'down'}")
+        await self._rebuild()
+
+    async def _rebuild(self):
+        live = [url for url, member in self.members.items() if member.up]
+        self._held.clear()
+        self.ring = HashRing(live, CLUSTER_CONFIG["vnodes"])
+        self.counters["rebalances"] += 1
+        logger.info(f"🕸️ Ring rebuilt with {len(live)} nodes")
+        if self.on_rebalance:
+            try:
+                await self.on_rebalance(self.ring)
+            except Exception as e:
+                logger.error(f"🕸️ Rebalance failed: {e}")
+
+    async def _announce(self, event):
+        peers = [url for url in self.members if url != self.url]
+        results = await asyncio.gather(*[http_clients.post("cluster", f"{url}/cluster/{event}", json={"url": self.url},
+                                                           headers=self.headers(), timeout=2) for url in peers],
+                                       return_exceptions=True)
+        if event == "join":
+            down = [url for url, result in zip(peers, results) if isinstance(result, Exception) or result.status_code != 200]
+            for url in down: #not started yet, it announces itself when it is
+                self.members[url].up = False
+            if down:
+                await self._rebuild()
+
+    async def _ping_loop(self):
+        while True:
+            slept = time.monotonic()
+            await asyncio.sleep(CLUSTER_CONFIG["ping_interval"])
+            slept = time.monotonic()-slept
+            if slept > CLUSTER_CONFIG["ping_interval"]*(CLUSTER_CONFIG["ping_failures"]+1):
+                #the others took this node for dead and may own its chats now
+                logger.warning(f"🕸️ Node stalled for {slept:.0f}s, taking chats over again")
+                self._held.clear()
+            for url, member in list(self.members.items()):
+                if url == self.url:
+                    continue
+                try:
+                    response = await http_clients.get("cluster", f"{url}/cluster/ping", headers=self.headers(), timeout=2)
+                    response.raise_for_status()
+                    member.failures = 0
+                    await self.mark(url, up=True)
+                except httpx.HTTPError:
+                    member.failures += 1
+                    if member.failures >= CLUSTER_CONFIG["ping_failures"]:
+                        await self.mark(url, up=False)
+
+    def stats(self):
+        if not self.enabled:
+            return None
+        return {"self": self.url, "nodes": {url: member.up for url, member in self.members.items()}, **self.counters}
+
+cluster = Cluster()
+
+def configure_cluster(config):
+  """Sets this node and its peers, must run before start()"""
+  cluster.configure(config)
+  return cluster
+
+def worker_path(path, index):
+    """data/updates.db -> data/updates-2.db, files a worker can't share with the others"""
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+def run_workers(script, count, port, host="127.0.0.1"):
+    """
+    Runs count copies of script on port, port+1... as one cluster on this machine,
+    next to the nodes already listed in CLUSTER_NODES. Files written by a single
+    process (update ledger, caches) get one copy per worker, only worker 0 polls
+    getUpdates. Blocks until the workers exit, Ctrl+C stops them all.
+    """
+    urls = [f"http://{host}:{port+i}" for i in range(count)]
+    nodes = [url for url in os.getenv("CLUSTER_NODES", "").split(",") if url.strip()] + urls
+    workers = []
+    for i, url in enumerate(urls):
+        env = {**os.environ,
+               "CLUSTER_WORKERS": "1", "CLUSTER_SELF": url, "CLUSTER_NODES": ",".join(nodes), "UVICORN_PORT": str(port+i),
+               "UPDATES_DB": worker_path(os.getenv("UPDATES_DB", "data/updates.db"), i),
+               "TOOL_CACHE_FILE": worker_path(os.getenv("TOOL_CACHE_FILE", "data/tool_cache.json"), i),
+               "WEATHER_GEOCODE_FILE": worker_path(os.getenv("WEATHER_GEOCODE_FILE", "data/geocode.json"), i)}
+        if i > 0:
+            env["TELEGRAM_MODE"] = "webhook"
+        workers.append(subprocess.Popen([sys.executable, script], env=env, start_new_session=True)) #signals come from here, once
+    logger.info(f"🕸️ {count} workers started on {urls}")
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.send_signal(signal.SIGINT)
+        for worker in workers:
+            worker.wait()
@@ -0,0 +1,136 @@
+import json
+import logging
+
+from .budget import budget
+
+logger = logging.getLogger(__name__)
+
+STUB_TAG = "[collapsed] "
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def _clip(text, chars):
+    if isinstance(text, (list, tuple)):
+        text = ", ".join(str(item) for item in text)
+    text = " ".join(str(text).split()) if text else text
+    return text if not text or len(text) <= chars else text[:chars].rstrip()+"…"
+
+def format_series(rows):
+    return [{
+        "name": row.get("name"),
+        "other_names": _clip(row.get("other_names"), 120),
+        "type": row.get("type"),
+        "genres": row.get("genres"),
+        "watched": row.get("watched"),
+        "airing": row.get("airing"),
+        "rating": row.get("rating"),
+        "next_release": row.get("next_release"),
+        "synopsis": _clip(row.get("synopsis"), 300),
+        "score": round(float(row["score"]), 2) if row.get("score") is not None else None
+    } for row in rows]
+
+# tool name -> formatter for its structured result, strings are passed through as they are
+FORMATTERS = {
+    "get_series_details": format_series
+}
+
+def _without_nulls(value):
+    if isinstance(value, dict):
+        return {k: _without_nulls(v) for k, v in value.items() if v is not None and v != ""}
+    if isinstance(value, list):
+        return [_without_nulls(v) for v in value]
+    return value
+
+class ToolOutputCompactor:
+    """
+    Turns tool results into what goes in the context, and keeps old ones from piling up.
+
+    format() runs the tool's formatter on structured results (only the fields the model
+    needs, compact JSON instead of a Python repr) and caps the size, dropping list items
+    before cutting text so the JSON stays valid. collapse() replaces the outputs of
+    turns older than keep_turns by a short stub once they are answered: the answer is in
+    the history already. Savings are counted in estimated prompt tokens.
+    """
+
+    def __init__(self, max_chars=4000, tool_max_chars=None, keep_turns=2, stub_chars=120):
+        self.max_chars = max_chars
+        self.tool_max_chars = dict(tool_max_chars or {"browse_website": 8000, "read_file": 8000})
+        self.keep_turns = keep_turns
+        self.stub_chars = stub_chars
+        self.counters = {"raw_tokens": 0, "sent_tokens": 0, "collapsed": 0, "collapsed_tokens": 0}
+
+    def tokens(self, chars):
+        return int(chars/budget.chars_per_token)
+
+    def format(self, name, result):
+        if isinstance(result, str):
+            value = result
+        else:
+            formatter = FORMATTERS.get(name)
+            value = _without_nulls(formatter(result) if formatter else result)
+        content = self.cap(value, self.tool_max_chars.get(name, self.max_chars))
+
+        raw = self.tokens(len(str(result)))
+        sent = self.tokens(len(content))
+        self.counters["raw_tokens"] += raw
+        self.counters["sent_tokens"] += sent
+        if raw > sent:
+            logger.info(f"🗜️ {name} output compacted, {raw} -> {sent} prompt tokens")
+        return content
+
+    def cap(self, value, max_chars):
+        text = value if isinstance(value, str) else dumps(value)
+        if len(text) <= max_chars:
+            return text
+
+        items = value if isinstance(value, list) else None
+        if isinstance(value, dict): #shrink the biggest list inside, e.g. forecast points
+            lists = [k for k, v in value.items() if isinstance(v, list)]
+            if lists:
+                key = max(lists, key=lambda k: len(value[k]))
+                items = value[key]
+        if items:
+            kept = list(items)
+            while kept and len(text) > max_chars-32:
+                kept.pop()
+                text = dumps(kept if isinstance(value, list) else {**value, key: kept})
+            if len(text) <= max_chars-32:
+                return f"{text}\n…[{len(items)-len(kept)} more items]"
+
+        return f"{text[:max_chars]}\n…[{len(text)-max_chars} chars cut]"
+
+    def collapse(self, messages):
+        """History with the tool outputs of answered turns, except the last keep_turns, as stubs"""
+        users = [i for i, msg in enumerate(messages) if msg.get('role') == 'user']
+        if len(users) <= self.keep_turns:
+            return messages
+
+        collapsed = list(messages)
+        saved = 0
+        for i in range(users[-self.keep_turns] if self.keep_turns else len(messages)):
+            msg = collapsed[i]
+            content = msg.get('content') or ""
+            if msg.get('role') != 'tool' or content.startswith(STUB_TAG) or len(content) <= self.stub_chars:
+                continue
+            stub = f"{STUB_TAG}{msg.get('name', 'tool')} returned {len(content)} chars: {content[:self.stub_chars]}…"
+            collapsed[i] = {**msg, 'content': stub}
+            saved += self.tokens(len(content)-len(stub))
+            self.counters["collapsed"] += 1
+
+        if saved:
+            self.counters["collapsed_tokens"] += saved
+            logger.info(f"🗜️ Old tool outputs collapsed, {saved} prompt tokens saved on every next turn")
+        return collapsed
+
+    def stats(self):
+        return {**self.counters, "saved_tokens": self.counters["raw_tokens"]-self.counters["sent_tokens"]}
+
+compactor = ToolOutputCompactor()
+
+def configure_compactor(config):
+  """Updates the shared compactor in place, modules keep their reference to it"""
+  compactor.max_chars = config["max_chars"]
+  compactor.keep_turns = config["keep_turns"]
+  compactor.tool_max_chars.update(config["tool_max_chars"])
+  return compactor
@@ -1,17 +1,27 @@
-import json
 import logging
 from dotenv import load_dotenv
-from ollama import Client
 import os
-from os.path import abspath
 
-# Configure basic logging
-logging.basicConfig(
-    format='%(levelname)s: %(name)s %(message)s',
-    level=logging.DEBUG
-)
+from .backends import router
+from .metrics import metrics
+from .logs import truncated
+from .storage import make_store
+from .cache import ContextCache
+
 logger = logging.getLogger(__name__)
 
+store = make_store()
+cache = None
+
+def configure_store(config, cache_config=None):
+  global store, cache
+  store = make_store(config["engine"], config["folder"])
+  if cache_config and cache_config["enabled"]:
+    cache = ContextCache(store, cache_config["max_chats"], cache_config["max_bytes"], cache_config["idle_ttl"])
+  else:
+    cache = None
+  return cache
+
 ## MESSAGE HANDLING
 def init_context(system_prompt):
   logger.info(f"Context initialization")
@@ -25,7 +35,7 @@ def append_context(messages, role, content="<no content>", tools=None):
       logger.info(f"Text-only message from {role}")
       msg = {'role': role, 'content': content}
 
-    logger.debug(msg)
+    logger.debug("%s", truncated(msg))
     messages.append(msg)
     return messages
 
@@ -37,46 +47,90 @@ def purge_context(messages, msg_keep, msg_max):
     return messages
 
 def print_context(messages, window):
-    messages_part = messages[-window:]
-    logger.debug(json.dumps(messages_part, indent=2))
+    logger.debug("%s", truncated(messages[-window:]))
 
 def save_context(key, messages):
   logger.info(f"saved context for {key}")
-  logger.debug(abspath(f"data/{key}.json"))
   try:
-    with open(f"data/{key}.json", "w") as f:
-      f.write(json.dumps(messages))
+    if cache:
+      cache.put(key, messages)
+    else:
+      store.save(key, messages)
+  except Exception as e:
+    logger.error(f"Cannot save chat history for {key}!\n{str(e)}")
+
+def flush_context(key):
+  """Writes a cached chat to the store now, instead of on the next flush"""
+  try:
+    if cache:
+      cache.flush_key(key)
   except Exception as e:
     logger.error(f"Cannot save chat history for {key}!\n{str(e)}")
 
 def load_context(key):
   logger.info(f"loaded context for {key}")
-  logger.debug(abspath(f"data/{key}.json"))
   try:
-    f = open(f"data/{key}.json","r")
-    return json.loads(f.read())
+    return cache.get(key) if cache else store.load(key)
   except Exception as e:
     logger.error(f"Cannot load chat history for {key}!\n{str(e)}")
     return None
 
-def compress_context(messages, init_msg, config):
+def delete_context(key):
+  logger.info(f"wiped context for {key}")
+  try:
+    if cache:
+      cache.delete(key)
+    else:
+      store.delete(key)
+  except Exception as e:
+    logger.error(f"Cannot wipe chat history for {key}!\n{str(e)}")
+
+def release_contexts(owned):
+  """
+  Writes out and drops the cached chats that owned(key) says belong to another node now.
+  The store forgets what it knows about every chat, so a chat that comes back to this
+  node is read again from the shared store.
+  """
+  released = [key for key in cache.keys() if not owned(key)] if cache else []
+  for key in released:
+    cache.release(key)
+  store.forget()
+  return released
 
+def release_context(key):
+  """Writes out and drops one chat, another node takes it over"""
+  if cache:
+    cache.release(key)
+  store.forget(key)
+
+def render_transcript(messages, tool_chars=2000):
+    """Plain text version of a history slice, what the compression model gets to read"""
+    lines = []
+    for msg in messages:
+      if msg.get('tool_calls'):
+        calls = ", ".join(f'{call["function"]["name"]}({call["function"]["arguments"]})' for call in msg['tool_calls'])
+        lines.append(f"{msg['role']} called tools: {calls}")
+      content = msg.get('content') or ""
+      if msg['role'] == 'tool':
+        content = content[:tool_chars]
+      if content:
+        lines.append(f"{msg['role']}: {content}")
+    return "\n".join(lines)
+
+async def compress_context(messages, previous_summary, config):
+    """Summarizes messages, on top of an earlier summary if any, and returns the summary text"""
     logger.info(f"Context compression starting...")
     model = config["model"]
     stream = config["stream"]
-    client = Client(host=config["endpoint"])
     options = {'temperature': config["temperature"], 'num_ctx': config["num_ctx"]}
 
-    oldest_messages = messages[:-2]
-    latest_messages = messages[-2:]
+    request = init_context(config['system_prompt'])
+    if previous_summary:
+      request = append_context(request, "user", f"Summary so far:\n{previous_summary}")
+    request = append_context(request, "user", render_transcript(messages))
 
-    messages = append_context(oldest_messages, "assistant", content=config['system_prompt'])
-    llm_reply = client.chat(model=model, options=options, messages=messages, stream=stream)
-    logger.debug(f"{llm_reply['message']['content']}")
-
-    new_messages = init_context(init_msg)
-    new_messages+= latest_messages
-    new_messages = append_context(new_messages, "assistant", content=llm_reply.message.content)
+    with metrics.stage("compress", model):
+      llm_reply = await router.chat(config, model=model, options=options, messages=request, stream=stream)
+    logger.debug("Summary: %s", truncated(llm_reply.message.content))
     logger.info(f"Context compression completed!")
-    return new_messages
-
+    return llm_reply.message.content
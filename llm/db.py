@@ -0,0 +1,183 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SERIES_COLUMNS = "id,name,genres,type, viewed as watched,other_names,pub_status as airing,"+\
+                 "rating,to_char(next_release, 'dd/mm/yyyy') as next_release, synopsis"
+
+# $1 raw search text, $2 same text escaped for ILIKE, $3 max rows
+SEARCH_TRGM = f"""
+    SELECT {SERIES_COLUMNS},
+           greatest(similarity(name, $1), similarity(coalesce(other_names::text, ''), $1)) AS score
+    FROM anime_downloader_anime
+    WHERE name % $1 OR other_names::text % $1
+       OR name ILIKE '%' || $2 || '%' OR other_names::text ILIKE '%' || $2 || '%'
+    ORDER BY score DESC, length(name)
+    LIMIT $3"""
+
+SEARCH_PLAIN = f"""
+    SELECT {SERIES_COLUMNS},
+           CASE WHEN name ILIKE $2 THEN 1.0 WHEN name ILIKE $2 || '%' THEN 0.8
+                WHEN name ILIKE '%' || $2 || '%' THEN 0.5 ELSE 0.3 END AS score
+    FROM anime_downloader_anime
+    WHERE name ILIKE '%' || $2 || '%' OR other_names::text ILIKE '%' || $2 || '%'
+    ORDER BY score DESC, length(name)
+    LIMIT $3"""
+
+TRGM_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS anime_name_trgm ON anime_downloader_anime USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS anime_other_names_trgm ON anime_downloader_anime USING gin ((other_names::text) gin_trgm_ops)"
+]
+
+psycopg2 = None # imported on the first query, the bot starts without it when the series tool is off
+PooledConnection = None
+
+def load_driver():
+    global psycopg2, PooledConnection
+    if psycopg2 is not None:
+        return
+    import psycopg2
+    import psycopg2.pool
+    import psycopg2.extensions
+
+    class PooledConnection(psycopg2.extensions.connection):
+        """Connection that remembers whether its prepared statements exist and when it was last used"""
+        prepared = False
+        last_used = 0
+
+def escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class SeriesDB:
+    """
+    Bounded PostgreSQL connection pool for the series database.
+
+    Callers block up to pool_wait seconds for a free connection instead of opening a
+    new one per call. Every session gets a statement_timeout, connections idle for a
+    while are pinged before use and broken ones are replaced. The search statement is
+    prepared once per connection; it ranks titles with pg_trgm similarity over name and
+    other_names when the extension is available and falls back to plain ILIKE otherwise.
+    """
+
+    def __init__(self, db_config=None, minconn=1, maxconn=5, statement_timeout_ms=5000, pool_wait=10, ping_after=30, create_indexes=False, top_n=3):
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pool_wait = pool_wait
+        self.ping_after = ping_after
+        self.create_indexes = create_indexes
+        self.top_n = top_n
+        self.trigram = None
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _init_pool(self):
+        with self._lock:
+            if self._pool:
+                return
+            load_driver()
+            if self.db_config is None:
+                from .dbconfig import DB_CONFIG
+                self.db_config = DB_CONFIG
+            self._slots = threading.BoundedSemaphore(self.maxconn)
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                self.minconn, self.maxconn,
+                connection_factory=PooledConnection,
+                options=f"-c statement_timeout={self.statement_timeout_ms}",
+                **self.db_config
+            )
+            logger.info(f"DB pool ready ({self.minconn}-{self.maxconn} connections)")
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic()-conn.last_used < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        self._init_pool()
+        if not self._slots.acquire(timeout=self.pool_wait):
+            raise RuntimeError("database busy, no free connection")
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            if not self._healthy(conn):
+                logger.warning("Dropping broken DB connection")
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            self._prepare(conn)
+            yield conn
+            conn.rollback() #read only, end the transaction
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                conn.last_used = time.monotonic()
+                self._pool.putconn(conn, close=bool(conn.closed))
+            self._slots.release()
+
+    def _prepare(self, conn):
+        if conn.prepared:
+            return
+        with conn.cursor() as cur:
+            if self.trigram is None:
+                self._detect_trigram(cur)
+            cur.execute(f"PREPARE series_search (text, text, int) AS {SEARCH_TRGM if self.trigram else SEARCH_PLAIN}")
+        conn.commit()
+        conn.prepared = True
+
+    def _detect_trigram(self, cur):
+        if self.create_indexes:
+            for statement in TRGM_INDEXES:
+                try:
+                    cur.execute(statement)
+                    cur.connection.commit()
+                except psycopg2.Error as e:
+                    cur.connection.rollback()
+                    logger.warning(f"Cannot create trigram index: {e}")
+                    break
+        cur.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'")
+        self.trigram = cur.fetchone() is not None
+        logger.info(f"Series search uses {'pg_trgm similarity' if self.trigram else 'ILIKE'}")
+
+    def search_series(self, name, limit=None):
+        """Ranked top matches for a title, list of dicts (best first)"""
+        limit = limit or self.top_n
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE series_search (%s, %s, %s)", (name, escape_like(name), limit))
+                cols = [col.name for col in cur.description]
+                return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def close(self):
+        if self._pool:
+            self._pool.closeall()
+            self._pool = None
+
+series_db = SeriesDB()
+
+def configure_db(config):
+  """Updates the shared pool settings in place, takes effect before the first query"""
+  series_db.minconn = config["minconn"]
+  series_db.maxconn = config["maxconn"]
+  series_db.statement_timeout_ms = config["statement_timeout_ms"]
+  series_db.pool_wait = config["pool_wait"]
+  series_db.create_indexes = config["create_indexes"]
+  series_db.top_n = config["top_n"]
+  return series_db
@@ -0,0 +1,312 @@
+import os
+import re
+import mmap
+import time
+import bisect
+import fnmatch
+import logging
+import tempfile
+import threading
+from array import array
+from datetime import datetime
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+FILES_CONFIG = {
+    "root": ".",                             # the folders below are relative to it
+    "folders": ["drafts", "plots", "data"],  # the model can list, read and search these...
+    "writable": ["drafts"],                  # ...and write only in these
+    "read_bytes": 4000,                      # default window of a read
+    "max_read_bytes": 16000,
+    "max_matches": 50,                       # search results per call
+    "max_file_bytes": 8*1024*1024,           # writes that would make a file bigger are refused
+    "index_ttl": 30,                         # seconds a directory listing is trusted without a rescan
+    "line_indexes": 16,                      # files whose line offsets are kept
+    "hidden": []                             # globs below root the tools never see, the bot's own state
+}
+
+class FileToolError(ValueError):
+    """Bad path or arguments, the message goes back to the model"""
+
+def _open_map(f):
+    """Read-only map of an open file, None for an empty one (mmap refuses those)"""
+    size = os.fstat(f.fileno()).st_size
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+def _char_start(mm, pos):
+    """Moves pos forward past UTF-8 continuation bytes, so a window never starts mid character"""
+    while pos < len(mm) and mm[pos] & 0xC0 == 0x80:
+        pos += 1
+    return pos
+
+def _is_text(mm):
+    return mm is None or b"\0" not in mm[:1024]
+
+class FileEngine:
+    """
+    Files the tools work on, in a few folders below root (drafts, plots, data).
+
+    Paths given by the model are resolved inside those folders, anything that escapes
+    them is refused. Reads map the file and copy only the requested window, by byte
+    offset or by lines, so a large draft costs its window and not its size; a partial
+    read says where to continue. Line offsets of recently read files are indexed once
+    per version of the file. search() runs a regex over the mapped bytes. Writes
+    overwrite atomically, append, or patch a single occurrence in place, rewriting
+    only from the patch on. Directory listings with sizes and mtimes are cached and
+    rescanned when the folder changes or index_ttl passes. Files matching the hidden
+    globs (chat histories, memory, caches kept in data) don't exist for the tools.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listings = {}              # folder -> (scanned monotonic, dir mtime_ns, {name: (size, mtime)})
+        self._lines = OrderedDict()      # (path, mtime_ns, size) -> array of line start offsets
+        self.counters = {"reads": 0, "read_bytes": 0, "searches": 0, "writes": 0, "listing_hits": 0, "listing_scans": 0}
+
+    def resolve(self, path, writing=False):
+        """(folder, absolute path) of a file, bare names go to drafts"""
+        parts = [part for part in os.path.normpath(str(path).strip()).replace("\\", "/").split("/") if part not in ("", ".")]
+        if len(parts) > 1 and parts[0] in FILES_CONFIG["folders"]:
+            folder, parts = parts[0], parts[1:]
+        else:
+            folder = "drafts"
+        if writing and folder not in FILES_CONFIG["writable"]:
+            raise FileToolError(f"{folder} is read only, files can be written in {', '.join(FILES_CONFIG['writable'])}")
+        base = os.path.realpath(os.path.join(FILES_CONFIG["root"], folder))
+        full = os.path.realpath(os.path.join(base, *parts)) if parts else base
+        if full == base or os.path.commonpath([base, full]) != base:
+            raise FileToolError(f"{path} is not a file name inside {', '.join(FILES_CONFIG['folders'])}")
+        if self.hidden(os.path.relpath(full, os.path.realpath(FILES_CONFIG["root"]))):
+            raise FileToolError(f"{path} not found")
+        return folder, full
+
+    def hidden(self, name):
+        """True for a path relative to root the tools must not show"""
+        name = os.path.normpath(name).replace("\\", "/")
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in FILES_CONFIG["hidden"])
+
+    def listing(self, folder):
+        """{name: (size, mtime)} of a folder, from the cache while it is fresh"""
+        if folder not in FILES_CONFIG["folders"]:
+            raise FileToolError(f"{folder} is not one of {', '.join(FILES_CONFIG['folders'])}")
+        path = os.path.join(FILES_CONFIG["root"], folder)
+        try:
+            dir_mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            cached = self._listings.get(folder)
+            if cached and cached[1] == dir_mtime and time.monotonic()-cached[0] < FILES_CONFIG["index_ttl"]:
+                self.counters["listing_hits"] += 1
+                return cached[2]
+        entries = {}
+        with os.scandir(path) as scan:
+            for entry in scan:
+                #links are left out, one could point anywhere outside the folder
+                if entry.is_file(follow_symlinks=False) and not self.hidden(os.path.join(folder, entry.name)):
+                    stat = entry.stat(follow_symlinks=False)
+                    entries[entry.name] = (stat.st_size, stat.st_mtime)
+        with self._lock:
+            self.counters["listing_scans"] += 1
+            self._listings[folder] = (time.monotonic(), dir_mtime, entries)
+        return entries
+
+    def list_dir(self, folder):
+        entries = self.listing(str(folder).strip().strip("/"))
+        if not entries:
+            return f"{folder} is empty"
+        lines = [f"{name}\t{size} bytes\t{datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M')}"
+                 for name, (size, mtime) in sorted(entries.items())]
+        return f"{len(entries)} files in {folder}, {sum(size for size, _ in entries.values())} bytes\n" + "\n".join(lines)
+
+    def read(self, path, offset=0, limit=0, line=0, lines=0):
+        """A window of a file: from byte offset, or lines lines from line number line"""
+        folder, full = self.resolve(path)
+        if not os.path.isfile(full):
+            raise FileToolError(f"{path} not found")
+        name = f"{folder}/{os.path.relpath(full, os.path.realpath(os.path.join(FILES_CONFIG['root'], folder)))}"
+        limit = min(int(limit) or FILES_CONFIG["read_bytes"], FILES_CONFIG["max_read_bytes"])
+        with open(full, "rb") as f:
+            mm = _open_map(f)
+            if mm is None:
+                return ""
+            with mm:
+                if not _is_text(mm):
+                    raise FileToolError(f"{name} is a binary file, {len(mm)} bytes")
+                size = len(mm)
+                if line or lines:
+                    starts = self._line_starts(full, f, mm)
+                    first = min(max(1, int(line) or 1), len(starts))
+                    last = min(len(starts), first-1+(int(lines) or len(starts)))
+                    start = starts[first-1]
+                    end = starts[last] if last < len(starts) else size
+                    more = f", continue with line={last+1}]"
+                    if end-start > limit: #window cut by limit, on a line end when there is one
+                        cut = mm.rfind(b"\n", start, start+limit)
+                        if cut >= 0:
+                            end = cut+1
+                            last = bisect.bisect_right(starts, cut)
+                            more = f", continue with line={last+1}]"
+                        else:
+                            end = _char_start(mm, start+limit)
+                            more = f", line {first} continues at offset={end}]"
+                    text = mm[start:end].decode("utf-8", errors="replace")
+                    header = None if first == 1 and end == size else f"[{name} lines {first}-{last} of {len(starts)}" + \
+                             (more if end < size else "]")
+                else:
+                    start = _char_start(mm, min(max(0, int(offset)), size))
+                    end = _char_start(mm, min(size, start+limit))
+                    text = mm[start:end].decode("utf-8", errors="replace")
+                    header = None if start == 0 and end == size else f"[{name} bytes {start}-{end} of {size}" + \
+                             (f", continue with offset={end}]" if end < size else "]")
+        with self._lock:
+            self.counters["reads"] += 1
+            self.counters["read_bytes"] += end-start
+        return f"{header}\n{text}" if header else text
+
+    def search(self, pattern, path=""):
+        """Lines matching a regex (case insensitive, plain text if it isn't a valid regex) in a file or every folder"""
+        try:
+            regex = re.compile(str(pattern).encode(), re.IGNORECASE)
+        except re.error:
+            regex = re.compile(re.escape(str(pattern).encode()), re.IGNORECASE)
+
+        if path and str(path).strip().strip("/") in FILES_CONFIG["folders"]:
+            targets = [(str(path).strip().strip("/"), name) for name in sorted(self.listing(str(path).strip().strip("/")))]
+        elif path:
+            folder, full = self.resolve(path)
+            if not os.path.isfile(full):
+                raise FileToolError(f"{path} not found")
+            targets = [(folder, os.path.relpath(full, os.path.realpath(os.path.join(FILES_CONFIG["root"], folder))))]
+        else:
+            targets = [(folder, name) for folder in FILES_CONFIG["folders"] for name in sorted(self.listing(folder))]
+
+        found, total = [], 0
+        for folder, name in targets:
+            try:
+                folder, full = self.resolve(f"{folder}/{name}")
+                with open(full, "rb") as f:
+                    mm = _open_map(f)
+                    if mm is None:
+                        continue
+                    with mm:
+                        if not _is_text(mm):
+                            continue
+                        starts = None
+                        last_line = 0
+                        for match in regex.finditer(mm):
+                            starts = starts or self._line_starts(full, f, mm)
+                            number = bisect.bisect_right(starts, match.start())
+                            if number == last_line: #one result per line
+                                continue
+                            last_line = number
+                            total += 1
+                            if len(found) < FILES_CONFIG["max_matches"]:
+                                begin = starts[number-1]
+                                end = mm.find(b"\n", begin)
+                                text = mm[begin:end if end >= 0 else len(mm)][:200].decode("utf-8", errors="replace").strip()
+                                found.append(f"{folder}/{name}:{number}: {text}")
+            except FileToolError: #a link out of the folder or to a hidden file
+                continue
+            except OSError as e:
+                logger.warning(f"📁 Cannot search {folder}/{name}: {e}")
+        with self._lock:
+            self.counters["searches"] += 1
+        if not found:
+            return f"No matches for {pattern}"
+        more = f"\n... {total-len(found)} more matches" if total > len(found) else ""
+        return "\n".join(found) + more
+
+    def write(self, path, text, mode="overwrite"):
+        """Overwrites (atomically) or appends to a file"""
+        folder, full = self.resolve(path, writing=True)
+        data = str(text).encode("utf-8")
+        if mode not in ("overwrite", "append"):
+            raise FileToolError(f"unknown mode {mode}, use overwrite or append")
+        current = os.path.getsize(full) if mode == "append" and os.path.exists(full) else 0
+        if current+len(data) > FILES_CONFIG["max_file_bytes"]:
+            raise FileToolError(f"{path} would be over {FILES_CONFIG['max_file_bytes']} bytes")
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        if mode == "append":
+            with open(full, "ab") as f:
+                f.write(data)
+        else:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(full), prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, full)
+        self._written(folder, full)
+        return current+len(data)
+
+    def patch(self, path, old, new):
+        """Replaces the single occurrence of old, the file is rewritten from there on only"""
+        folder, full = self.resolve(path, writing=True)
+        if not os.path.isfile(full):
+            raise FileToolError(f"{path} not found")
+        old, new = str(old).encode("utf-8"), str(new).encode("utf-8")
+        if not old:
+            raise FileToolError("the text to replace is empty")
+        with open(full, "r+b") as f:
+            mm = _open_map(f)
+            if mm is None:
+                raise FileToolError(f"{path} is empty")
+            with mm:
+                pos = mm.find(old)
+                if pos < 0:
+                    raise FileToolError(f"text to replace not found in {path}")
+                if mm.find(old, pos+1) >= 0:
+                    raise FileToolError(f"text to replace found {mm[:].count(old)} times in {path}, give a longer piece")
+                size = len(mm)
+                tail = mm[pos+len(old):] if len(old) != len(new) else b""
+            if size-len(old)+len(new) > FILES_CONFIG["max_file_bytes"]:
+                raise FileToolError(f"{path} would be over {FILES_CONFIG['max_file_bytes']} bytes")
+            f.seek(pos)
+            f.write(new+tail)
+            if tail or len(old) != len(new):
+                f.truncate()
+        self._written(folder, full)
+        return pos
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "listings": len(self._listings), "line_indexes": len(self._lines)}
+
+    def _line_starts(self, full, f, mm):
+        stat = os.fstat(f.fileno())
+        key = (full, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            starts = self._lines.get(key)
+            if starts is not None:
+                self._lines.move_to_end(key)
+                return starts
+        starts = array("q", [0])
+        pos = mm.find(b"\n")
+        while pos >= 0 and pos+1 < len(mm):
+            starts.append(pos+1)
+            pos = mm.find(b"\n", pos+1)
+        with self._lock:
+            for stale in [old for old in self._lines if old[0] == full]:
+                del self._lines[stale]
+            self._lines[key] = starts
+            while len(self._lines) > FILES_CONFIG["line_indexes"]:
+                self._lines.popitem(last=False)
+        return starts
+
+    def _written(self, folder, full):
+        stat = os.stat(full)
+        with self._lock:
+            self.counters["writes"] += 1
+            cached = self._listings.get(folder)
+            if cached and os.path.dirname(full) == os.path.realpath(os.path.join(FILES_CONFIG["root"], folder)):
+                cached[2][os.path.basename(full)] = (stat.st_size, stat.st_mtime)
+                self._listings[folder] = (cached[0], os.stat(os.path.dirname(full)).st_mtime_ns, cached[2])
+
+files = FileEngine()
+
+def configure_files(config):
+  """Updates the folders and limits of the file tools, cached listings are dropped"""
+  FILES_CONFIG.update(config)
+  FILES_CONFIG["hidden"] = [os.path.normpath(pattern).replace("\\", "/") for pattern in FILES_CONFIG["hidden"]]
+  files._listings.clear()
+  return files
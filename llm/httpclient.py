@@ -0,0 +1,153 @@
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Settings per outbound service, every service gets its own keep-alive pool (one per host inside)
+HTTP_CONFIG = {
+    "default": {
+        "max_connections": 20,
+        "max_keepalive": 10,
+        "keepalive_expiry": 60,
+        "connect_timeout": 5,
+        "read_timeout": 15,
+        "retries": 2,
+        "backoff": 0.5,
+        "retry_status": True,  # retry on 429/5xx too, only safe for idempotent calls
+        "follow_redirects": False,
+        "headers": {}
+    },
+    "telegram": {"read_timeout": 10, "retry_status": False},
+    "weather": {"read_timeout": 10},
+    "cluster": {"read_timeout": 10, "retries": 0, "retry_status": False},
+    "web": {"follow_redirects": True, "retries": 1, "headers": {"User-Agent": "Mozilla/5.0 (compatible; LuckyAI/1.0)"}}
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) # request never reached the server
+
+def service_config(service):
+    return {**HTTP_CONFIG["default"], **HTTP_CONFIG.get(service, {})}
+
+class ServiceStats:
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.handshake_secs = 0.0
+        self.retries = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "new_connections": self.connections,
+            "reuse_rate": round(1-self.connections/self.requests, 3) if self.requests else None,
+            "handshake_ms": int(self.handshake_secs*1000),
+            "retries": self.retries,
+            "errors": self.errors
+        }
+
+class HttpClients:
+    """
+    Shared, long-lived httpx clients for every outbound call (Telegram, weather, web).
+
+    Connections are kept alive and reused across calls instead of paying a TCP+TLS
+    handshake per request. request() adds retries with exponential backoff and jitter:
+    connection failures are always retried, 429/5xx only for services marked as
+    idempotent. New connections are counted through httpx trace events, which gives
+    the connection reuse rate per service.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._stats = {}
+
+    def client(self, service):
+        if service not in self._clients:
+            conf = service_config(service)
+            self._clients[service] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=conf["max_connections"],
+                                    max_keepalive_connections=conf["max_keepalive"],
+                                    keepalive_expiry=conf["keepalive_expiry"]),
+                timeout=httpx.Timeout(conf["read_timeout"], connect=conf["connect_timeout"]),
+                follow_redirects=conf["follow_redirects"],
+                headers=conf["headers"]
+            )
+        return self._clients[service]
+
+    def stats_for(self, service):
+        return self._stats.setdefault(service, ServiceStats())
+
+    def _trace(self, stats):
+        started = {}
+        async def trace(event, info):
+            if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                started[event] = time.perf_counter()
+            elif event == "connection.connect_tcp.complete":
+                stats.connections += 1
+                stats.handshake_secs += time.perf_counter()-started.pop("connection.connect_tcp.started", time.perf_counter())
+            elif event == "connection.start_tls.complete":
+                stats.handshake_secs += time.perf_counter()-started.pop("connection.start_tls.started", time.perf_counter())
+        return trace
+
+    async def request(self, service, method, url, **kwargs):
+        conf = service_config(service)
+        stats = self.stats_for(service)
+        attempt = 0
+        while True:
+            stats.requests += 1
+            try:
+                response = await self.client(service).request(method, url, extensions={"trace": self._trace(stats)}, **kwargs)
+                if not (conf["retry_status"] and response.status_code in RETRY_STATUS and attempt < conf["retries"]):
+                    return response
+                reason = f"status {response.status_code}"
+                await response.aclose()
+            except httpx.TransportError as e:
+                retryable = isinstance(e, CONNECT_ERRORS) or conf["retry_status"]
+                if not retryable or attempt >= conf["retries"]:
+                    stats.errors += 1
+                    raise
+                reason = type(e).__name__
+
+            attempt += 1
+            stats.retries += 1
+            delay = conf["backoff"] * 2**(attempt-1) * (0.5+random.random())
+            logger.warning(f"🔁 {service} {method} retry {attempt}/{conf['retries']} in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
+
+    async def get(self, service, url, **kwargs):
+        return await self.request(service, "GET", url, **kwargs)
+
+    async def post(self, service, url, **kwargs):
+        return await self.request(service, "POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, service, method, url, **kwargs):
+        stats = self.stats_for(service)
+        stats.requests += 1
+        try:
+            async with self.client(service).stream(method, url, extensions={"trace": self._trace(stats)}, **kwargs) as response:
+                yield response
+        except httpx.TransportError:
+            stats.errors += 1
+            raise
+
+    def stats(self):
+        return {service: stats.as_dict() for service, stats in self._stats.items()}
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+http_clients = HttpClients()
+
+def configure_http(config):
+  """Overrides the default pool settings, must run before the first request"""
+  HTTP_CONFIG["default"].update(config)
+  return http_clients
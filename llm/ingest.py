@@ -0,0 +1,201 @@
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+
+import httpx
+
+from .httpclient import http_clients
+from .metrics import metrics
+from .logs import truncated
+
+logger = logging.getLogger(__name__)
+
+INGEST_CONFIG = {
+    "path": "data/updates.db",
+    "window": 10000,       # update_ids remembered after they are done, for deduplication
+    "mode": "webhook",     # or "polling" to fetch updates with getUpdates
+    "poll_timeout": 30,    # long polling wait in seconds
+    "poll_limit": 100
+}
+
+def update_chat(update):
+    return update.get("message", {}).get("chat", {}).get("id")
+
+class UpdateLedger:
+    """
+    SQLite record of the updates the bot has seen, pending until their turn is done.
+
+    accept() inserts the update_id and reports whether it is new, so a webhook retried
+    by Telegram is processed once. Done updates are kept as a sliding window of the last
+    window ids. Updates still pending at startup were interrupted by a crash or a
+    restart and are handed back to be run again. Also keeps the getUpdates offset.
+    """
+
+    def __init__(self, path, window=10000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, body TEXT, done INTEGER DEFAULT 0, received REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._done_since_prune = 0
+
+    def accept(self, update):
+        with self.lock:
+            cursor = self.db.execute("INSERT OR IGNORE INTO updates (update_id, body, received) VALUES (?, ?, ?)",
+                                     (update["update_id"], json.dumps(update), time.time()))
+        return cursor.rowcount == 1
+
+    def done(self, update_id):
+        with self.lock:
+            self.db.execute("UPDATE updates SET done=1, body=NULL WHERE update_id=?", (update_id,))
+            self._done_since_prune += 1
+            if self._done_since_prune >= max(1, self.window//10):
+                self._done_since_prune = 0
+                self.db.execute("DELETE FROM updates WHERE done=1 AND update_id <= (SELECT max(update_id) FROM updates) - ?", (self.window,))
+
+    def pending(self):
+        with self.lock:
+            rows = self.db.execute("SELECT body FROM updates WHERE done=0 ORDER BY update_id").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def stats(self):
+        with self.lock:
+            pending, remembered = self.db.execute("SELECT sum(done=0), count(*) FROM updates").fetchone()
+        return {"pending": pending or 0, "remembered": remembered}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class UpdateIngestor:
+    """
+    Single way in for Telegram updates, from the webhook or from getUpdates polling.
+
+    Every update goes through the ledger first: duplicates are dropped, new ones are
+    queued on the chat scheduler as (update, received time) and marked done by
+    finish() once their turn ran. In polling mode a background task long-polls
+    getUpdates in batches and stores the offset, so a restart neither loses nor
+    refetches updates; it works behind NAT without a public webhook. With several
+    nodes, updates of a chat owned by another node are forwarded to it before the
+    ledger, the owner deduplicates them.
+    """
+
+    def __init__(self):
+        self.ledger = None
+        self.scheduler = None
+        self.on_busy = None
+        self.url = None
+        self.forward = None
+        self._poller = None
+
+    async def start(self, scheduler, on_busy, url, forward=None):
+        """
+        url(method) gives the Bot API url of a method. forward(chat_id, update), when
+        given, returns True if another node took the update.
+        """
+        self.scheduler = scheduler
+        self.on_busy = on_busy
+        self.url = url
+        self.forward = forward
+        self.ledger = await asyncio.to_thread(UpdateLedger, INGEST_CONFIG["path"], INGEST_CONFIG["window"])
+
+        resumed = await asyncio.to_thread(self.ledger.pending)
+        for update in resumed:
+            chat_id = update_chat(update)
+            if chat_id is None or not self.scheduler.submit(chat_id, (update, time.monotonic())):
+                await self.finish(update)
+        if resumed:
+            logger.info(f"📥 {len(resumed)} updates left unfinished by the last run resumed")
+
+        if INGEST_CONFIG["mode"] == "polling":
+            self._poller = asyncio.create_task(self.poll())
+
+    async def stop(self):
+        if self._poller:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+        if self.ledger:
+            await asyncio.to_thread(self.ledger.close)
+
+    async def ingest(self, update, local=False):
+        """
+        Returns what happened to the update: received, duplicate, busy, ignored or
+        forwarded to the node owning the chat. local skips forwarding, for updates
+        another node already forwarded here.
+        """
+        with metrics.stage("ingest"):
+            result = await self._ingest(update, local)
+        metrics.inc("bot_updates_total", result=result)
+        return result
+
+    async def _ingest(self, update, local):
+        chat_id = update_chat(update)
+        if chat_id is None:
+            logger.debug("Ignoring update without chat: %s", truncated(update))
+            return "ignored"
+
+        if self.forward and not local and await self.forward(chat_id, update):
+            return "forwarded"
+
+        if "update_id" in update and not await asyncio.to_thread(self.ledger.accept, update):
+            logger.info(f"📥 Update {update['update_id']} from {chat_id} already seen, skipped")
+            return "duplicate"
+
+        # same chat runs in order, different chats share the worker pool
+        if not self.scheduler.submit(chat_id, (update, time.monotonic())):
+            await self.finish(update)
+            self.on_busy(chat_id)
+            return "busy"
+        return "received"
+
+    async def finish(self, update):
+        if "update_id" in update:
+            await asyncio.to_thread(self.ledger.done, update["update_id"])
+
+    async def poll(self):
+        await http_clients.post("telegram", self.url("deleteWebhook")) #getUpdates is refused while a webhook is set
+        offset = await asyncio.to_thread(self.ledger.get, "offset", 0)
+        timeout = INGEST_CONFIG["poll_timeout"]
+        logger.info(f"📥 Polling getUpdates from offset {offset}")
+        while True:
+            try:
+                response = await http_clients.post("telegram", self.url("getUpdates"),
+                    json={"offset": offset, "timeout": timeout, "limit": INGEST_CONFIG["poll_limit"], "allowed_updates": ["message"]},
+                    timeout=httpx.Timeout(timeout+10, connect=5))
+                response.raise_for_status()
+                updates = response.json().get("result", [])
+            except (httpx.HTTPError, ValueError) as e:
+                metrics.inc("bot_errors_total", stage="poll")
+                logger.warning(f"📥 getUpdates failed ({type(e).__name__}: {e}), retrying in 5s")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                await self.ingest(update)
+                offset = max(offset, update["update_id"]+1)
+            if updates:
+                await asyncio.to_thread(self.ledger.put, "offset", offset)
+
+    def stats(self):
+        return {"mode": INGEST_CONFIG["mode"], **(self.ledger.stats() if self.ledger else {})}
+
+ingestor = UpdateIngestor()
+
+def configure_ingest(config):
+  """Updates the ingestion settings, must run before start()"""
+  INGEST_CONFIG.update(config)
+  return ingestor
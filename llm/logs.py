@@ -0,0 +1,142 @@
+import sys
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger(__name__)
+
+LOG_CONFIG = {
+    "level": "INFO",
+    "levels": {},          # logger name -> level, e.g. {"llm.context": "DEBUG", "httpx": "WARNING"}
+    "format": '%(levelname)s: %(name)s %(trace)s%(message)s',
+    "payload_chars": 500,  # messages, tool outputs... logged through truncated() are cut there
+    "debug_sample": 1.0,   # share of turns whose DEBUG lines are kept
+    "queue_size": 10000    # records waiting for the writer thread, the next ones are dropped
+}
+
+class truncated:
+    """
+    Lazy, size-capped view of a payload for log arguments:
+    logger.debug("reply %s", truncated(message)). Nothing is serialized unless the
+    record is actually written, and then only up to payload_chars characters.
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        limit = self.limit or LOG_CONFIG["payload_chars"]
+        if isinstance(self.value, str):
+            text = self.value
+            return text if len(text) <= limit else f"{text[:limit]}… [{len(text)-limit} more chars]"
+        # serialized piece by piece and only up to the limit, a long history isn't dumped whole to log 500 chars
+        encoder = json.JSONEncoder(ensure_ascii=False, default=lambda obj: str(obj)[:limit+1])
+        pieces, size = [], 0
+        for piece in encoder.iterencode(self.value):
+            pieces.append(piece)
+            size += len(piece)
+            if size > limit:
+                return f"{''.join(pieces)[:limit]}… [cut at {limit} chars]"
+        return "".join(pieces)
+
+class TraceFormatter(logging.Formatter):
+    """Adds %(trace)s, "[trace id] " of the turn the record was written in or nothing"""
+
+    def format(self, record):
+        trace = getattr(record, "trace_id", None)
+        record.trace = f"[{trace}] " if trace else ""
+        return super().format(record)
+
+class DebugSampler(logging.Filter):
+    """Keeps debug_sample of the DEBUG records, by turn so a kept turn has all its lines"""
+
+    def filter(self, record):
+        rate = LOG_CONFIG["debug_sample"]
+        if record.levelno > logging.DEBUG or rate >= 1:
+            return True
+        trace = getattr(record, "trace_id", None)
+        if trace:
+            return int(trace, 16) % 1000 < rate*1000
+        return random.random() < rate
+
+class LogQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread. The calling thread only merges the message with
+    its arguments (they may change afterwards), formatting and I/O happen on the writer.
+    A full queue drops the record instead of blocking the event loop.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """
+    Logging configured once at startup: every logger writes through a queue to a single
+    writer thread, levels are per logger from LOG_LEVEL/LOG_LEVELS.
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+
+    def configure(self, config):
+        LOG_CONFIG.update(config)
+        self.stop()
+
+        log_queue = queue.Queue(LOG_CONFIG["queue_size"])
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(TraceFormatter(LOG_CONFIG["format"]))
+        self.handler = LogQueueHandler(log_queue)
+        self.handler.addFilter(DebugSampler())
+        self.listener = QueueListener(log_queue, output, respect_handler_level=True)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(LOG_CONFIG["level"].upper())
+        for name, level in LOG_CONFIG["levels"].items():
+            logging.getLogger(name).setLevel(level.upper())
+
+        self.listener.start()
+        logger.info(f"📝 Logging at {LOG_CONFIG['level'].upper()}, overrides {LOG_CONFIG['levels']}, debug sample {LOG_CONFIG['debug_sample']}")
+
+    def stop(self):
+        """Writes out what is still queued"""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        if self.handler:
+            logging.getLogger().removeHandler(self.handler)
+
+    def stats(self):
+        if not self.handler:
+            return None
+        return {"queued": self.handler.queue.qsize(), "dropped": self.handler.dropped}
+
+logs = LogPipeline()
+atexit.register(logs.stop)
+
+def configure_logging(config):
+  """Replaces the root handlers by the queue, call it once before anything logs"""
+  logs.configure(config)
+  return logs
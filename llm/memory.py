@@ -0,0 +1,319 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError: #no numpy, no memory: chats send their whole history
+    np = None
+
+from .backends import router
+from .compact import STUB_TAG
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MEMORY_CONFIG = {
+    "endpoint": None,       # Ollama host(s) serving the embedding model
+    "model": None,          # embedding model, e.g. nomic-embed-text, None turns memory off
+    "folder": "data/memory",
+    "top_k": 4,             # snippets recalled per turn
+    "min_score": 0.3,       # cosine similarity below this is not worth recalling
+    "recent": 6,            # messages before the current turn sent as they are
+    "snippet_chars": 1000,  # longer messages are cut in several snippets...
+    "max_snippets": 8,      # ...up to this many per message
+    "max_chats": 64,        # indexes kept in memory
+    "batch": 32             # texts per embed request
+}
+
+MEMORY_TAG = "🗂️ Recalled from earlier in this conversation:\n"
+
+def snippet_texts(msg):
+    """Texts to embed for a message, none for system messages, tool calls and collapsed tool outputs"""
+    role = msg.get('role')
+    content = (msg.get('content') or "").strip()
+    if role == 'system' or not content or content.startswith(STUB_TAG):
+        return []
+    text = f"{msg.get('name', 'tool')} returned: {content}" if role == 'tool' else f"{role}: {content}"
+
+    size = MEMORY_CONFIG["snippet_chars"]
+    snippets = []
+    while text and len(snippets) < MEMORY_CONFIG["max_snippets"]:
+        cut = len(text) if len(text) <= size else text.rfind(" ", size//2, size)
+        cut = size if cut < 0 else cut
+        snippets.append(text[:cut])
+        text = text[cut:].lstrip()
+    return snippets
+
+def digest(text):
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+class ChatMemory:
+    """
+    Snippets of one chat and their embeddings, normalized to unit length so cosine
+    similarity is a single matrix-vector product. Rows live in a float32 matrix that
+    grows by doubling. On disk they are appended to <chat>.vec as float16 rows, the
+    snippets to <chat>.jsonl after a header line with the model and dimensions.
+    """
+
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        self.texts = []
+        self.rows = {}  # digest -> row
+        self.size = 0
+        self._matrix = None
+
+    @property
+    def vectors(self):
+        return self._matrix[:self.size]
+
+    def load(self):
+        lines = []
+        try:
+            with open(self.path+".jsonl", encoding="utf-8") as f:
+                for line in f:
+                    lines.append(json.loads(line))
+        except FileNotFoundError:
+            return self
+        except ValueError: #torn last line, what was read before it is fine
+            pass
+        if not lines or lines[0].get("model") != self.model:
+            logger.info(f"🗂️ Memory {self.path} was made with another model, starting over")
+            self.delete()
+            return self
+
+        dims = lines[0]["dims"]
+        raw = np.fromfile(self.path+".vec", dtype=np.float16) if os.path.exists(self.path+".vec") else np.empty(0, np.float16)
+        count = min(len(lines)-1, raw.size//dims)
+        self._append(lines[1:count+1], raw[:count*dims].reshape(count, dims).astype(np.float32))
+        if count != len(lines)-1 or raw.size != count*dims: #interrupted write, keep the rows both files have
+            self._rewrite(lines[0])
+        return self
+
+    def add(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if self._matrix is not None and self._matrix.shape[1] != vectors.shape[1]:
+            logger.warning(f"🗂️ Embeddings of {self.path} changed size, starting over")
+            self.delete()
+        header = {"model": self.model, "dims": vectors.shape[1]}
+        if self.size == 0:
+            self._rewrite(header)
+
+        entries = [{"text": text} for text in texts]
+        self._append(entries, vectors)
+        with open(self.path+".jsonl", "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False)+"\n" for entry in entries)
+        with open(self.path+".vec", "ab") as f:
+            f.write(vectors.astype(np.float16).tobytes())
+
+    def search(self, query, k, min_score, exclude=()):
+        """Rows of the k snippets closest to query, skipping the digests in exclude"""
+        if self.size == 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        scores = self.vectors @ (query/max(np.linalg.norm(query), 1e-12))
+        take = min(self.size, k+len(exclude))
+        best = np.argpartition(scores, self.size-take)[self.size-take:]
+        best = best[np.argsort(scores[best])[::-1]]
+        skip = {self.rows[key] for key in exclude if key in self.rows}
+        return [int(row) for row in best if scores[row] >= min_score and row not in skip][:k]
+
+    def delete(self):
+        for ext in (".jsonl", ".vec"):
+            try:
+                os.remove(self.path+ext)
+            except FileNotFoundError:
+                pass
+        self.texts = []
+        self.rows = {}
+        self.size = 0
+        self._matrix = None
+
+    def _append(self, entries, vectors):
+        needed = self.size+len(entries)
+        if self._matrix is None or needed > len(self._matrix):
+            capacity = max(64, needed, 2*len(self._matrix) if self._matrix is not None else 0)
+            grown = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            if self.size:
+                grown[:self.size] = self.vectors
+            self._matrix = grown
+        self._matrix[self.size:needed] = vectors
+        for entry in entries:
+            self.rows[digest(entry["text"])] = len(self.texts)
+            self.texts.append(entry["text"])
+        self.size = needed
+
+    def _rewrite(self, header):
+        with open(self.path+".jsonl", "w", encoding="utf-8") as f:
+            f.write(json.dumps(header)+"\n")
+            f.writelines(json.dumps({"text": text}, ensure_ascii=False)+"\n" for text in self.texts)
+        with open(self.path+".vec", "wb") as f:
+            if self.size:
+                f.write(self.vectors.astype(np.float16).tobytes())
+
+class Recall:
+    """What a turn sends instead of the whole history: head, recalled snippets, recent window"""
+
+    def __init__(self, head, start, note):
+        self.head = head    # leading system messages, prompt and summary
+        self.start = start  # first message of the recent window
+        self.note = note
+
+    def prompt(self, messages):
+        return messages[:self.head] + ([self.note] if self.note else []) + messages[self.start:]
+
+class MemoryIndex:
+    """
+    Long-term memory of the chats, so a long conversation doesn't have to be sent whole.
+
+    After every turn remember() embeds its messages and tool outputs in the background
+    with the Ollama embedding model. On the next turn recall() embeds the user message
+    and picks the top_k most similar snippets from the chat's index; the prompt is the
+    system prompt (and summary), those snippets, and the last `recent` messages before
+    the current turn, so its size stays about the same however long the chat gets.
+    Chats shorter than the window, and turns whose embedding fails, get the full
+    history as before. Stored histories are never modified.
+    """
+
+    def __init__(self):
+        self._chats = OrderedDict() # chat_id -> ChatMemory, most recent last
+        self._jobs = {}             # chat_id -> running remember()
+        self.counters = {"embedded": 0, "embed_requests": 0, "errors": 0, "recalls": 0, "recalled": 0}
+
+    @property
+    def enabled(self):
+        return np is not None and bool(MEMORY_CONFIG["model"])
+
+    def remember(self, chat_id, messages):
+        """Called after each turn with the history, before tool outputs are collapsed"""
+        if not self.enabled:
+            return
+        previous = self._jobs.get(chat_id)
+        self._jobs[chat_id] = asyncio.create_task(self._remember(chat_id, list(messages), previous))
+
+    async def recall(self, chat_id, messages):
+        """Recall for a turn whose user message ends messages, None sends the whole history"""
+        if not self.enabled:
+            return None
+        head = 0
+        while head < len(messages) and messages[head].get('role') == 'system':
+            head += 1
+        turn = len(messages)-1
+        start = max(head, turn-MEMORY_CONFIG["recent"])
+        while start < turn and messages[start].get('role') != 'user': #whole turns only, no tool output without its call
+            start += 1
+        if start <= head:
+            return None
+
+        job = self._jobs.get(chat_id)
+        if job:
+            await asyncio.gather(job, return_exceptions=True)
+        try:
+            with metrics.stage("memory_recall"):
+                chat = await self._index(chat_id, messages[head:start]) #normally done already by remember()
+                query = (await self._embed(snippet_texts(messages[turn])[:1] or [messages[turn].get('content') or ""]))[0]
+                window = {digest(text) for msg in messages[start:] for text in snippet_texts(msg)}
+                rows = chat.search(query, MEMORY_CONFIG["top_k"], MEMORY_CONFIG["min_score"], window)
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.warning(f"🗂️ Recall failed for {chat_id} ({type(e).__name__}: {e}), sending the whole history")
+            return None
+
+        self.counters["recalls"] += 1
+        self.counters["recalled"] += len(rows)
+        logger.info(f"🗂️ {len(rows)} snippets recalled for {chat_id}, {start-head} older messages left out")
+        note = {'role': 'system', 'content': MEMORY_TAG+"\n".join(f"- {chat.texts[row]}" for row in sorted(rows))} if rows else None
+        return Recall(head, start, note)
+
+    def forget(self, chat_id):
+        """Drops the memory of a chat, used on /wipe"""
+        job = self._jobs.pop(chat_id, None)
+        if job:
+            job.cancel()
+        chat = self._chats.pop(chat_id, None) or ChatMemory(self._path(chat_id), MEMORY_CONFIG["model"])
+        chat.delete()
+
+    def release(self, owned):
+        """Unloads the chats owned(chat_id) says are no longer handled here"""
+        released = [chat_id for chat_id in self._chats if not owned(chat_id) and chat_id not in self._jobs]
+        for chat_id in released:
+            del self._chats[chat_id]
+        return released
+
+    async def stop(self):
+        jobs = list(self._jobs.values()) #unfinished ones are redone by the next recall
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    def stats(self):
+        if not self.enabled:
+            return None
+        return {"chats": len(self._chats), "snippets": sum(chat.size for chat in self._chats.values()),
+                "indexing": len(self._jobs), **self.counters}
+
+    def _path(self, chat_id):
+        return os.path.join(MEMORY_CONFIG["folder"], str(chat_id))
+
+    async def _chat(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is None:
+            chat = await asyncio.to_thread(ChatMemory(self._path(chat_id), MEMORY_CONFIG["model"]).load)
+        self._chats[chat_id] = chat
+        while len(self._chats) > MEMORY_CONFIG["max_chats"]:
+            self._chats.popitem(last=False)
+        return chat
+
+    async def _embed(self, texts):
+        vectors = []
+        for i in range(0, len(texts), MEMORY_CONFIG["batch"]):
+            vectors += await router.embed(MEMORY_CONFIG, texts[i:i+MEMORY_CONFIG["batch"]])
+            self.counters["embed_requests"] += 1
+        return np.asarray(vectors, dtype=np.float32)
+
+    async def _index(self, chat_id, messages):
+        """Embeds the snippets of messages the chat's index doesn't have yet"""
+        chat = await self._chat(chat_id)
+        new = {}
+        for msg in messages:
+            for text in snippet_texts(msg):
+                key = digest(text)
+                if key not in chat.rows:
+                    new[key] = text
+        if new:
+            with metrics.stage("memory_index"):
+                vectors = await self._embed(list(new.values()))
+                await asyncio.to_thread(chat.add, list(new.values()), vectors)
+            self.counters["embedded"] += len(new)
+            logger.debug("🗂️ %s snippets of %s embedded, %s in its index", len(new), chat_id, chat.size)
+        return chat
+
+    async def _remember(self, chat_id, messages, previous):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await self._index(chat_id, messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.warning(f"🗂️ Indexing failed for {chat_id} ({type(e).__name__}: {e}), retried on its next turn")
+        finally:
+            if self._jobs.get(chat_id) is asyncio.current_task():
+                del self._jobs[chat_id]
+
+memory = MemoryIndex()
+
+def configure_memory(config):
+  """Updates the memory settings, an empty model keeps it off"""
+  MEMORY_CONFIG.update(config)
+  if memory.enabled:
+    os.makedirs(MEMORY_CONFIG["folder"], exist_ok=True)
+  elif MEMORY_CONFIG["model"]:
+    logger.warning("🗂️ numpy is not installed, long-term memory is off")
+  return memory
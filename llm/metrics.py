@@ -0,0 +1,147 @@
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1)
+
+# trace id of the turn being processed, every log record written while handling it carries it
+# (shown by the %(trace)s of the log format)
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def new_trace():
+    trace = uuid.uuid4().hex[:8]
+    trace_id.set(trace)
+    return trace
+
+_record_factory = logging.getLogRecordFactory()
+
+def _traced_record(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.trace_id = trace_id.get()
+    return record
+
+logging.setLogRecordFactory(_traced_record)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Family:
+    def __init__(self, kind, help, buckets=None):
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+        self.series = {} # sorted label items -> value or Histogram
+
+def _labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92)*2).replace(chr(34), chr(92)+chr(34))}"' for k, v in items)
+    return "{" + ",".join(escaped) + "}"
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms, rendered in the Prometheus text format
+    by /metrics. Labels are plain keyword arguments ("name" holds the model or tool),
+    labels with a None value are left out. Gauges that mirror some other component
+    (queue sizes...) are read through a callback at scrape time instead of being kept
+    up to date.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._callbacks = {}
+
+    def declare(self, name, kind, help, buckets=None):
+        self._families[name] = Family(kind, help, buckets)
+
+    def _series(self, metric, labels):
+        family = self._families[metric]
+        key = tuple(sorted((k, v) for k, v in labels.items() if v is not None))
+        if key not in family.series:
+            family.series[key] = Histogram(family.buckets) if family.kind == "histogram" else 0
+        return family, key
+
+    def inc(self, metric, value=1, **labels):
+        family, key = self._series(metric, labels)
+        family.series[key] += value
+
+    def set(self, metric, value, **labels):
+        family, key = self._series(metric, labels)
+        family.series[key] = value
+
+    def observe(self, metric, value, **labels):
+        family, key = self._series(metric, labels)
+        family.series[key].observe(value)
+
+    def gauge_callback(self, name, help, callback):
+        """callback() returns a number or a list of (labels dict, number)"""
+        self._callbacks[name] = (help, callback)
+
+    @contextmanager
+    def stage(self, stage, name=None):
+        """Times a block into bot_stage_seconds, exceptions count as errors of that stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("bot_errors_total", stage=stage, name=name)
+            raise
+        finally:
+            self.observe("bot_stage_seconds", time.perf_counter()-start, stage=stage, name=name)
+
+    def render(self):
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for key, value in family.series.items():
+                if family.kind != "histogram":
+                    lines.append(f"{name}{_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key, ('le', bound))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key, ('le', '+Inf'))} {value.count}")
+                lines.append(f"{name}_sum{_labels(key)} {round(value.sum, 6)}")
+                lines.append(f"{name}_count{_labels(key)} {value.count}")
+
+        for name, (help, callback) in self._callbacks.items():
+            try:
+                values = callback()
+            except Exception as e:
+                logger.error(f"Metric {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in (values if isinstance(values, list) else [({}, values)]):
+                lines.append(f"{name}{_labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.declare("bot_stage_seconds", "histogram", "Latency of each stage of a turn: ingest, queue, context_load, model, tool, context_save, compress, send, telegram_api, turn", LATENCY_BUCKETS)
+metrics.declare("bot_errors_total", "counter", "Failures by stage")
+metrics.declare("bot_updates_total", "counter", "Telegram updates by ingestion result")
+metrics.declare("bot_tokens_total", "counter", "Tokens processed by the models, prompt and generation")
+metrics.declare("bot_tokens_per_second", "histogram", "Model speed per request, prompt evaluation and generation", RATE_BUCKETS)
+metrics.declare("bot_context_usage_ratio", "histogram", "Prompt tokens over the configured num_ctx", RATIO_BUCKETS)
+metrics.declare("bot_model_load_seconds", "histogram", "Model load time reported by Ollama", LATENCY_BUCKETS)
@@ -1,54 +1,73 @@
-import uuid
+import time
+import asyncio
 import logging
 
-from ollama import Client, ResponseError
-from .tools import get_tools, toolcall_to_json
+from .backends import router
+from .budget import budget
+from .summarizer import summarizer
+from .toolcache import tool_cache
+from .compact import compactor
+from .memory import memory
+from .metrics import metrics
+from .logs import truncated
+from .tools import get_tools, toolcall_to_json, call_tool
 from .context import (
     init_context,
     append_context,
-    print_context,
     save_context,
-    load_context,
-    purge_context,
-    compress_context
+    load_context
 )
 
-nanosec_to_sec = 100000000
+nanosec_to_sec = 1000000000
 
-# Configure basic logging
-logging.basicConfig(
-    format='%(levelname)s: %(name)s %(message)s',
-    level=logging.DEBUG
-)
 logger = logging.getLogger(__name__)
 
-def get_client(config):
-  return Client(host=config["endpoint"])
-
 def ai_step_stats(llm_response):
     model = llm_response.model
     prompt_tokens = llm_response.prompt_eval_count
     eval_tokens = llm_response.eval_count
-    load_dur = int(llm_response.load_duration/nanosec_to_sec)
-    prompt_dur = int(llm_response.prompt_eval_duration/nanosec_to_sec)
-    gen_dur = int(llm_response.eval_duration/nanosec_to_sec)
-    total_dur = int(llm_response.total_duration/nanosec_to_sec)
+    load_dur = round((llm_response.load_duration or 0)/nanosec_to_sec, 2)
+    prompt_dur = round((llm_response.prompt_eval_duration or 0)/nanosec_to_sec, 2)
+    gen_dur = round((llm_response.eval_duration or 0)/nanosec_to_sec, 2)
+    total_dur = round((llm_response.total_duration or 0)/nanosec_to_sec, 2)
     logger.info(f"🧠 {model} loaded in {load_dur} secs\nPROMPT: {prompt_tokens} tokens in {prompt_dur} secs\nGENERATION: {eval_tokens} tokens in  {gen_dur} secs. TOTAL {total_dur}")
 
-def get_response_from_model(client, messages, config, tools):
+def record_model_stats(llm_response, num_ctx):
+    """Token counts, speed and context usage of a model answer, for /metrics"""
+    metrics.observe("bot_context_usage_ratio", (llm_response.prompt_eval_count or 0)/num_ctx)
+    if llm_response.load_duration:
+        metrics.observe("bot_model_load_seconds", llm_response.load_duration/nanosec_to_sec)
+    for phase, tokens, duration in (("prompt", llm_response.prompt_eval_count, llm_response.prompt_eval_duration),
+                                    ("generation", llm_response.eval_count, llm_response.eval_duration)):
+        metrics.inc("bot_tokens_total", tokens or 0, phase=phase)
+        if tokens and duration:
+            metrics.observe("bot_tokens_per_second", tokens/(duration/nanosec_to_sec), phase=phase)
+
+async def get_response_from_model(chat_id, messages, config, tools, on_partial=None, estimated_tokens=None):
     model = config["model"]
     stream = config["stream"]
     show_stats = config["show_stats"]
-    options = {'temperature': config["temperature"], 'num_ctx': config["num_ctx"]}
+    options = {'temperature': config["temperature"]}
+    sizes = []
+
+    def size(resident): #picked once the backend is known, to reuse the num_ctx it has loaded
+      sizes.append(budget.num_ctx(chat_id, estimated_tokens, config["num_ctx"], resident))
+      return sizes[-1]
 
     try:
-      llm_reply = client.chat(model=model, options=options, messages=messages, stream=stream, tools=tools)
+      with metrics.stage("model", model):
+        llm_reply = await router.chat(config, chat_id, on_partial, num_ctx=size, model=model, options=options, messages=messages, stream=stream, tools=tools)
     except Exception as e:
       logger.error(f"Error on model chat request!\n{e}")
+      raise
+    num_ctx = sizes[-1]
 
     prompt_tokens = int(llm_reply.prompt_eval_count)
     pct = int(prompt_tokens/int(config['num_ctx'])*100)
-    logger.info(f"🎫 Tokens {prompt_tokens}/{config['num_ctx']} {pct}%")
+    logger.info(f"🎫 Tokens {prompt_tokens}/{config['num_ctx']} {pct}% (estimated {estimated_tokens}, num_ctx {num_ctx})")
+    budget.learn_num_ctx(chat_id, estimated_tokens, prompt_tokens, num_ctx, config["num_ctx"])
+    budget.calibrate(estimated_tokens, prompt_tokens)
+    record_model_stats(llm_reply, num_ctx)
 
     if show_stats:
         ai_step_stats(llm_reply)
@@ -59,34 +78,63 @@ def get_response_from_model(client, messages, config, tools):
     else:
       return llm_reply.message.content, None, pct
 
-def run_tools(available_functions, requested_tools):
-    tool_messages = []
-
+TOOL_CONFIG = {"timeout": 60, "concurrency": 8}
+_tool_slots = None
+
+def configure_tool_runner(config):
+  global _tool_slots
+  TOOL_CONFIG.update(config)
+  _tool_slots = None
+
+async def run_tool(available_functions, tool):
+    global _tool_slots
+    if _tool_slots is None: #global limit, shared by every chat
+      _tool_slots = asyncio.Semaphore(TOOL_CONFIG["concurrency"])
+
+    tool_id   = tool["id"]
+    func = tool["function"]
+    tool_name = func["name"]
+    tool_args = func["arguments"]
+
+    func_call = available_functions.get(tool_name)
+    if not func_call:
+      logger.error(f"Function {tool_name} not found")
+      return {'role': 'tool', 'content': 'tool not found!', 'name': tool_name, 'tool_call_id': tool_id}
+
+    async with _tool_slots:
+      logger.info("🛠️ TOOL %s(%s)", tool_name, truncated(tool_args))
+      start = time.perf_counter()
+      try:
+        function_result = await asyncio.wait_for(call_tool(func_call, **tool_args), TOOL_CONFIG["timeout"])
+        content = compactor.format(tool_name, function_result)
+      except asyncio.TimeoutError:
+        content = f"Error, {tool_name} timed out after {TOOL_CONFIG['timeout']} secs"
+        metrics.inc("bot_errors_total", stage="tool", name=tool_name)
+      except asyncio.CancelledError:
+        if asyncio.current_task().cancelling(): #the turn itself is being cancelled
+          raise
+        content = f"Error, {tool_name} was cancelled" #a task the tool depends on was, not this turn
+        metrics.inc("bot_errors_total", stage="tool", name=tool_name)
+      except Exception as e:
+        content = str(e)
+        metrics.inc("bot_errors_total", stage="tool", name=tool_name)
+      elapsed = time.perf_counter()-start
+      metrics.observe("bot_stage_seconds", elapsed, stage="tool", name=tool_name)
+      logger.info(f"🛠️ TOOL {tool_name} done in {int(elapsed*1000)} ms")
+
+    return {'role': 'tool', 'content': content, 'name': tool_name, 'tool_call_id': tool_id}
+
+async def run_tools(available_functions, requested_tools):
+    """Runs the requested tools concurrently, results keep the order of the tool calls"""
     if requested_tools:
-      for tool in requested_tools:
-
-        tool_id   = tool["id"]
-        func = tool["function"]
-        tool_name = func["name"]
-        tool_args = func["arguments"]
-
-        func_call = available_functions.get(tool_name)
-        if func_call:
-          logger.info(f"🛠️ TOOL {tool_name}({tool_args})")
-          try:
-            function_result = func_call(**tool_args)
-            tool_messages.append({'role': 'tool', 'content': str(function_result), 'name': tool_name, 'tool_call_id': tool_id})
-          except Exception as e:
-            tool_messages.append({'role': 'tool', 'content': str(e), 'name': tool_name, 'tool_call_id': tool_id})
-        else:
-          logger.error('Function', tool_name, 'not found')
-          tool_messages.append({'role': 'tool', 'content': 'tool not found!', 'name': tool_name, 'tool_call_id': tool_id})
-
-      logger.debug(f"{tool_messages}")
+      start = time.perf_counter()
+      tool_messages = list(await asyncio.gather(*[run_tool(available_functions, tool) for tool in requested_tools]))
+      logger.info(f"🛠️ {len(tool_messages)} tools done in {int((time.perf_counter()-start)*1000)} ms")
+      logger.debug("%s", truncated(tool_messages))
       return tool_messages
     else:
       logger.info(' 🙅‍♂️ NO TOOLS, text only')
-      return tool_messages
+      return []
 
 def tool_list_info(tools):
     if tools and tools!=[]:
@@ -94,38 +142,59 @@ def tool_list_info(tools):
     else:
       return ""
 
-def interact_with_ai(user_request, chat_id, config, compress_config):
-    client = get_client(config)
+async def interact_with_ai(user_request, chat_id, config, compress_config, progress=None):
+    """
+    Runs a full conversation turn. When progress is given (streaming mode) it is awaited
+    with the text to show to the user so far: tool captions plus the partial reply.
+    """
     tool_captions = ""
 
-    history = load_context(chat_id)
+    async def on_partial(text):
+      await progress(tool_captions+text)
+
+    with metrics.stage("context_load"):
+      history = await asyncio.to_thread(load_context, chat_id)
     if history:
-      messages=history
+      messages=summarizer.apply(chat_id, history) #background summary ready? swap it in
     else:
       messages=init_context(config["system_prompt"])
 
     messages = append_context(messages, "user", user_request)
+    recall = await memory.recall(chat_id, messages) #long chats: recalled snippets and a recent window, not the whole history
 
     tool_iter = 0
     tool_max_iter = config["max_iter"]
     tools, available_functions = get_tools()
+    available_functions = tool_cache.wrap_all(available_functions)
+    tools_tokens = budget.tools_tokens(tools)
 
     while tool_iter < tool_max_iter:
       tool_iter+=1
 
-      llm_response, tool_calls, context_usage = get_response_from_model(client, messages, config, tools)
-      if context_usage > 95:
-        messages = compress_context(messages, config["system_prompt"], compress_config)
+      # size the prompt before paying for it, not after
+      prompt = recall.prompt(messages) if recall else messages
+      request_messages, estimated_tokens = budget.fit(chat_id, prompt, config["num_ctx"], tools_tokens)
+
+      try:
+        llm_response, tool_calls, context_usage = await get_response_from_model(chat_id, request_messages, config, tools, on_partial if progress else None, estimated_tokens)
+      except Exception:
+        return "⚠️ The model is not available right now, please try again later" #history not saved, the turn can be repeated
 
       messages = append_context(messages, "assistant", llm_response, tool_calls)
-      tool_messages = run_tools(available_functions, tool_calls)
+      tool_messages = await run_tools(available_functions, tool_calls)
 
       if tool_messages!=[]: #loop, tools used
         messages = messages+tool_messages
         #messages = purge_context(messages, config["context_keep"], config["context_max"])
         tool_captions+=tool_list_info(tool_calls)+"\n"
+        if progress:
+          await progress(tool_captions)
       else: #talk to user, loop finished!
-        save_context(chat_id, messages)
+        memory.remember(chat_id, messages) #tool outputs are embedded before they are collapsed
+        messages = compactor.collapse(messages) #answered turns don't need the full tool outputs anymore
+        with metrics.stage("context_save"):
+          await asyncio.to_thread(save_context, chat_id, messages)
+        summarizer.touch(chat_id, messages, budget.usage(chat_id, messages, config["num_ctx"], tools_tokens), compress_config)
         return f"🧠 Context usage {context_usage}%\n"+tool_captions+messages[-1]['content']
 
     return "Max tool iterations triggered!"
@@ -5,11 +5,8 @@ from ollama import Client
 import os
 from os.path import abspath
 
-# Configure basic logging
-logging.basicConfig(
-    format='%(levelname)s: %(name)s %(message)s',
-    level=logging.DEBUG
-)
+from . import tools
+
 logger = logging.getLogger(__name__)
 
 def save_user_preferences(filename, text):
@@ -24,16 +21,7 @@ def save_user_preferences(filename, text):
     Returns:
         str: Success or error message
     """
-    logger.info(f"Written to {filename}")
-    try:
-        with open(f"drafts/{filename}", "w") as f:
-            f.write(text)
-
-        return "Success, data written to {filename}"
-
-    except Exception as e:
-        logger.error(f"Cannot write to {filename}!\n{str(e)}")
-        return "Error, cannot write to {filename}"
+    return tools.write_file(filename, text)
 
 
 def read_file(filename):
@@ -47,10 +35,4 @@ def read_file(filename):
         str: File contents as string if successful, error message if file doesn't
         exist or can't be read.
     """
-    logger.info(f"Read from {filename}")
-    try:
-        f = open(f"drafts/{filename}","r")
-        return f.read()
-    except Exception as e:
-        logger.error(f"Cannot read from {filename}!\n{str(e)}")
-        return f"Error, cannot read from {filename}"
\ No newline at end of file
+    return tools.read_file(filename)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import re
+import json
+import types
+import typing
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", tuple: "array", dict: "object"}
+
+def _parse_docstring(doc):
+    """(description, {arg: description}) of a Google style docstring"""
+    description, args = [], {}
+    section, last = "description", None
+    for line in (doc or "").splitlines():
+        line = line.strip()
+        lowered = line.lower()
+        if lowered.startswith("args:"):
+            section = "args"
+        elif lowered.startswith(("returns:", "yields:", "raises:")):
+            section = None
+        elif section == "description":
+            description.append(line)
+        elif section == "args" and line:
+            match = re.match(r"(\w+)\s*(?:\([^)]*\))?\s*:\s*(.*)", line)
+            if match:
+                last = match.group(1)
+                args[last] = match.group(2)
+            elif last:
+                args[last] += " " + line
+    return "\n".join(description).strip(), args
+
+def _json_types(annotation):
+    """JSON schema types of an annotation, Optional ones include null"""
+    if annotation is inspect.Parameter.empty:
+        return ["string"]
+    options = typing.get_args(annotation) if typing.get_origin(annotation) in (typing.Union, types.UnionType) else [annotation]
+    found = []
+    for option in options:
+        name = "null" if option is type(None) else JSON_TYPES.get(typing.get_origin(option) or option, "string")
+        if name not in found:
+            found.append(name)
+    return found
+
+def function_schema(func):
+    """Ollama tool schema of a function, from its signature and docstring"""
+    description, docs = _parse_docstring(inspect.getdoc(func))
+    properties, required = {}, []
+    for name, param in inspect.signature(func).parameters.items():
+        found = _json_types(param.annotation)
+        if param.default is inspect.Parameter.empty and "null" not in found:
+            required.append(name)
+        properties[name] = {"type": ", ".join(kind for kind in found if kind != "null") or "string", "description": docs.get(name, "")}
+    parameters = {"type": "object", "properties": properties}
+    if required:
+        parameters["required"] = required
+    return {"type": "function", "function": {"name": func.__name__, "description": description, "parameters": parameters}}
+
+class ToolRegistry:
+    """
+    Tools the model can call, registered with @tool_registry.register.
+
+    The JSON schema of a tool is built once from its signature and docstring, the first
+    time it is needed, instead of by the ollama client on every chat request. get_tools()
+    returns the same schemas and functions on every turn until the set of enabled tools
+    changes. Tools can be turned on or off per deployment (TOOLS_ENABLED/TOOLS_DISABLED),
+    a disabled tool isn't sent in the prompt at all.
+    """
+
+    def __init__(self):
+        self._functions = {}
+        self._schemas = {}
+        self.enabled = None # None means every registered tool
+        self.disabled = set()
+        self._active = None
+
+    def register(self, func):
+        self._functions[func.__name__] = func
+        self._active = None
+        return func
+
+    def schema(self, name):
+        if name not in self._schemas:
+            self._schemas[name] = function_schema(self._functions[name])
+        return self._schemas[name]
+
+    def names(self):
+        return [name for name in self._functions
+                if (self.enabled is None or name in self.enabled) and name not in self.disabled]
+
+    def get_tools(self):
+        """(schemas to send to the model, name -> function), built once"""
+        if self._active is None:
+            names = self.names()
+            unknown = ((self.enabled or set()) | self.disabled) - set(self._functions)
+            if unknown:
+                logger.warning(f"🧰 Unknown tools in TOOLS_ENABLED/TOOLS_DISABLED: {sorted(unknown)}")
+            self._active = ([self.schema(name) for name in names], {name: self._functions[name] for name in names})
+            logger.info(f"🧰 {len(names)} tools enabled, {len(json.dumps(self._active[0]))} chars of schemas: {names}")
+        return self._active
+
+    def configure(self, enabled=None, disabled=()):
+        self.enabled = set(enabled) if enabled else None
+        self.disabled = set(disabled)
+        self._active = None
+
+tool_registry = ToolRegistry()
+
+def configure_tools(config):
+  """Selects the tools of this deployment, takes effect on the next turn"""
+  tool_registry.configure(config["enabled"], config["disabled"])
+  return tool_registry
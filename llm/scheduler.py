@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class ChatScheduler:
+    """
+    Per-chat ordered work queue with a bounded worker pool.
+
+    Every chat_id owns a FIFO of pending jobs, so two messages from the same chat are
+    never processed at the same time (no lost turns on load/save context).
+    Chats with pending work take turns in a round-robin ready queue: a worker runs a
+    single job of a chat and then moves that chat to the back of the line, so heavy
+    users can't starve everyone else. The number of workers bounds how many
+    conversations hit the model backend at once: a job runs only with one of the
+    workers slots. A job waiting on something else (another node) through suspend()
+    lends its slot to a spare worker meanwhile, and gets a slot back before any job
+    that hasn't started yet.
+    """
+
+    def __init__(self, handler, workers=4, chat_queue_max=5, total_queue_max=100):
+        """
+        :param handler: coroutine function called with (chat_id, job) for every job.
+        :param workers: global concurrency, size it to the Ollama backend capacity.
+        :param chat_queue_max: pending jobs allowed per chat before it is reported busy.
+        :param total_queue_max: pending jobs allowed across all chats.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.chat_queue_max = chat_queue_max
+        self.total_queue_max = total_queue_max
+
+        self._queues = {}          # chat_id -> deque of pending jobs
+        self._ready = deque()      # round-robin order of chats with pending jobs
+        self._scheduled = set()    # chats either in _ready or being run by a worker
+        self._pending = 0
+        self._wakeup = None
+        self._tasks = []
+        self._suspended = 0        # jobs waiting in suspend(), a spare worker runs for each
+        self._free = workers       # slots not held by a running job
+        self._slot_waiters = deque()
+
+    def submit(self, chat_id, job):
+        """Queues a job for a chat. Returns False when the chat or the bot is too busy."""
+        queued = len(self._queues.get(chat_id, ()))
+        if queued >= self.chat_queue_max or self._pending >= self.total_queue_max:
+            logger.warning(f"🚦 Queue full for {chat_id} ({queued} queued for chat, {self._pending} total)")
+            return False
+
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self._pending += 1
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.append(chat_id)
+            self._notify()
+        return True
+
+    def busy(self, chat_id):
+        """True while a chat has a job queued or running"""
+        return chat_id in self._scheduled
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "active_chats": len(self._scheduled),
+            "ready_chats": len(self._ready)
+        }
+
+    def _notify(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"🚦 Scheduler started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"🚦 Scheduler stopped, {self._pending} jobs dropped")
+
+    async def _next_chat(self):
+        while not self._ready:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self._ready.popleft()
+
+    async def _acquire(self, first=False):
+        """Waits for a slot, resumed jobs (first) go ahead of the ones that haven't started"""
+        if self._free and not self._slot_waiters:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        if first:
+            self._slot_waiters.appendleft(waiter)
+        else:
+            self._slot_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self._slot_waiters:
+                self._slot_waiters.remove(waiter)
+            elif not waiter.cancelled(): #got the slot as it was cancelled, hand it on
+                self._release()
+            raise
+
+    def _release(self):
+        while self._slot_waiters:
+            waiter = self._slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+    async def suspend(self, awaitable):
+        """Awaits something a running job depends on, a spare worker uses its slot meanwhile"""
+        self._suspended += 1
+        self._tasks.append(asyncio.create_task(self._worker(f"spare-{len(self._tasks)}")))
+        self._release()
+        try:
+            return await awaitable
+        finally:
+            self._suspended -= 1
+            try:
+                await self._acquire(first=True)
+            except asyncio.CancelledError:
+                self._free -= 1 #stopping, the worker gives a slot back as it unwinds
+                raise
+
+    async def _worker(self, worker_id):
+        while True:
+            if len(self._tasks) > self.workers + self._suspended: #a job resumed, the pool shrinks back
+                self._tasks.remove(asyncio.current_task())
+                return
+            chat_id = await self._next_chat()
+            queue = self._queues[chat_id]
+            job = queue.popleft()
+            self._pending -= 1
+
+            try:
+                await self._acquire()
+            except asyncio.CancelledError:
+                queue.appendleft(job) #stopping, the job stays pending
+                self._pending += 1
+                raise
+            try:
+                await self.handler(chat_id, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed on chat {chat_id}: {e}")
+            finally:
+                self._release()
+                if queue: #more work for this chat, back to the end of the line
+                    self._ready.append(chat_id)
+                    self._notify()
+                else:
+                    self._scheduled.discard(chat_id)
+                    del self._queues[chat_id]
@@ -0,0 +1,269 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+## CHAT HISTORY STORAGE ENGINES
+# Every store exposes load(key) -> list|None, save(key, messages), delete(key) and
+# forget(key=None). save() gets the full history of the chat, the append-only engines
+# detect which messages are new since the last load/save and only write those.
+# forget() drops that in-process state, for chats another process may have written.
+# The journal and sqlite engines also refuse to overwrite a history that changed since
+# this process last read or wrote it (StaleHistoryError), so a node that lost a chat
+# can't clobber the turns of its new owner.
+
+class StaleHistoryError(RuntimeError):
+    """The stored history was written by someone else since it was loaded here"""
+
+def _dump(msg):
+    return json.dumps(msg, ensure_ascii=False)
+
+def _marks(messages, count):
+    """
+    Cheap fingerprint of the first count messages: the head (system prompt and summary),
+    the last one, and the total content length, so messages rewritten in the middle
+    (tool outputs collapsed to stubs) make the next save a compaction
+    """
+    if count == 0:
+        return None
+    chars = sum(len(msg.get('content') or "") for msg in messages[:count])
+    return (_dump(messages[:min(2, count)]), _dump(messages[count-1]), chars)
+
+def _ident(path):
+    """Identity of a journal file as this process left it, None when there is none"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size)
+
+def _is_append(messages, count, marks):
+    """True when messages only grew since the fingerprint was taken"""
+    return count <= len(messages) and _marks(messages, count) == marks
+
+class JsonStore:
+    """Legacy layout: data/{key}.json holds the whole history, rewritten on every save."""
+
+    def __init__(self, folder="data"):
+        self.folder = folder
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.loads(f.read())
+
+    def save(self, key, messages):
+        path = self.path(key)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(messages))
+        os.replace(tmp, path) #never leave a half written history behind
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def forget(self, key=None):
+        pass
+
+class JournalStore:
+    """
+    Append-only journal: data/{key}.jsonl holds one message per line.
+    A normal turn appends just its new messages. When the history was rewritten
+    (compression, summaries) the journal is compacted: the full history goes to a temp
+    file that atomically replaces the old one. A torn last line left by a crash is
+    dropped on load. Legacy data/{key}.json files are migrated on first load.
+    """
+
+    def __init__(self, folder="data", fsync=True):
+        self.folder = folder
+        self.fsync = fsync
+        self.legacy = JsonStore(folder)
+        self._persisted = {} # key -> (messages on disk, fingerprint of them, file identity)
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.jsonl")
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            messages = self.legacy.load(key)
+            if messages is not None:
+                logger.info(f"Migrating legacy history for {key} to journal")
+                self._compact(key, messages)
+                self.legacy.delete(key)
+            else:
+                self._persisted[key] = (0, None, None)
+            return messages
+
+        with open(path, "rb") as f:
+            data = f.read()
+        valid_bytes = data.rfind(b"\n")+1
+        try: #fast path, parse every complete line in one go
+            messages = json.loads(b"[" + data[:valid_bytes].rstrip(b"\n").replace(b"\n", b",") + b"]")
+        except ValueError:
+            messages, valid_bytes = self._salvage(data)
+
+        if valid_bytes < len(data):
+            logger.warning(f"Dropping torn tail of journal for {key}")
+            with open(path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+        self._persisted[key] = (len(messages), _marks(messages, len(messages)), _ident(path))
+        return messages
+
+    def _salvage(self, data):
+        """Keeps the messages before the first broken line"""
+        messages = []
+        valid_bytes = 0
+        for raw in data.splitlines(keepends=True):
+            if not raw.endswith(b"\n"):
+                break
+            try:
+                messages.append(json.loads(raw))
+            except ValueError:
+                break
+            valid_bytes += len(raw)
+        return messages, valid_bytes
+
+    def save(self, key, messages):
+        if key not in self._persisted:
+            self.load(key)
+        count, marks, ident = self._persisted[key]
+        if _ident(self.path(key)) != ident:
+            self._persisted.pop(key, None)
+            raise StaleHistoryError(f"Journal for {key} changed since it was loaded")
+
+        if _is_append(messages, count, marks):
+            self._append(key, messages)
+        else:
+            self._compact(key, messages)
+
+    def delete(self, key):
+        self._persisted.pop(key, None)
+        self.legacy.delete(key)
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def forget(self, key=None):
+        if key is None:
+            self._persisted.clear()
+        else:
+            self._persisted.pop(key, None)
+
+    def _write(self, f, lines):
+        f.write("".join(f"{line}\n" for line in lines))
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _append(self, key, messages):
+        count = self._persisted[key][0]
+        if count == len(messages):
+            return
+        lines = [_dump(msg) for msg in messages[count:]]
+        with open(self.path(key), "a") as f:
+            self._write(f, lines)
+        self._persisted[key] = (len(messages), _marks(messages, len(messages)), _ident(self.path(key)))
+
+    def _compact(self, key, messages):
+        path = self.path(key)
+        tmp = f"{path}.tmp"
+        lines = [_dump(msg) for msg in messages]
+        with open(tmp, "w") as f:
+            self._write(f, lines)
+        os.replace(tmp, path)
+        self._persisted[key] = (len(messages), _marks(messages, len(messages)), _ident(path))
+
+class SqliteStore:
+    """
+    Single SQLite database in WAL mode, one row per message.
+    Same append detection as the journal, rewrites happen inside one transaction.
+    Every chat has a version bumped by each save, a save expecting another version fails.
+    """
+
+    def __init__(self, path="data/context.db"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (chat TEXT, seq INTEGER, body TEXT, PRIMARY KEY (chat, seq))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (chat TEXT PRIMARY KEY, version INTEGER)")
+        self._persisted = {}
+
+    def _version(self, key):
+        row = self.db.execute("SELECT version FROM versions WHERE chat=?", (str(key),)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, key):
+        with self.lock:
+            self.db.execute("BEGIN")
+            rows = self.db.execute("SELECT body FROM messages WHERE chat=? ORDER BY seq", (str(key),)).fetchall()
+            version = self._version(key)
+            self.db.execute("COMMIT")
+        messages = [json.loads(row[0]) for row in rows]
+        self._persisted[key] = (len(messages), _marks(messages, len(messages)), version)
+        return messages or None
+
+    def save(self, key, messages):
+        if key not in self._persisted:
+            self.load(key)
+        count, marks, version = self._persisted[key]
+        start = count if _is_append(messages, count, marks) else 0
+        if start and start == len(messages):
+            return
+
+        lines = [_dump(msg) for msg in messages[start:]]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._version(key) != version:
+                    self._persisted.pop(key, None)
+                    raise StaleHistoryError(f"History of {key} changed since it was loaded")
+                self.db.execute("INSERT INTO versions (chat, version) VALUES (?, 1) ON CONFLICT(chat) DO UPDATE SET version=version+1",
+                                (str(key),))
+                if start == 0:
+                    self.db.execute("DELETE FROM messages WHERE chat=?", (str(key),))
+                self.db.executemany("INSERT INTO messages (chat, seq, body) VALUES (?, ?, ?)",
+                                    [(str(key), start+i, line) for i, line in enumerate(lines)])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        self._persisted[key] = (len(messages), _marks(messages, len(messages)), version+1)
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE chat=?", (str(key),))
+            self.db.execute("DELETE FROM versions WHERE chat=?", (str(key),))
+        self._persisted.pop(key, None)
+
+    def forget(self, key=None):
+        if key is None:
+            self._persisted.clear()
+        else:
+            self._persisted.pop(key, None)
+
+STORES = {
+    "json": lambda folder: JsonStore(folder),
+    "journal": lambda folder: JournalStore(folder),
+    "sqlite": lambda folder: SqliteStore(os.path.join(folder, "context.db"))
+}
+
+def register_store(engine, factory):
+    """Adds a storage engine, factory(folder) returns the store. Used for stores shared by several nodes"""
+    STORES[engine] = factory
+
+def make_store(engine="journal", folder="data"):
+    if engine not in STORES:
+        raise ValueError(f"Unknown context store '{engine}', pick one of {', '.join(STORES)}")
+    logger.info(f"Context store: {engine} in {folder}")
+    return STORES[engine](folder)
@@ -0,0 +1,33 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+async def chat(client, on_partial=None, **kwargs):
+    """
+    Runs client.chat and always returns a single ChatResponse.
+    With stream=True the chunks are put back together: content is concatenated,
+    tool_calls are collected as soon as they show up, and the stats come from the
+    final (done) chunk. on_partial(text) is awaited with the text so far while the
+    model is still talking to the user, it stops once a tool call is detected.
+    """
+    if not kwargs.get("stream"):
+        return await client.chat(**kwargs)
+
+    content = ""
+    tool_calls = []
+    last_chunk = None
+
+    async for chunk in await client.chat(**kwargs):
+        last_chunk = chunk
+        if chunk.message.tool_calls:
+            if not tool_calls:
+                logger.debug("Tool call detected mid-stream after %s chars", len(content))
+            tool_calls.extend(chunk.message.tool_calls)
+        if chunk.message.content:
+            content += chunk.message.content
+            if on_partial and not tool_calls:
+                await on_partial(content)
+
+    last_chunk.message.content = content
+    last_chunk.message.tool_calls = tool_calls or None
+    return last_chunk
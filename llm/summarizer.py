@@ -0,0 +1,137 @@
+import asyncio
+import logging
+
+from .context import compress_context
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_TAG = "📝 Summary of the earlier conversation:\n"
+
+def is_summary(msg):
+    return msg.get('role') == 'system' and (msg.get('content') or "").startswith(SUMMARY_TAG)
+
+class SummaryResult:
+    def __init__(self, start, upto, first, last, text):
+        self.start = start  # first summarized message
+        self.upto = upto    # first message kept as is
+        self.first = first
+        self.last = last
+        self.text = text
+
+class RollingSummarizer:
+    """
+    Keeps a rolling summary per chat, computed in the background with the CT model.
+
+    After every turn touch() is called with a snapshot of the history. Once the chat
+    has been idle for idle_after seconds, or right away when the history uses more than
+    threshold % of num_ctx, the messages since the last summary (all but the recent
+    window) are folded into it. The result waits until the next turn of that chat, where
+    apply() swaps it in: [system prompt, summary, recent messages]. Swaps happen on the
+    chat's own worker, so they never race with a turn.
+    """
+
+    def __init__(self, idle_after=300, threshold=60, keep_recent=6, min_messages=8, concurrency=1):
+        self.idle_after = idle_after
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.min_messages = min_messages
+        self.concurrency = concurrency
+        self._slots = None
+        self._timers = {}   # chat_id -> pending idle timer
+        self._jobs = {}     # chat_id -> running summarization
+        self._results = {}  # chat_id -> SummaryResult waiting for the next turn
+
+    def touch(self, chat_id, messages, usage, config):
+        """Called after each turn with the saved history and its context usage %"""
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        if chat_id in self._jobs:
+            return
+
+        if usage >= self.threshold:
+            logger.info(f"📝 Context of {chat_id} at {usage}%, summarizing now")
+            self._start(chat_id, list(messages), config)
+        else:
+            self._timers[chat_id] = asyncio.create_task(self._idle(chat_id, list(messages), config))
+
+    def apply(self, chat_id, messages):
+        """Swaps a finished summary into the history, returns the history to use"""
+        result = self._results.pop(chat_id, None)
+        if not result:
+            return messages
+
+        if len(messages) < result.upto or messages[result.start] != result.first or messages[result.upto-1] != result.last:
+            logger.warning(f"📝 History of {chat_id} changed under the summary, discarding it")
+            return messages
+
+        summary = {'role': 'system', 'content': SUMMARY_TAG+result.text}
+        logger.info(f"📝 Summary applied for {chat_id}: {result.upto-result.start} messages folded")
+        return [messages[0], summary] + messages[result.upto:]
+
+    def forget(self, chat_id):
+        """Drops everything pending for a chat, used on /wipe"""
+        for tasks in (self._timers, self._jobs):
+            task = tasks.pop(chat_id, None)
+            if task:
+                task.cancel()
+        self._results.pop(chat_id, None)
+
+    def chats(self):
+        return set(self._timers) | set(self._jobs) | set(self._results)
+
+    async def stop(self):
+        tasks = list(self._timers.values()) + list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {"idle_timers": len(self._timers), "running": len(self._jobs), "ready": len(self._results)}
+
+    def _cut(self, messages):
+        """Range to fold into the summary, it ends right before a user message to keep turns whole"""
+        start = 2 if len(messages) > 1 and is_summary(messages[1]) else 1
+        for upto in range(len(messages)-max(1, self.keep_recent), start, -1):
+            if messages[upto].get('role') == 'user':
+                if upto-start >= self.min_messages:
+                    return start, upto
+                break
+        return None
+
+    async def _idle(self, chat_id, messages, config):
+        await asyncio.sleep(self.idle_after)
+        self._timers.pop(chat_id, None)
+        self._start(chat_id, messages, config)
+
+    def _start(self, chat_id, messages, config):
+        if self._cut(messages):
+            self._jobs[chat_id] = asyncio.create_task(self._summarize(chat_id, messages, config))
+
+    async def _summarize(self, chat_id, messages, config):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        start, upto = self._cut(messages)
+        previous = messages[1]['content'][len(SUMMARY_TAG):] if start == 2 else None
+        try:
+            async with self._slots:
+                text = await compress_context(messages[start:upto], previous, config)
+            if text:
+                self._results[chat_id] = SummaryResult(1, upto, messages[1], messages[upto-1], text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"📝 Summarization failed for {chat_id}: {e}")
+        finally:
+            self._jobs.pop(chat_id, None)
+
+summarizer = RollingSummarizer()
+
+def configure_summarizer(config):
+  """Updates the shared summarizer in place, modules keep their reference to it"""
+  summarizer.idle_after = config["idle_after"]
+  summarizer.threshold = config["threshold"]
+  summarizer.keep_recent = config["keep_recent"]
+  summarizer.min_messages = config["min_messages"]
+  summarizer.concurrency = config["concurrency"]
+  return summarizer
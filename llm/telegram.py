@@ -0,0 +1,372 @@
+import time
+import asyncio
+import logging
+
+import httpx
+
+from .httpclient import http_clients
+from .metrics import metrics, trace_id
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096 # UTF-16 code units, counted by Telegram after parsing
+ESCAPED_CHARS = "_*[`"
+
+def escape_telegram_markdown(text):
+    return text.replace("_", "\\_").replace("*", "\\*").replace("[", "\\[").replace("`", "\\`");
+
+def _units(char):
+    return (2 if ord(char) > 0xFFFF else 1) + (1 if char in ESCAPED_CHARS else 0)
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Cuts raw text in chunks whose escaped form fits in one message, at a paragraph,
+    line or word end when there is one in the second half of the chunk. Chunks are
+    escaped one by one afterwards, so a cut never separates an escape from its character.
+    """
+    chunks = []
+    while text:
+        used, end = 0, len(text)
+        for i, char in enumerate(text):
+            used += _units(char)
+            if used > limit:
+                end = i
+                break
+        if end == len(text):
+            chunks.append(text)
+            break
+
+        cut = end
+        for separator in ("\n\n", "\n", " "):
+            pos = text.rfind(separator, 0, end)
+            if pos > end//2:
+                cut = pos
+                break
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    return [chunk for chunk in chunks if chunk]
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now-self.updated)*self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1-self.tokens)/self.rate)
+
+    def pause(self, secs):
+        """Nothing goes out for secs, used when Telegram answers 429 with retry_after"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - secs*self.rate
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+class ChatLane:
+    """Per chat limiter plus a lock that keeps the replies of a chat in order"""
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class Delivery:
+    def __init__(self, chat_id, chunks, on_done=None, sent=True):
+        self.chat_id = chat_id
+        self.chunks = chunks
+        self.on_done = on_done # awaited with True once sent, False when it failed
+        self.sent = sent       # False when an earlier part of the reply, sent outside the queue, failed
+        self.queued_at = time.monotonic()
+        self.trace = trace_id.get()
+
+class Outbox:
+    """
+    Outbound Telegram delivery, every message the bot sends goes through here.
+
+    send() splits a reply to fit the 4096 character limit and puts it in a bounded
+    queue, it never waits on Telegram so the LLM workers move on to the next turn.
+    A few sender tasks drain the queue under a global token bucket (Telegram allows
+    about 30 messages per second) and a per chat one, chunks of a reply and replies of
+    a chat keep their order. 429 answers are retried after the retry_after Telegram
+    asks for, 5xx and network errors with backoff, and a message Telegram cannot parse
+    as Markdown is sent again as plain text. Delivery is at least once: a reply whose
+    answer got lost on the way back may show up twice. on_done(delivered) of a reply
+    runs once it went out, failed or was dropped, not for replies left at shutdown.
+    """
+
+    def __init__(self, token=None, api_url="https://api.telegram.org", rate=30, chat_rate=1, chat_burst=3, queue_max=500, senders=4, max_retries=5, backoff=1):
+        self.token = token
+        self.api_url = api_url
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.queue_max = queue_max
+        self.senders = senders
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._bucket = None
+        self._nodes = 1
+        self._queue = None
+        self._senders = []
+        self._lanes = {} # chat_id -> ChatLane
+        self._callbacks = set() # on_done of replies that never reached a sender
+        self.counters = {"queued": 0, "delivered": 0, "messages": 0, "failed": 0, "dropped": 0,
+                         "retries": 0, "rate_limited": 0, "plain_fallbacks": 0}
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    def url(self, method):
+        return f"{self.api_url}/bot{self.token}/{method}"
+
+    async def start(self):
+        self._bucket = TokenBucket(self.rate/self._nodes, self.rate/self._nodes)
+        self._queue = asyncio.Queue(self.queue_max)
+        self._senders = [asyncio.create_task(self._sender()) for _ in range(self.senders)]
+        logger.info(f"📤 Outbox started with {self.senders} senders, {self.rate} msg/s")
+
+    async def stop(self, timeout=10):
+        """Gives queued replies up to timeout seconds to go out"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"📤 Outbox stopped with {self._queue.qsize()} replies undelivered")
+        for sender in self._senders:
+            sender.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        self._senders = []
+        await asyncio.gather(*self._callbacks, return_exceptions=True)
+
+    def send(self, chat_id, text, on_done=None):
+        """Queues a reply, False when the queue is full and the reply was dropped"""
+        return self.enqueue(chat_id, split_message(text), on_done)
+
+    def enqueue(self, chat_id, chunks, on_done=None, sent=True):
+        if not chunks:
+            self._later(on_done, sent)
+            return sent
+        try:
+            self._queue.put_nowait(Delivery(chat_id, chunks, on_done, sent))
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            logger.error(f"📤 Outbox full, reply to {chat_id} dropped")
+            self._later(on_done, False)
+            return False
+        self.counters["queued"] += 1
+        return True
+
+    def _later(self, on_done, delivered):
+        if on_done:
+            task = asyncio.create_task(self._done(on_done, delivered))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    async def _done(self, on_done, delivered):
+        try:
+            await on_done(delivered)
+        except Exception as e:
+            logger.error(f"📤 Reply callback failed: {e}")
+
+    async def call(self, method, payload, plain=None):
+        """
+        Rate limited API call with retries, returns the result or None when it failed.
+        plain is the unescaped text, sent without parse_mode if Markdown parsing fails.
+        """
+        chat_id = payload.get("chat_id")
+        lane = self._lane(chat_id)
+        lane.users += 1
+        try:
+            return await self._call(lane, method, payload, plain)
+        finally:
+            lane.users -= 1
+
+    async def _call(self, lane, method, payload, plain):
+        for attempt in range(self.max_retries+1):
+            await lane.bucket.acquire()
+            await self._bucket.acquire()
+            delay = self.backoff * 2**attempt
+            start = time.perf_counter()
+            try:
+                response = await http_clients.post("telegram", self.url(method), json=payload)
+                data = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                reason = type(e).__name__
+            else:
+                if data.get("ok"):
+                    return data.get("result")
+                description = data.get("description", "")
+                reason = f"{response.status_code} {description}"
+                if response.status_code == 429:
+                    self.counters["rate_limited"] += 1
+                    lane.bucket.pause(data.get("parameters", {}).get("retry_after", delay)) #next acquire waits it out
+                    delay = 0
+                elif response.status_code == 400 and "message is not modified" in description:
+                    return True #the text is already there
+                elif response.status_code == 400 and "parse" in description and plain is not None and "parse_mode" in payload:
+                    self.counters["plain_fallbacks"] += 1
+                    payload = {key: value for key, value in payload.items() if key != "parse_mode"}
+                    payload["text"] = plain
+                    delay = 0
+                elif response.status_code < 500:
+                    break
+            finally:
+                metrics.observe("bot_stage_seconds", time.perf_counter()-start, stage="telegram_api", name=method)
+
+            if attempt == self.max_retries:
+                break
+            self.counters["retries"] += 1
+            logger.warning(f"📤 {method} to {payload.get('chat_id')} retry {attempt+1}/{self.max_retries} in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
+
+        self.counters["failed"] += 1
+        metrics.inc("bot_errors_total", stage="send", name=method)
+        logger.error(f"📤 {method} to {payload.get('chat_id')} failed: {reason}")
+        return None
+
+    def _lane(self, chat_id):
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if len(self._lanes) >= 1024: #forget chats that are done sending
+                for key in [key for key, old in self._lanes.items() if not old.users and old.bucket.idle()]:
+                    del self._lanes[key]
+            lane = self._lanes[chat_id] = ChatLane(self.chat_rate, self.chat_burst)
+        return lane
+
+    async def _sender(self):
+        while True:
+            delivery = await self._queue.get()
+            trace = trace_id.set(delivery.trace) #log lines of the delivery belong to the turn that queued it
+            try:
+                try:
+                    delivered = await self._deliver(delivery)
+                except Exception as e:
+                    logger.error(f"📤 Delivery to {delivery.chat_id} failed: {e}")
+                    delivered = False
+                if delivery.on_done:
+                    await self._done(delivery.on_done, delivered and delivery.sent)
+            finally:
+                trace_id.reset(trace)
+                self._queue.task_done()
+
+    async def _deliver(self, delivery):
+        lane = self._lane(delivery.chat_id)
+        lane.users += 1
+        try:
+            async with lane.lock:
+                for chunk in delivery.chunks:
+                    payload = {"chat_id": delivery.chat_id, "text": escape_telegram_markdown(chunk), "parse_mode": "Markdown"}
+                    if await self._call(lane, "sendMessage", payload, chunk) is None:
+                        return False
+                    self.counters["messages"] += 1
+        finally:
+            lane.users -= 1
+
+        latency = time.monotonic()-delivery.queued_at
+        self.counters["delivered"] += 1
+        self._latency_sum += latency
+        self._latency_max = max(self._latency_max, latency)
+        metrics.observe("bot_stage_seconds", latency, stage="send")
+        logger.info(f"📤 Reply to {delivery.chat_id} delivered in {len(delivery.chunks)} messages ({latency:.2f}s)")
+        return True
+
+    def share(self, nodes):
+        """The global limit is per bot, with several nodes sending replies each gets 1/nodes of it"""
+        self._nodes = max(1, nodes)
+        if self._bucket:
+            self._bucket.rate = self._bucket.burst = self.rate/self._nodes
+
+    def stats(self):
+        delivered = self.counters["delivered"]
+        return {
+            **self.counters,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "latency_avg_ms": int(self._latency_sum/delivered*1000) if delivered else None,
+            "latency_max_ms": int(self._latency_max*1000)
+        }
+
+class TelegramReplyStream:
+    """
+    Shows a reply while it is being generated: the first partial text goes out with
+    sendMessage and later ones edit that message, at most once per interval.
+    update() never waits on Telegram, the latest text is picked up by a single pusher task.
+    A final text over the message limit keeps its first part in the edited message and
+    the rest goes through the outbox queue, on_done of finish() runs once that is out.
+    """
+
+    def __init__(self, outbox, chat_id: int, interval: float = 1.5):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id = None
+        self.text = ""
+        self.sent_text = ""
+        self.last_push = 0
+        self._pusher = None
+        self._waiting = False
+
+    async def update(self, text: str):
+        self.text = text
+        if self._pusher is None or self._pusher.done():
+            self._pusher = asyncio.create_task(self._push(wait=True))
+
+    async def finish(self, text: str, on_done=None):
+        if self._pusher and self._waiting: #no need to wait for a partial edit, the final text replaces it
+            self._pusher.cancel()
+        elif self._pusher:
+            await self._pusher
+        chunks = split_message(text)
+        self.text = chunks[0] if chunks else ""
+        sent = await self._push(wait=False)
+        self.outbox.enqueue(self.chat_id, chunks[1:], on_done, sent)
+
+    async def _push(self, wait: bool):
+        """False when the message couldn't be sent or edited"""
+        delay = self.last_push + self.interval - time.monotonic()
+        if wait and delay > 0:
+            self._waiting = True
+            await asyncio.sleep(delay)
+            self._waiting = False
+
+        chunks = split_message(self.text)
+        text = chunks[0] if chunks else ""
+        if not text.strip() or text == self.sent_text:
+            return True
+
+        payload = {"chat_id": self.chat_id, "text": escape_telegram_markdown(text), "parse_mode": "Markdown"}
+        if self.message_id is None:
+            result = await self.outbox.call("sendMessage", payload, text)
+            self.message_id = result.get("message_id") if result else None
+        else:
+            result = await self.outbox.call("editMessageText", {**payload, "message_id": self.message_id}, text)
+        self.last_push = time.monotonic()
+        if result is None:
+            return False
+        self.sent_text = text
+        return True
+
+outbox = Outbox()
+
+def configure_outbox(config):
+  """Updates the shared outbox in place, must run before start()"""
+  outbox.token = config["token"]
+  outbox.api_url = config["api_url"]
+  outbox.rate = config["rate"]
+  outbox.chat_rate = config["chat_rate"]
+  outbox.chat_burst = config["chat_burst"]
+  outbox.queue_max = config["queue_max"]
+  outbox.senders = config["senders"]
+  outbox.max_retries = config["max_retries"]
+  return outbox
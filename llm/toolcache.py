@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from .tools import call_tool
+
+logger = logging.getLogger(__name__)
+
+# ttl in seconds, tools without a policy are never cached (get_current_time, file tools...)
+# get_weather_forecast has its own caches in weather.py
+DEFAULT_POLICIES = {
+    "get_series_details": {"ttl": 6*3600, "casefold": True},
+    "browse_website": {"ttl": 900, "casefold": False}
+}
+
+def normalize(value, casefold):
+    if isinstance(value, str):
+        value = " ".join(value.split())
+        return value.casefold() if casefold else value
+    if isinstance(value, dict):
+        return {k: normalize(v, casefold) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v, casefold) for v in value]
+    return value
+
+class ToolCache:
+    """
+    TTL + LRU result cache in front of the tool functions.
+
+    wrap() returns a drop-in replacement for a tool function, the tool itself is not
+    changed. Keys are the tool name plus its normalized arguments (whitespace collapsed,
+    case folded for tools where case doesn't matter), so "Madrid " and "madrid" share
+    a result. Identical calls running at the same time share a single execution.
+    Expiry uses wall-clock time so entries can be saved to disk and reloaded.
+    """
+
+    def __init__(self, policies=None, max_entries=1000, max_bytes=16*1024*1024):
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (expires_at, result, size)
+        self._bytes = 0
+        self._inflight = {}
+        self._wrapped = {}
+        self.counters = {}
+
+    def key(self, name, kwargs):
+        casefold = self.policies[name].get("casefold", False)
+        return f"{name}:{json.dumps(normalize(kwargs, casefold), sort_keys=True, default=str)}"
+
+    def wrap(self, name, func):
+        if name not in self.policies or not self.policies[name].get("ttl"):
+            return func
+        wrapped = self._wrapped.get(name)
+        if wrapped and wrapped.__wrapped__ is func:
+            return wrapped
+
+        async def cached_tool(**kwargs):
+            return await self.call(name, func, kwargs)
+        cached_tool.__wrapped__ = func
+        self._wrapped[name] = cached_tool
+        return cached_tool
+
+    def wrap_all(self, available_functions):
+        return {name: self.wrap(name, func) for name, func in available_functions.items()}
+
+    async def call(self, name, func, kwargs):
+        key = self.key(name, kwargs)
+        counter = self.counters.setdefault(name, {"hits": 0, "misses": 0})
+
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            counter["hits"] += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        if key in self._inflight: #same call already running, share its result
+            counter["hits"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        counter["misses"] += 1
+        # the call runs as its own task: a caller timing out stops waiting for it, it doesn't cancel it for the others
+        task = self._inflight[key] = asyncio.ensure_future(self._run(key, name, func, kwargs))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception()) #retrieved even if nobody waits anymore
+        return await asyncio.shield(task)
+
+    async def _run(self, key, name, func, kwargs):
+        try:
+            result = await call_tool(func, **kwargs)
+        finally:
+            self._inflight.pop(key, None)
+        self._store(key, time.time()+self.policies[name]["ttl"], result)
+        return result
+
+    def _store(self, key, expires_at, result):
+        size = len(key) + len(json.dumps(result, default=str))
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (expires_at, result, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        hits = sum(c["hits"] for c in self.counters.values())
+        lookups = hits + sum(c["misses"] for c in self.counters.values())
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hit_rate": round(hits/lookups, 3) if lookups else None,
+            "tools": self.counters
+        }
+
+    def save(self, path):
+        now = time.time()
+        entries = [[key, expires_at, result] for key, (expires_at, result, _) in self._entries.items() if expires_at > now]
+        try:
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as f:
+                f.write(json.dumps(entries, default=str))
+            os.replace(tmp, path)
+            logger.info(f"Tool cache saved: {len(entries)} entries")
+        except Exception as e:
+            logger.error(f"Cannot save tool cache to {path}!\n{str(e)}")
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                entries = json.loads(f.read())
+        except Exception as e:
+            logger.error(f"Cannot load tool cache from {path}!\n{str(e)}")
+            return
+        now = time.time()
+        for key, expires_at, result in entries:
+            if expires_at > now and key.split(":", 1)[0] in self.policies:
+                self._store(key, expires_at, result)
+        logger.info(f"Tool cache loaded: {len(self._entries)} entries")
+
+tool_cache = ToolCache()
+
+def configure_tool_cache(config):
+  """Updates the shared tool cache in place, modules keep their reference to it"""
+  tool_cache.policies.update(config["policies"])
+  tool_cache.max_entries = config["max_entries"]
+  tool_cache.max_bytes = config["max_bytes"]
+  return tool_cache
@@ -1,26 +1,17 @@
-import os
-import json
 import uuid
-import psycopg2
+import asyncio
+import inspect
 import logging
-import requests
-from typing import List, Optional, Union
-from bs4 import BeautifulSoup
-
-from .dbconfig import DB_CONFIG
-from dotenv import load_dotenv
-
-# Configure basic logging
-logging.basicConfig(
-    format='%(levelname)s: %(name)s %(message)s',
-    level=logging.DEBUG
-)
-logger = logging.getLogger(__name__)
+from typing import Optional
+
+from . import web
+from .registry import tool_registry
+from .weather import weather
+from .files import files
 
-def remove_empty_lines(text):
-    lines = text.split('\n')
-    non_empty_lines = [line for line in lines if line.strip() != '']
-    return str('\n'.join(non_empty_lines))
+from .db import series_db
+
+logger = logging.getLogger(__name__)
 
 def toolcall_to_json(tool):
     id_ = str(uuid.uuid4())
@@ -28,47 +19,36 @@ def toolcall_to_json(tool):
     args = tool.function.arguments
     return {"id":id_ , "type":"function", "function":{"name":name,"arguments":args}}
 
-def connect_to_db():
-    conn = None
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
+async def call_tool(func, **kwargs):
+    """Awaits async tools, blocking tools (db, disk) run in a thread so they don't stall the event loop"""
+    if inspect.iscoroutinefunction(func):
+        return await func(**kwargs)
+    return await asyncio.to_thread(func, **kwargs)
 
+@tool_registry.register
 def get_series_details(name:str):
     """
     Retrieves details of a specific series from the database based on its name.
     It will search in the series database which contains japanese animes and chinese donghuas.
+    The search is fuzzy over titles and alternative titles, best matches come first.
 
     Args:
     - name (str): Name of the series
 
     Returns:
-    - str: series data from query on the database
+    - str: JSON list with the top matches ranked by score
 
     If the series is not found, returns an error message indicating that the ID was not found.
     """
-    conn = connect_to_db()
-    with conn.cursor() as cur:
-        query = f"SELECT id,name,genres,type, viewed as watched,other_names,pub_status as airing,"+\
-                f"rating,to_char(next_release, 'dd/mm/yyyy') as next_release, synopsis "+\
-                f"FROM anime_downloader_anime WHERE name ILIKE '%{name}%'"
-        logger.debug(query)
-        cur.execute(query)
-        cols = list(cur.description)
-        row = cur.fetchone()
-        if not row:
-            logger.error(f"Series id={name} not found")
-            return f"Series id={name} not found"
-        else:
-            logger.info(f"Anime id={name} found")
-            row_dict = {}
-            for i, col in enumerate(cols):
-              row_dict[col.name] = row[i]
-            return str(row_dict)
-
+    rows = series_db.search_series(name)
+    if not rows:
+        logger.error(f"Series id={name} not found")
+        return f"Series id={name} not found"
+    else:
+        logger.info(f"Anime id={name} found, {len(rows)} matches")
+        return rows
+
+@tool_registry.register
 def list_local_dir(directory) -> str:
     """
     This tool will return a local disk directory listing, it's useful to check existing files in local disk.
@@ -78,52 +58,45 @@ def list_local_dir(directory) -> str:
         directory (str): pick of these "drafts","plots","data".
 
     Returns:
-        str: a text string containing all file names
+        str: one line per file with its name, size in bytes and last modification time
 
     Example:
         list_local_dir("drafts") -> file listing in string format from the drafts dir
     """
-    return str(os.listdir())
+    try:
+        return files.list_dir(directory)
+    except Exception as e:
+        logger.error(f"Cannot list {directory}!\n{str(e)}")
+        return f"Error, cannot list {directory}: {e}"
 
-def browse_website(url: str, mode: str)->str:
+@tool_registry.register
+async def browse_website(url: str, mode: str, page: int = 1)->str:
     """
     This function allows to get any webpage on the internet at any time, to function will trigger an HTTP GET to the URL in the parameter.
-    "human" mode will get the text of the website in markdown format
+    "human" mode will get the main text of the website, without menus, headers or footers
     "links" mode is the best approach to explore a website first
     For exploration or browsing purporses use a multi-step strategy use first the "links" method call and then call again several times using "human" mode.
     If you need to search for something you can start here 'https://es.wikipedia.org/w/index.php?search=<search_term>' (<search_term> is your place holder)
+    Long pages are split, the answer starts with "page N of M", call again with the next page number to keep reading.
 
     Args:
       url(string): The URL get data from, any valid URL will work.
-      mode(string): Valid modes: "html", "markdown", "links".
-        - "human" which will get only the text parts in markdown (MD) format
+      mode(string): Valid modes: "human", "links", "html".
+        - "human" which will get only the text parts of the main content
         - "links" which will return all links within the website, this method is suitable while exploring websites
+        - "html" which will return the raw html
+      page(integer): page of the result to return, starts at 1
 
     Returns:
-      str: [http status code] the http body if the web site requested, html if "html" mode is selected or markdown if "markdown" mode.
+      str: [http status code] page N of M, followed by the text, links or html of that page.
 
     Example:
-       browse_website("https://www.opentext.com/contact/", "human") -> [404] failed attempt to extract text from website
+       browse_website("https://www.opentext.com/contact/", "human") -> [404] page 1 of 1 failed attempt to extract text from website
     """
-    response = requests.get(url)
-    status = response.status_code
-
-    if mode=="html":
-        ret_data = f"[{status}] {str(response.__dict__)}"
-    if mode=="human":
-        soup = BeautifulSoup(response.text, 'html.parser')
-        #markdown_converter = mistune.Markdown()
-        #return f"[{status}] {markdown_converter(soup.get_text())}"
-        ret_data = f"[{status}] {soup.get_text()}"
-    if mode=="links":
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = [a.get('href') for a in soup.find_all('a', href=True)]
-        links = sorted(list(set(links)))
-        ret_data = f"[{status}] {', '.join(links)}"
-
-    return remove_empty_lines(ret_data)
-
-def get_weather_forecast(city_name: str, mode: str) -> str:
+    return await web.browse(url, mode, page)
+
+@tool_registry.register
+async def get_weather_forecast(city_name: str, mode: str) -> str:
   """
   Get weather forecast for a given city or location, all data comes from api.openweathermap.org API public endpoints.
   "simple" report will include just basic forecast information.
@@ -131,29 +104,14 @@ def get_weather_forecast(city_name: str, mode: str) -> str:
 
   Args:
   city_name (string): the name of the city or location to get weather forecast from
-  mode (string): it can be "simple" to get highs and lows basic info, or "detailed" to get a full hourly json dump.
+  mode (string): it can be "simple" to get the current weather, or "detailed" to get a forecast every 3 hours for the next 24 hours.
 
   Returns:
-    str: the weather forecast for the location in JSON format, you should translate to a very detailed human readable text. All units will be in international system
+    str: the weather for the location in compact JSON format, you should translate to a very detailed human readable text. All units will be in international system
   """
-  load_dotenv()
-  WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-
-  geo_url=f"http://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={WEATHER_API_KEY}"
-  response_geo = requests.get(geo_url)
-
-  lon = response_geo.json()[0]["lon"]
-  lat = response_geo.json()[0]["lat"]
-  query = f"lon={lon}&lat={lat}&appid={WEATHER_API_KEY}&units=metric&cnt=8"
-
-  if mode=="simple":
-     weather_url=f"https://api.openweathermap.org/data/2.5/weather?{query}"
-  else:
-     weather_url=f"https://api.openweathermap.org/data/2.5/forecast?{query}"
-
-  response_weather = requests.get(weather_url)
-  return str(response_weather.json())
+  return await weather.forecast(city_name, mode)
 
+@tool_registry.register
 def get_current_time() -> str:
   """
   Returns today's date and time for Madrid (Spain) timezone
@@ -165,68 +123,94 @@ def get_current_time() -> str:
   return str(datetime.now())
 
 
-def write_file(filename, text):
-    """Creates or overwrites a file in the disk server, you can save any file.
+@tool_registry.register
+def write_file(filename: str, text: str, mode: Optional[str] = None) -> str:
+    """Creates, overwrites or appends to a file in the disk server, you can save any file.
     Consider adding the proper extension to the file.
-    Do not set any path, just filename.
+    Do not set any path, just filename. Use patch_file to change a part of an existing file.
 
     Args:
-        filename (str): Name of file to create/overwrite. Include extension.
+        filename (str): Name of file to write in the drafts folder. Include extension.
         text (str): Content to write to the file. UTF-8 encoded.
+        mode (str): "overwrite" replaces the file, "append" adds text at its end.
 
     Returns:
         str: Success or error message
     """
-    logger.info(f"Written to {filename}")
     try:
-        with open(f"drafts/{filename}", "w") as f:
-            f.write(text)
-
-        return "Success, data written to {filename}"
-
+        mode = mode or "overwrite"
+        size = files.write(filename, text, mode)
+        logger.info(f"Written to {filename} ({mode}), {size} bytes")
+        return f"Success, data written to {filename}, {size} bytes"
     except Exception as e:
         logger.error(f"Cannot write to {filename}!\n{str(e)}")
-        return "Error, cannot write to {filename}"
+        return f"Error, cannot write to {filename}: {e}"
 
+@tool_registry.register
+def patch_file(filename: str, old_text: str, new_text: str) -> str:
+    """Replaces a piece of text in an existing file, the rest of the file is kept as is.
+    old_text must appear exactly once in the file, read the file first to copy it.
 
-def read_file(filename):
+    Args:
+        filename (str): Name of file in the drafts folder. Include extension.
+        old_text (str): Exact text to replace.
+        new_text (str): Text to put in its place, empty to delete it.
+
+    Returns:
+        str: Success or error message
+    """
+    try:
+        pos = files.patch(filename, old_text, new_text)
+        logger.info(f"Patched {filename} at byte {pos}")
+        return f"Success, {filename} patched at byte {pos}"
+    except Exception as e:
+        logger.error(f"Cannot patch {filename}!\n{str(e)}")
+        return f"Error, cannot patch {filename}: {e}"
+
+@tool_registry.register
+def read_file(filename: str, offset: Optional[int] = None, limit: Optional[int] = None, line: Optional[int] = None, lines: Optional[int] = None) -> str:
     """Retrieves file contents from disk server, useful to retrieve any previously saved file.
-    Do not set any path, just the filename.
+    A bare filename is read from drafts, "plots/name" or "data/name" read from those folders.
+    Long files come in windows of about 4000 bytes starting with a [file bytes X-Y of N] line,
+    call again with the offset or line it gives to keep reading.
 
     Args:
-        filename (str): Name of file to read from drafts folder. Include extension.
+        filename (str): Name of file to read. Include extension.
+        offset (int): byte to start reading at, the beginning by default
+        limit (int): how many bytes to read, about 4000 by default
+        line (int): read by lines instead, first line to return (starts at 1)
+        lines (int): how many lines to return with line
 
     Returns:
         str: File contents as string if successful, error message if file doesn't
         exist or can't be read.
     """
-    logger.info(f"Read from {filename}")
     try:
-        f = open(f"drafts/{filename}","r")
-        return f.read()
+        text = files.read(filename, offset or 0, limit or 0, line or 0, lines or 0)
+        logger.info(f"Read from {filename}, {len(text)} chars")
+        return text
     except Exception as e:
         logger.error(f"Cannot read from {filename}!\n{str(e)}")
-        return f"Error, cannot read from {filename}"
+        return f"Error, cannot read from {filename}: {e}"
+
+@tool_registry.register
+def search_files(pattern: str, filename: Optional[str] = None) -> str:
+    """Finds the lines of the local files that match a text or regular expression, case insensitive.
+    Useful to locate something in a long file before reading that part with read_file(line=...).
+
+    Args:
+        pattern (str): text or regular expression to look for
+        filename (str): a file name, or a folder ("drafts", "plots", "data"), empty searches every folder
+
+    Returns:
+        str: one "folder/file:line: text" per matching line
+    """
+    try:
+        return files.search(pattern, filename or "")
+    except Exception as e:
+        logger.error(f"Cannot search {filename or 'files'}!\n{str(e)}")
+        return f"Error, cannot search {filename or 'files'}: {e}"
 
 
 def get_tools():
-  tools = [
-    get_series_details,
-    list_local_dir,
-    get_weather_forecast,
-    get_current_time,
-    browse_website,
-    write_file,
-    read_file
-  ]
-
-  available_functions = {
-    'get_series_details': get_series_details,
-    'list_local_dir': list_local_dir,
-    'get_weather_forecast': get_weather_forecast,
-    'get_current_time': get_current_time,
-    'browse_website': browse_website,
-    'write_file': write_file,
-    'read_file': read_file
-  }
-  return tools, available_functions
+  return tool_registry.get_tools()
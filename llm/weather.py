@@ -0,0 +1,184 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+
+import httpx
+
+from .httpclient import http_clients
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.openweathermap.org"
+
+# openweathermap refreshes current weather every 10 minutes and the 3-hourly forecast every 3 hours,
+# cached data expires at the next refresh instead of after a fixed ttl
+REFRESH_SECS = {"simple": 600, "detailed": 3*3600}
+
+WEATHER_CONFIG = {
+    "api_key": None,
+    "geocode_file": "data/geocode.json",
+    "geocode_entries": 5000,
+    "forecast_points": 8, # 3h points in a detailed forecast, 8 = next 24h
+    "forecast_entries": 500
+}
+
+class WeatherError(RuntimeError):
+    """A failed call to the weather API, the message is safe for the model (no url, it holds the api key)"""
+
+def city_key(city_name):
+    return " ".join(city_name.split()).casefold()
+
+def _weather_point(item):
+    main = item.get("main", {})
+    rain = item.get("rain") or {}
+    point = {
+        "dt": item.get("dt"),
+        "temp": main.get("temp"),
+        "feels_like": main.get("feels_like"),
+        "min": main.get("temp_min"),
+        "max": main.get("temp_max"),
+        "humidity": main.get("humidity"),
+        "wind": item.get("wind", {}).get("speed"),
+        "clouds": item.get("clouds", {}).get("all"),
+        "pop": item.get("pop"),
+        "rain": rain.get("3h", rain.get("1h")),
+        "weather": ", ".join(w.get("description", "") for w in item.get("weather", []))
+    }
+    return {k: v for k, v in point.items() if v is not None and v != ""}
+
+def compact_weather(place, data):
+    """Only what the model needs from a current weather or forecast answer, no ids, icons or duplicated units"""
+    report = {"city": place["name"], "country": place.get("country"), "timezone": data.get("timezone", data.get("city", {}).get("timezone"))}
+    if "list" in data:
+        report["forecast"] = [_weather_point(item) for item in data["list"]]
+    else:
+        report.update(_weather_point(data))
+    return report
+
+class WeatherService:
+    """
+    Weather lookups for the get_weather_forecast tool.
+
+    City names resolve to coordinates through a geocoding cache saved to disk, the set of
+    places users ask about is small and doesn't change, so the geocoding API is only
+    called for new cities. Reports are cached by rounded coordinates and mode until the
+    provider publishes new data. A repeated question costs no request, a new city with
+    known weather one, and every answer is parsed once into a compact dict.
+    """
+
+    def __init__(self):
+        self._places = {}    # city key -> {"lat", "lon", "name", "country"}
+        self._reports = {}   # (lat, lon, mode) -> (expires_at, report)
+        self._inflight = {}
+        self._dirty = False
+        self.counters = {"geocode_hits": 0, "geocode_calls": 0, "report_hits": 0, "report_calls": 0}
+
+    async def forecast(self, city_name, mode):
+        try:
+            return await self._forecast(city_name, mode)
+        except WeatherError as e:
+            return f"Error, {e}"
+
+    async def _forecast(self, city_name, mode):
+        mode = "simple" if mode == "simple" else "detailed"
+        place = await self.locate(city_name)
+        if place is None:
+            return f"Error, location {city_name} not found"
+
+        key = (round(place["lat"], 2), round(place["lon"], 2), mode)
+        cached = self._reports.get(key)
+        if cached and cached[0] > time.time():
+            self.counters["report_hits"] += 1
+            return cached[1]
+
+        if key in self._inflight: #same report already being fetched
+            self.counters["report_hits"] += 1
+            return await asyncio.shield(self._inflight[key])
+        task = self._inflight[key] = asyncio.ensure_future(self._fetch(place, mode))
+        try:
+            report = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(key, None)
+
+        refresh = REFRESH_SECS[mode]
+        self._reports[key] = (math.ceil(time.time()/refresh)*refresh, report)
+        while len(self._reports) > WEATHER_CONFIG["forecast_entries"]:
+            self._reports.pop(next(iter(self._reports)))
+        return report
+
+    async def _fetch(self, place, mode):
+        self.counters["report_calls"] += 1
+        params = {"lat": place["lat"], "lon": place["lon"], "appid": WEATHER_CONFIG["api_key"], "units": "metric"}
+        if mode == "simple":
+            url = f"{API_URL}/data/2.5/weather"
+        else:
+            url = f"{API_URL}/data/2.5/forecast"
+            params["cnt"] = WEATHER_CONFIG["forecast_points"]
+        return compact_weather(place, await self._get(url, params))
+
+    async def _get(self, url, params):
+        """JSON answer of the API, errors never carry the url or the exception text: both hold the api key"""
+        try:
+            response = await http_clients.get("weather", url, params=params)
+        except httpx.HTTPError as e:
+            raise WeatherError(f"weather service unreachable ({type(e).__name__})") from None
+        if response.is_error:
+            raise WeatherError(f"weather service error {response.status_code}")
+        return response.json()
+
+    async def locate(self, city_name):
+        key = city_key(city_name)
+        if key in self._places:
+            self.counters["geocode_hits"] += 1
+            return self._places[key]
+
+        self.counters["geocode_calls"] += 1
+        found = await self._get(f"{API_URL}/geo/1.0/direct", {"q": city_name, "limit": 1, "appid": WEATHER_CONFIG["api_key"]})
+        if not found:
+            return None
+
+        place = {"lat": found[0]["lat"], "lon": found[0]["lon"], "name": found[0].get("name", city_name), "country": found[0].get("country")}
+        self._places[key] = place
+        if len(self._places) > WEATHER_CONFIG["geocode_entries"]:
+            self._places.pop(next(iter(self._places)))
+        self._dirty = True
+        await asyncio.to_thread(self.save)
+        return place
+
+    def save(self, path=None):
+        path = path or WEATHER_CONFIG["geocode_file"]
+        if not path or not self._dirty:
+            return
+        try:
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as f:
+                f.write(json.dumps(self._places, ensure_ascii=False))
+            os.replace(tmp, path)
+            self._dirty = False
+        except Exception as e:
+            logger.error(f"Cannot save geocode cache to {path}!\n{str(e)}")
+
+    def load(self, path=None):
+        path = path or WEATHER_CONFIG["geocode_file"]
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                self._places.update(json.loads(f.read()))
+            logger.info(f"Geocode cache loaded: {len(self._places)} places")
+        except Exception as e:
+            logger.error(f"Cannot load geocode cache from {path}!\n{str(e)}")
+
+    def stats(self):
+        return {**self.counters, "places": len(self._places), "reports": len(self._reports)}
+
+weather = WeatherService()
+
+def configure_weather(config):
+  """Updates the shared weather settings and loads the geocode cache"""
+  WEATHER_CONFIG.update(config)
+  weather.load()
+  return weather
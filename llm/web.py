@@ -0,0 +1,128 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from urllib.parse import urljoin
+
+from .httpclient import HTTP_CONFIG, http_clients
+
+logger = logging.getLogger(__name__)
+
+_soup = None
+
+def soup_parser():
+    """bs4 and the parser are imported on the first page that needs parsing"""
+    global _soup
+    if _soup is None:
+        from bs4 import BeautifulSoup
+        try: #C parser, several times faster than html.parser
+            import lxml
+            parser = "lxml"
+        except ImportError:
+            parser = "html.parser"
+        _soup = (BeautifulSoup, parser)
+    return _soup
+
+TEXT_TYPES = ("text/html", "application/xhtml+xml", "text/plain", "application/json", "text/xml", "application/xml")
+NOISE_TAGS = ["script", "style", "noscript", "template", "svg", "iframe", "nav", "header", "footer", "aside", "form"]
+
+WEB_CONFIG = {
+    "max_bytes": 2*1024*1024,
+    "page_chars": 6000,
+    "doc_cache_size": 32,
+    "doc_cache_ttl": 300
+}
+
+class WebPage:
+    def __init__(self, status, pages, truncated):
+        self.status = status
+        self.pages = pages
+        self.truncated = truncated
+        self.fetched_at = time.monotonic()
+
+_documents = OrderedDict() # (url, mode) -> WebPage, so asking for page 2 doesn't download again
+
+def configure_web(config):
+  """Timeouts go to the shared "web" HTTP pool, the rest are fetch limits"""
+  HTTP_CONFIG["web"]["connect_timeout"] = config.pop("connect_timeout", 5)
+  HTTP_CONFIG["web"]["read_timeout"] = config.pop("read_timeout", 15)
+  WEB_CONFIG.update(config)
+
+async def download(url):
+    """Streams the body up to max_bytes, returns (status, content type, text, truncated)"""
+    async with http_clients.stream("web", "GET", url) as response:
+        content_type = response.headers.get("content-type", "text/html").split(";")[0].strip().lower()
+        if content_type not in TEXT_TYPES:
+            return response.status_code, content_type, None, False
+
+        body = bytearray()
+        truncated = False
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) >= WEB_CONFIG["max_bytes"]:
+                truncated = True
+                break
+        encoding = response.charset_encoding or "utf-8"
+        return response.status_code, content_type, bytes(body[:WEB_CONFIG["max_bytes"]]).decode(encoding, errors="replace"), truncated
+
+def remove_empty_lines(text):
+    return "\n".join(line.strip() for line in text.split("\n") if line.strip())
+
+def extract(url, content_type, text, mode):
+    """CPU bound, runs in a thread: main text, links or raw html of a document"""
+    if mode == "html" or content_type not in ("text/html", "application/xhtml+xml"):
+        return text
+
+    BeautifulSoup, parser = soup_parser()
+    soup = BeautifulSoup(text, parser)
+    if mode == "links":
+        links = {urljoin(url, a.get("href")) for a in soup.find_all("a", href=True) if not a.get("href").startswith(("#", "javascript:"))}
+        return "\n".join(sorted(links))
+
+    for tag in soup(NOISE_TAGS):
+        tag.decompose()
+    main = soup.find("main") or soup.find("article") or soup.find(attrs={"role": "main"}) or soup.body or soup
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    content = remove_empty_lines(main.get_text("\n"))
+    return f"# {title}\n{content}" if title else content
+
+def paginate(text, page_chars):
+    """Splits text in pages of about page_chars, cutting at line ends when possible"""
+    pages = []
+    while len(text) > page_chars:
+        cut = text.rfind("\n", 0, page_chars)
+        if cut < page_chars//2:
+            cut = page_chars
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pages.append(text)
+    return pages
+
+async def fetch_page(url, mode):
+    key = (url, mode)
+    doc = _documents.get(key)
+    if doc and time.monotonic()-doc.fetched_at < WEB_CONFIG["doc_cache_ttl"]:
+        _documents.move_to_end(key)
+        return doc
+
+    status, content_type, text, truncated = await download(url)
+    if text is None:
+        doc = WebPage(status, [f"unsupported content type {content_type}"], False)
+    else:
+        content = await asyncio.to_thread(extract, url, content_type, text, mode)
+        doc = WebPage(status, paginate(content, WEB_CONFIG["page_chars"]), truncated)
+        logger.info(f"🌐 {url} [{status}] {len(text)} chars downloaded, {len(content)} extracted in {len(doc.pages)} pages")
+
+    _documents[key] = doc
+    while len(_documents) > WEB_CONFIG["doc_cache_size"]:
+        _documents.popitem(last=False)
+    return doc
+
+async def browse(url, mode, page=1):
+    doc = await fetch_page(url, mode)
+    page = min(max(1, int(page)), len(doc.pages))
+    header = f"[{doc.status}] page {page} of {len(doc.pages)}"
+    if doc.truncated:
+        header += f" (download stopped at {WEB_CONFIG['max_bytes']//1024} KB)"
+    footer = f"\n[call again with page={page+1} to continue]" if page < len(doc.pages) else ""
+    return f"{header}\n{doc.pages[page-1]}{footer}"